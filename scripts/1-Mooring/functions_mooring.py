@@ -1,23 +1,35 @@
 import os
 import json
+import glob
 import shutil
+import hashlib
 import numpy as np
 import pandas as pd
 import netCDF4
+import openpyxl
 from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timezone, timedelta
 from dateutil.relativedelta import relativedelta
+from netcdf_storage import create_variable, mask_invalid, masked_view, append_sorted, insert_profiles
 
 
 
-def read_data(file_path, file_type):
+# Bits of the quality flags (_qual variables): a flag is the sum of the bits of the failed tests
+qa_bits = {"deployment": 1, "range": 2, "spike": 4, "gradient": 8, "flat_line": 16, "neighbour": 32}
+qa_flag_description = "0 = nothing to report, sum of: " + ", ".join("{} = {}".format(bit, test) for test, bit in qa_bits.items())
+
+
+def read_data(file_path, file_type, cache_folder=None, engine="pandas"):
     if file_type == "hobo_T":
-        temp = read_temp_hobo(file_path)
+        temp = read_temp_hobo(file_path, cache_folder, engine=engine)
     else:
         raise ValueError("File type not recognised: {}".format(file_type))
     return temp
 
-def read_temp_hobo(file_path):
+def read_temp_hobo(file_path, cache_folder=None, cache_size_max=500e6, engine="pandas"):
+    # If cache_folder is given, the parsed columns are stored there and reused as long as the Excel file is unchanged
+    # engine="stream" reads the sheet row by row (lower memory use for long deployments), engine="pandas" uses pd.read_excel
     ind_name=file_path.rfind("\\")
     if ind_name==-1: # The character was not found
         ind_name=file_path.rfind("/")
@@ -31,11 +43,133 @@ def read_temp_hobo(file_path):
         filename=file_path
         filepath=''
         
-    df = pd.read_excel(file_path, header=None, sheet_name='Data',skiprows=1,usecols=[1,2], names=["time","Temp"],index_col=False)
-    df["time"]=df["time"].astype("datetime64[s]")
+    cached = None
+    if cache_folder:
+        cache_file = hobo_cache_file(file_path, cache_folder)
+        cached = load_hobo_cache(cache_file)
+    if cached is None and engine == "stream":
+        time, temp = read_hobo_stream(file_path)
+        df = pd.DataFrame({"time": time.view("datetime64[s]"), "Temp": temp})
+        if cache_folder:
+            save_hobo_cache(cache_file, time, temp, cache_size_max)
+    elif cached is None:
+        df = pd.read_excel(file_path, header=None, sheet_name='Data',skiprows=1,usecols=[1,2], names=["time","Temp"],index_col=False)
+        df["time"]=df["time"].astype("datetime64[s]")
+        if cache_folder:
+            save_hobo_cache(cache_file, df["time"].values.view("int64"), df["Temp"].values.astype("float"), cache_size_max)
+    else:
+        df = pd.DataFrame({"time": cached["time"].view("datetime64[s]"), "Temp": cached["Temp"]})
     data_temp={"folder":filepath,"file":filename,"data":df}
     return data_temp
 
+def read_hobo_stream(file_path, chunk_size=10000):
+    # Read the columns time and Temp of the sheet 'Data' in chunks and write them in preallocated arrays
+    # Returns time as int64 [seconds since 1970-01-01, NaT for empty cells] and Temp as float64
+    wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        ws = wb["Data"]
+        n_rows = ws.max_row - 1 if ws.max_row else chunk_size # max_row comes from the sheet dimension and can be missing
+        time = np.empty(max(n_rows, 1), dtype=np.int64)
+        temp = np.empty(max(n_rows, 1), dtype=np.float64)
+        n = 0 # Number of rows written
+        n_data = 0 # Number of rows up to the last non empty row (trailing empty rows are removed, as in pd.read_excel)
+        chunk_time = []
+        chunk_temp = []
+        for row in ws.iter_rows(min_row=2, max_col=3, values_only=True):
+            row = tuple(row) + (None,) * (3 - len(row))
+            chunk_time.append(row[1])
+            chunk_temp.append(row[2])
+            if row[0] is not None or row[1] is not None or row[2] is not None:
+                n_data = n + len(chunk_time)
+            if len(chunk_time) == chunk_size:
+                time, temp = write_hobo_chunk(time, temp, n, chunk_time, chunk_temp)
+                n = n + len(chunk_time)
+                chunk_time = []
+                chunk_temp = []
+        if len(chunk_time) > 0:
+            time, temp = write_hobo_chunk(time, temp, n, chunk_time, chunk_temp)
+    finally:
+        wb.close()
+    return time[:n_data], temp[:n_data]
+
+def write_hobo_chunk(time, temp, n, chunk_time, chunk_temp):
+    if n + len(chunk_time) > len(time): # Sheet dimension was wrong: grow the arrays
+        n_new = max(2 * len(time), n + len(chunk_time))
+        time = np.resize(time, n_new)
+        temp = np.resize(temp, n_new)
+    try:
+        time[n:n + len(chunk_time)] = np.array(chunk_time, dtype="datetime64[s]").view(np.int64)
+    except ValueError: # Dates stored as text
+        time[n:n + len(chunk_time)] = pd.to_datetime(pd.Series(chunk_time)).values.astype("datetime64[s]").view(np.int64)
+    temp[n:n + len(chunk_temp)] = np.array(chunk_temp, dtype=np.float64)
+    return time, temp
+
+def file_hash(file_path, block_size=2**20):
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def hobo_cache_file(file_path, cache_folder):
+    # Name = hash of the path + hash of size, modification time and content, so that a modified file never hits an old entry
+    stat = os.stat(file_path)
+    path_key = hashlib.sha1(os.path.abspath(file_path).encode()).hexdigest()[:16]
+    content_key = hashlib.sha1("{}_{}_{}".format(stat.st_size, stat.st_mtime_ns, file_hash(file_path)).encode()).hexdigest()[:16]
+    return os.path.join(cache_folder, "{}_{}.npz".format(path_key, content_key))
+
+def load_hobo_cache(cache_file):
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with np.load(cache_file) as npz:
+            cached = {"time": npz["time"], "Temp": npz["Temp"]}
+    except Exception as e:
+        print("Failed to read cache {}: {}".format(cache_file, e))
+        return None
+    os.utime(cache_file) # Mark as recently used for the eviction
+    return cached
+
+def save_hobo_cache(cache_file, time, temp, cache_size_max=500e6):
+    cache_folder = os.path.dirname(cache_file)
+    os.makedirs(cache_folder, exist_ok=True)
+    for old_file in glob.glob(os.path.join(cache_folder, os.path.basename(cache_file).split("_")[0] + "_*.npz")):
+        os.remove(old_file) # Previous versions of the same Excel file
+    tmp_file = cache_file + ".{}.tmp".format(os.getpid())
+    with open(tmp_file, "wb") as f:
+        np.savez(f, time=time, Temp=temp)
+    os.replace(tmp_file, cache_file) # Atomic, several processes can fill the cache at the same time
+    evict_hobo_cache(cache_folder, cache_size_max)
+
+def evict_hobo_cache(cache_folder, cache_size_max=500e6):
+    # Remove the least recently used entries until the cache is smaller than cache_size_max [bytes]
+    entries = []
+    for f in glob.glob(os.path.join(cache_folder, "*.npz")):
+        try:
+            stat = os.stat(f)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, f))
+    entries.sort()
+    cache_size = sum([entry[1] for entry in entries])
+    for mtime, size, f in entries:
+        if cache_size <= cache_size_max:
+            break
+        try:
+            os.remove(f)
+        except FileNotFoundError:
+            pass
+        cache_size -= size
+
+def clear_hobo_cache(cache_folder, file_path=None):
+    # Invalidate the cache entries of one Excel file, or of all files if file_path is None
+    if file_path is None:
+        pattern = "*.npz"
+    else:
+        pattern = hashlib.sha1(os.path.abspath(file_path).encode()).hexdigest()[:16] + "_*.npz"
+    for f in glob.glob(os.path.join(cache_folder, pattern)):
+        os.remove(f)
+
 
 def ch1903_to_latlng(x, y):
     x_aux = (x - 600000) / 1000000
@@ -53,8 +187,10 @@ def copy_variables(variables_dict):
     nc_copy = deepcopy(var_dict)
     return nc_copy
 
-def export(obj, folder, title, output_period="file", time_label="time", profile_to_grid=False, overwrite=False):
+def export(obj, folder, title, output_period="file", time_label="time", profile_to_grid=False, overwrite=False, folder_masked=None, title_masked=None):
     # If profile_to_grid=True, variable has been interpolated to a grid (e.g., profle with fixed depths)
+    # If folder_masked and title_masked are given, the data with the flagged values masked (Level 2) is exported in the same call
+    # to sibling files, from a masked view of the data (the data is not copied nor modified, no need to call mask_data)
     if profile_to_grid:
         variables = obj.grid_variables
         dimensions = obj.grid_dimensions
@@ -64,7 +200,32 @@ def export(obj, folder, title, output_period="file", time_label="time", profile_
         dimensions = obj.dimensions
         data = obj.data
 
-    time = data[time_label]
+    output_files = export_data(obj, variables, dimensions, data, folder, title, output_period, time_label, profile_to_grid, overwrite)
+    if folder_masked is not None:
+        output_files += export_data(obj, variables, dimensions, masked_view(data), folder_masked, title_masked, output_period, time_label, profile_to_grid, overwrite)
+    return output_files
+
+def remove_stale_outputs(folder, title, time):
+    """
+    Remove the files of title in folder (written by export with output_period="file") that cannot be updated with the
+    data at time: files starting at another time or with time steps that are not in time anymore. export merges the
+    new data in the other files (append_sorted).
+    """
+    if not os.path.isdir(folder) or len(time) == 0:
+        return
+    name = "{}_{}.nc".format(title, datetime.utcfromtimestamp(np.nanmin(time)).strftime('%Y%m%d_%H%M%S'))
+    for file in glob.glob(os.path.join(folder, glob.escape(title) + "_????????_??????.nc")):
+        if os.path.basename(file) == name:
+            with netCDF4.Dataset(file, mode='r') as nc:
+                file_time = nc.variables["time"][:].data
+            if np.all(np.isin(file_time, time)):
+                continue
+        print("Remove {}: rewritten from the new data".format(os.path.basename(file)))
+        os.remove(file)
+
+def export_data(obj, variables, dimensions, data, folder, title, output_period="file", time_label="time", profile_to_grid=False, overwrite=False):
+    # Write data to the netCDF files of folder, one file per output period
+    time = np.ma.filled(np.ma.asarray(data[time_label], dtype=float), np.nan) # Masked times are not exported
     time_min = datetime.utcfromtimestamp(np.nanmin(time)).replace(tzinfo=timezone.utc)
     time_max = datetime.utcfromtimestamp(np.nanmax(time)).replace(tzinfo=timezone.utc)
 
@@ -85,7 +246,7 @@ def export(obj, folder, title, output_period="file", time_label="time", profile_
         file_period = relativedelta(year=+1)
     else:
         print('Output period "{}" not recognised.'.format(output_period))
-        return
+        return []
 
     if not os.path.exists(folder):
         os.makedirs(folder)
@@ -105,107 +266,129 @@ def export(obj, folder, title, output_period="file", time_label="time", profile_
                 for key, values in dimensions.items():
                     nc.createDimension(values['dim_name'], values['dim_size'])
                 for key, values in variables.items():
-                    var = nc.createVariable(values["var_name"], np.float64, values["dim"], fill_value=np.nan)
-                    var.units = values["unit"]
-                    var.long_name = values["long_name"]
+                    var = create_variable(nc, values, np.shape(data[key]))
                     if profile_to_grid and key == time_label:
                         var[0] = time[0]
                     elif profile_to_grid and len(values["dim"]) == 2:
                         if values["dim"][0] == time_label:
-                            var[0, :] = data[key]
+                            var[0, :] = mask_invalid(var, data[key])
                         elif values["dim"][1] == time_label:
-                            var[:, 0] = data[key]
+                            var[:, 0] = mask_invalid(var, data[key])
                         else:
                             raise ValueError("Failed to write variable {} with dimensions: {} to file".format(key, ", ".join(values["dim"])))
                     else:
                         if len(values["dim"]) == 1:
                             if values["dim"][0] == time_label:
-                                var[:] = data[key][valid_time]
+                                var[:] = mask_invalid(var, data[key][valid_time])
                             else:
-                                var[:] = data[key]
+                                var[:] = mask_invalid(var, data[key])
                         elif len(values["dim"]) == 2:
                             if values["dim"][0] == time_label:
-                                var[:] = data[key][valid_time, :]
+                                var[:] = mask_invalid(var, data[key][valid_time, :])
                             elif values["dim"][1] == time_label:
-                                var[:] = data[key][:, valid_time]
+                                var[:] = mask_invalid(var, data[key][:, valid_time])
                         else:
                             raise ValueError("Failed to write variable {} with dimensions: {} to file".format(key, ", ".join(values["dim"])))
                 #close_netCDF(nc,out_file)
         
         else:
             with netCDF4.Dataset(out_file, mode='a', format='NETCDF4') as nc:
-                nc_time = np.array(nc.variables[time_label][:])
+                for key in obj.general_attributes: # e.g., corrected depth of the sensor
+                    setattr(nc, key, obj.general_attributes[key])
                 if profile_to_grid:
-                    if time[0] in nc_time:
-                        if overwrite:
-                            idx = np.where(nc_time == time[0])[0][0]
-                            for key, values in variables.items():
-                                if key not in dimensions:
-                                    if len(values["dim"]) == 1:
-                                        if hasattr(data[key], "__len__"):
-                                            nc.variables[key][idx] = data[key][0]
-                                        else:
-                                            nc.variables[key][idx] = data[key]
-                                    elif len(values["dim"]) == 2 and values["dim"][1] == time_label:
-                                        nc.variables[key][:, idx] = data[key]
-                                    else:
-                                        obj.logger.warning("Unable to write {} with {} dimensions.".format(key, len(
-                                            values["dim"])))
-
-                        else:
-                            obj.logger.warning("Grid data already exists in NetCDF, skipping.")
-                    else:
-                        idx = position_in_array(nc_time, time[0])
-                        nc.variables[time_label][:] = np.insert(nc_time, idx, time[0])
-                        for key, values in variables.items():
-                            if key not in dimensions:
-                                var = nc.variables[key]
-                                if len(values["dim"]) == 1:
-                                    if hasattr(data[key], "__len__"):
-                                        var[idx] = data[key][0]
-                                    else:
-                                        var[idx] = data[key]
-                                elif len(values["dim"]) == 2 and values["dim"][1] == time_label:
-                                    end = len(var[:][0]) - 1
-                                    if idx != end:
-                                        var[:, end] = data[key]
-                                        var[:] = var[:, np.insert(np.arange(end), idx, end)]
-                                    else:
-                                        var[:, idx] = data[key]
-                                else:
-                                    obj.logger.warning(
-                                        "Unable to write {} with {} dimensions.".format(key, len(values["dim"])))
+                    insert_profiles(nc, variables, dimensions, [data], time_label, overwrite)
                 else:
-                    if np.all(np.isin(time, nc_time)) and not overwrite:
-                        obj.logger.warning("Data already exists in NetCDF, skipping.")
-                    else:
-                        non_duplicates = ~np.isin(time, nc_time)
-                        valid = np.logical_and(valid_time, non_duplicates)
-                        combined_time = np.append(nc_time, time[valid])
-                        order = np.argsort(combined_time)
-                        nc_copy = copy_variables(nc.variables)
-                        for key, values in obj.variables.items():
-                            if time_label in values["dim"]:
-                                if len(values["dim"]) == 1:
-                                    combined = np.append(nc_copy[key][:], np.array(data[key])[valid])
-                                    if overwrite:
-                                        combined[np.isin(combined_time, time)] = np.array(data[key])[
-                                            np.isin(time, combined_time)]
-                                    out = combined[order]
-                                elif len(values["dim"]) == 2 and values["dim"][1] == time_label:
-                                    combined = np.concatenate((np.array(nc_copy[key][:]), np.array(data[key])[:, valid]), axis=1)
-                                    if overwrite:
-                                        combined[:, np.isin(combined_time, time)] = np.array(data[key])[:, np.isin(time, combined_time)]
-                                    out = combined[:, order]
-                                else:
-                                    raise ValueError(
-                                        "Failed to write variable {} with dimensions: {} to file"
-                                        .format(key, ", ".join(values["dim"])))
-                                nc.variables[key][:] = out
+                    if not append_sorted(nc, variables, data, time, valid_time, time_label, overwrite):
+                        print("Data already exists in NetCDF, skipping.")
                 #close_netCDF(nc,out_file)
         file_start = file_start + file_period
     return output_files
 
+def qa_range(values, bounds):
+    # Values outside [bounds[0], bounds[1]] (None: no bound)
+    flag = np.zeros(np.shape(values), dtype=bool)
+    with np.errstate(invalid="ignore"):
+        if bounds[0] is not None:
+            flag |= values < bounds[0]
+        if bounds[1] is not None:
+            flag |= values > bounds[1]
+    return flag
+
+def qa_spike(values, window=5, threshold=1.):
+    # Values differing by more than threshold from the running median over window samples (centred)
+    if len(values) < window:
+        return np.zeros(len(values), dtype=bool)
+    half = window // 2
+    padded = np.concatenate((np.full(half, values[0]), values, np.full(window - 1 - half, values[-1])))
+    median = np.median(np.lib.stride_tricks.sliding_window_view(padded, window), axis=-1)
+    with np.errstate(invalid="ignore"):
+        return np.abs(values - median) > threshold
+
+def qa_gradient(values, time, max_rate):
+    # Values changing faster than max_rate (unit of values per second) since the previous sample
+    flag = np.zeros(len(values), dtype=bool)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        flag[1:] = np.abs(np.diff(values) / np.diff(time)) > max_rate
+    return flag
+
+def qa_flat_line(values, window, tolerance=0.):
+    # Values belonging to a run of at least window samples varying by less than tolerance from one sample to the next
+    flag = np.zeros(len(values), dtype=bool)
+    if len(values) < window:
+        return flag
+    flat = np.concatenate(([False], np.abs(np.diff(values)) <= tolerance, [False]))
+    edges = np.diff(flat.astype(np.int8))
+    run_start = np.where(edges == 1)[0] # First sample of the run
+    run_end = np.where(edges == -1)[0] # Last sample of the run
+    long_runs = run_end - run_start + 1 >= window
+    marker = np.zeros(len(values) + 1, dtype=np.int64)
+    np.add.at(marker, run_start[long_runs], 1)
+    np.add.at(marker, run_end[long_runs] + 1, -1)
+    return np.cumsum(marker[:-1]) > 0
+
+def qa_neighbour(values, depth, max_difference):
+    # values: (depth x time) grid sorted by depth. Flag the sensors deviating by more than max_difference from the
+    # value interpolated between the sensors above and below (nearest sensor at the ends of the chain), when their
+    # deviation is the largest among their neighbours (the neighbours of a bad sensor are not flagged)
+    flag = np.zeros(np.shape(values), dtype=bool)
+    if len(depth) < 2:
+        return flag
+    expected = np.empty(np.shape(values))
+    expected[0], expected[-1] = values[1], values[-2]
+    if len(depth) > 2:
+        dz = depth[2:] - depth[:-2]
+        weight = np.divide(depth[1:-1] - depth[:-2], dz, out=np.full(len(dz), 0.5), where=dz > 0)[:, None]
+        expected[1:-1] = values[:-2] + weight * (values[2:] - values[:-2])
+    deviation = np.abs(values - expected)
+    deviation[np.isnan(deviation)] = 0
+    local_max = deviation >= np.maximum(np.vstack((deviation[1:], deviation[-1:] * 0)), np.vstack((deviation[:1] * 0, deviation[:-1])))
+    return (deviation > max_difference) & local_max
+
+def quality_assurance_tests(values, time, tests):
+    """
+    Apply the tests of a quality assurance configuration to a time series and return the flags (int8, bits of qa_bits).
+
+    tests is a dictionary {test: parameters}, e.g. {"range": {"bounds": [-2, 35]}, "spike": {"window": 5, "threshold": 1}}.
+    The neighbour test applies to the whole chain and is done on the grid (grid_temp).
+    """
+    values = np.asarray(values, dtype=float)
+    flags = np.zeros(len(values), dtype=np.int8)
+    for test, parameters in tests.items():
+        if test == "range":
+            flag = qa_range(values, **parameters)
+        elif test == "spike":
+            flag = qa_spike(values, **parameters)
+        elif test == "gradient":
+            flag = qa_gradient(values, time, **parameters)
+        elif test == "flat_line":
+            flag = qa_flat_line(values, **parameters)
+        elif test == "neighbour":
+            continue
+        else:
+            raise ValueError('Quality assurance test "{}" not recognised.'.format(test))
+        flags[flag] |= qa_bits[test]
+    return flags
+
 def position_in_array(arr, value):
     for i in range(len(arr)):
         if value < arr[i]:
@@ -222,7 +405,7 @@ def create_temp_grid(path,files,tnum_interp):
     for k,file in enumerate(files):
         L2_data=netCDF4.Dataset(os.path.join(path,file), mode='r', format='NETCDF4_CLASSIC')
         data_grid["depth"][k]=float(getattr(L2_data,"Depth (m)"))
-        data_grid["temp"][k,:]=np.interp(tnum_interp,L2_data.variables["time"][:].data,L2_data.variables["Temp"][:].data,left=np.nan,right=np.nan)
+        data_grid["temp"][k,:]=np.interp(tnum_interp,L2_data.variables["time"][:].data,np.ma.filled(L2_data.variables["Temp"][:].astype(float),np.nan),left=np.nan,right=np.nan)
     
     indsort=np.argsort(data_grid["depth"])
     data_grid["temp"]=data_grid["temp"][indsort,:]
@@ -231,6 +414,241 @@ def create_temp_grid(path,files,tnum_interp):
     
     return data_grid
 
+def read_L2_header(file_path, tnum_chunk_start, tnum_chunk_end):
+    # Return the depth of the sensor and, for each time chunk, the indices of the L2 data needed to interpolate it
+    with netCDF4.Dataset(file_path, mode='r') as L2_data:
+        depth = float(getattr(L2_data,"Depth (m)"))
+        time = L2_data.variables["time"][:].data
+    ind_start = np.maximum(np.searchsorted(time, tnum_chunk_start, side="right") - 1, 0)
+    ind_end = np.minimum(np.searchsorted(time, tnum_chunk_end, side="left") + 1, len(time))
+    return depth, ind_start, ind_end
+
+def interp_L2_chunk(file_path, ind_start, ind_end, tnum_chunk):
+    # Interpolate the L2 temperature on the time chunk, only reading the L2 data between ind_start and ind_end
+    with netCDF4.Dataset(file_path, mode='r') as L2_data:
+        time = L2_data.variables["time"][ind_start:ind_end].data
+        temp = np.ma.filled(L2_data.variables["Temp"][ind_start:ind_end].astype(float), np.nan) # Masked values (packed data: _FillValue) are NaN
+    if len(time) == 0:
+        return np.full(len(tnum_chunk), np.nan)
+    return np.interp(tnum_chunk,time,temp,left=np.nan,right=np.nan)
+
+def L3_time_span(folder, title):
+    # Return the existing L3 file in folder (None if there is none) with its time and depth axes
+    files = sorted(glob.glob(os.path.join(folder, "{}_*.nc".format(title))))
+    if len(files) == 0:
+        return None, None, None
+    with netCDF4.Dataset(files[0], mode='r') as nc:
+        time = nc.variables["time"][:].data
+        depth = nc.variables["depth"][:].data
+    return files[0], time, depth
+
+def grid_temp(obj, path, files, tnum_interp, folder, title, chunk_size=100000, n_workers=None, incremental=False):
+    """
+    Interpolate the L2 temperature of all sensors on tnum_interp and write the grid directly to the L3 netCDF file.
+
+    The L2 files are read by a pool of n_workers processes (n_workers=1: serial) and the grid is computed and
+    written by time chunks of chunk_size time steps, so that only a (n_sensors x chunk_size) array is kept in memory.
+    If incremental=True and an L3 file with the same sensors and time steps already exists in folder, only the time
+    steps of tnum_interp after the end of this file are interpolated and appended to it.
+    If obj.neighbour_test is set (thermistor_grid.quality_assurance), the neighbour sensors test is applied to each chunk:
+    the flags are written to temp_qual and the flagged values are removed from temp.
+    obj is a thermistor_grid with the metadata already added. Returns the list of created files, as export().
+    """
+    paths = [os.path.join(path, file) for file in files]
+    executor = ProcessPoolExecutor(max_workers=n_workers) if n_workers != 1 else None
+    mapper = executor.map if executor else map
+    try:
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        L3_file, L3_time, L3_depth = L3_time_span(folder, title)
+        n_keep = 0 # Number of time steps already in the L3 file
+        if incremental and L3_file is not None and len(L3_time) > 0:
+            n_keep = np.searchsorted(tnum_interp, L3_time[-1], side="right")
+            if not np.array_equal(tnum_interp[:n_keep], L3_time):
+                print("Time steps of {} differ from the new grid: full regridding".format(os.path.basename(L3_file)))
+                n_keep = 0
+        tnum_new = tnum_interp[n_keep:]
+        chunk_start = np.arange(0, len(tnum_new), chunk_size)
+        chunk_end = np.minimum(chunk_start + chunk_size, len(tnum_new))
+        headers = list(mapper(read_L2_header, paths, [tnum_new[chunk_start]] * len(paths), [tnum_new[chunk_end - 1]] * len(paths)))
+        depth = np.array([header[0] for header in headers])
+        indsort = np.argsort(depth)
+        if n_keep > 0 and not np.array_equal(depth[indsort], L3_depth):
+            print("Sensor depths of {} differ from the L2 files: full regridding".format(os.path.basename(L3_file)))
+            return grid_temp(obj, path, files, tnum_interp, folder, title, chunk_size, n_workers, incremental=False)
+
+        if n_keep > 0:
+            out_file = L3_file
+            if len(tnum_new) == 0:
+                print("{} is up to date".format(os.path.basename(L3_file)))
+                return [out_file]
+            nc = netCDF4.Dataset(out_file, mode='a', format='NETCDF4')
+            if any(values["var_name"] not in nc.variables for values in obj.variables.values()):
+                nc.close()
+                print("Variables of {} differ from the new grid: full regridding".format(os.path.basename(L3_file)))
+                return grid_temp(obj, path, files, tnum_interp, folder, title, chunk_size, n_workers, incremental=False)
+            print("Append {} time steps to {}".format(len(tnum_new), os.path.basename(L3_file)))
+        else:
+            if L3_file is not None:
+                os.remove(L3_file)
+            time_min = datetime.utcfromtimestamp(np.nanmin(tnum_interp)).replace(tzinfo=timezone.utc)
+            out_file = os.path.join(folder, "{}_{}.nc".format(title, time_min.strftime('%Y%m%d_%H%M%S')))
+            nc = netCDF4.Dataset(out_file, mode='w', format='NETCDF4')
+            for key, values in obj.dimensions.items():
+                nc.createDimension(values['dim_name'], values['dim_size'])
+            for key, values in obj.variables.items():
+                create_variable(nc, values, (len(files), len(tnum_interp)) if len(values["dim"]) == 2 else None)
+            nc.variables["depth"][:] = depth[indsort]
+        with nc:
+            for key in obj.general_attributes:
+                setattr(nc, key, obj.general_attributes[key])
+            nc.variables["time"][n_keep:] = tnum_new
+            for k in range(len(chunk_start)):
+                tnum_chunk = tnum_new[chunk_start[k]:chunk_end[k]]
+                rows = mapper(interp_L2_chunk, [paths[i] for i in indsort], [headers[i][1][k] for i in indsort],
+                              [headers[i][2][k] for i in indsort], [tnum_chunk] * len(paths))
+                temp = np.vstack(list(rows))
+                if obj.neighbour_test is not None: # Test on the whole chain, flagged values are removed from the grid
+                    flags = np.where(qa_neighbour(temp, depth[indsort], **obj.neighbour_test), qa_bits["neighbour"], 0).astype(np.int8)
+                    temp[flags > 0] = np.nan
+                    nc.variables["temp_qual"][:, n_keep + chunk_start[k]:n_keep + chunk_end[k]] = flags
+                nc.variables["temp"][:, n_keep + chunk_start[k]:n_keep + chunk_end[k]] = mask_invalid(nc.variables["temp"], temp)
+    finally:
+        if executor:
+            executor.shutdown()
+    return [out_file]
+
+def read_L3(file_path):
+    # Time, depth and temperature grid (depth x time, flagged values as NaN) of an L3 file
+    with netCDF4.Dataset(file_path, mode='r') as nc:
+        time = np.asarray(nc.variables["time"][:], dtype=float)
+        depth = np.asarray(nc.variables["depth"][:], dtype=float)
+        temp = np.ma.filled(np.ma.asarray(nc.variables["temp"][:], dtype=float), np.nan)
+    return time, depth, temp
+
+def water_density(temp):
+    # Density of freshwater [kg/m3] as a function of temperature [degC] (Chen and Millero, 1986, simplified)
+    return 1000 * (1 - (temp + 288.9414) / (508929.2 * (temp + 68.12963)) * (temp - 3.9863) ** 2)
+
+def fill_depth_gaps(values, depth):
+    """
+    Fill the missing values (NaN) of a depth x time grid by linear interpolation between the nearest valid depths.
+
+    Above the shallowest and below the deepest valid value, the nearest value is used. Columns without valid value
+    stay NaN. depth must be sorted.
+    """
+    n = len(depth)
+    index = np.arange(n)[:, None]
+    valid = ~np.isnan(values)
+    above = np.maximum.accumulate(np.where(valid, index, -1), axis=0) # Nearest valid index above (-1: none)
+    below = np.minimum.accumulate(np.where(valid, index, n)[::-1], axis=0)[::-1] # Nearest valid index below (n: none)
+    i_above = np.clip(above, 0, n - 1)
+    i_below = np.clip(below, 0, n - 1)
+    v_above = np.take_along_axis(values, i_above, axis=0)
+    v_below = np.take_along_axis(values, i_below, axis=0)
+    d_above = depth[i_above]
+    d_below = depth[i_below]
+    interval = d_below - d_above
+    weight = np.where(interval > 0, (depth[:, None] - d_above) / np.where(interval > 0, interval, 1), 0.)
+    filled = v_above + weight * (v_below - v_above)
+    filled = np.where(above < 0, v_below, filled)
+    return np.where(below >= n, v_above, filled)
+
+def hypsometric_layers(hypsometry, dz=0.1):
+    # Layers of thickness dz from the surface to the maximum depth of the hypsometry: depth of the centres and area [m2]
+    depth_hypso = np.asarray(hypsometry["Depth (m)"], dtype=float)
+    area_hypso = np.asarray(hypsometry["Area (m2)"], dtype=float)
+    indsort = np.argsort(depth_hypso)
+    z = np.arange(dz / 2, depth_hypso.max(), dz)
+    return z, np.interp(z, depth_hypso[indsort], area_hypso[indsort])
+
+def depth_interpolation_matrix(depth, z):
+    # Matrix W (len(z) x len(depth)) such that W @ values is the linear interpolation of values (depth x time) at z
+    # (nearest value above the shallowest and below the deepest depth)
+    j = np.clip(np.searchsorted(depth, z) - 1, 0, max(len(depth) - 2, 0))
+    W = np.zeros((len(z), len(depth)))
+    if len(depth) == 1:
+        W[:, 0] = 1
+        return W
+    weight = np.clip((z - depth[j]) / (depth[j + 1] - depth[j]), 0, 1)
+    W[np.arange(len(z)), j] = 1 - weight
+    W[np.arange(len(z)), j + 1] = weight
+    return W
+
+def schmidt_stability(rho, z, area, dz, g=9.81):
+    # Schmidt stability [J/m2] of density profiles rho (layers x time) on layers z of area [m2] and thickness dz (Idso, 1973)
+    volume = area * dz
+    z_volume = np.sum(z * volume) / np.sum(volume) # Depth of the centre of volume
+    return g / area[0] * np.sum(((z - z_volume) * volume)[:, None] * rho, axis=0)
+
+def heat_content(temp, rho, area, dz, cp=4186.):
+    # Heat content [J] of temperature profiles temp (layers x time, relative to 0 degC) on layers of area [m2] and thickness dz
+    return cp * np.sum((area * dz)[:, None] * rho * temp, axis=0)
+
+def buoyancy_frequency(rho, depth, g=9.81):
+    # Squared buoyancy frequency N2 [s-2] between consecutive depths of density profiles rho (depth x time), and the depths of the midpoints
+    drho_dz = np.diff(rho, axis=0) / np.diff(depth)[:, None]
+    return g / (rho[:-1] + rho[1:]) * 2 * drho_dz, (depth[:-1] + depth[1:]) / 2
+
+def thermocline_depth(rho, depth, min_gradient=0.1):
+    # Depth of the maximum density gradient [m] of density profiles rho (depth x time), NaN if the gradient is below min_gradient [kg/m3/m]
+    drho_dz = np.diff(rho, axis=0) / np.diff(depth)[:, None]
+    drho_dz = np.where(np.isnan(drho_dz), -np.inf, drho_dz)
+    k = np.argmax(drho_dz, axis=0)
+    gradient = np.take_along_axis(drho_dz, k[None, :], axis=0)[0]
+    return np.where(gradient >= min_gradient, (depth[k] + depth[k + 1]) / 2, np.nan)
+
+def mixed_layer_depth(temp, depth, threshold=0.5):
+    """
+    Mixed layer depth [m]: depth where the temperature first differs from the temperature of the shallowest sensor
+    by more than threshold [degC], interpolated between the sensors. temp (depth x time) must not contain missing values
+    (fill_depth_gaps) except in empty columns (NaN). If the whole water column is mixed, the deepest depth is returned.
+    """
+    difference = np.abs(temp - temp[0])
+    exceed = difference > threshold
+    k = np.argmax(exceed, axis=0)
+    mixed = ~exceed.any(axis=0)
+    k_above = np.maximum(k - 1, 0)
+    d_above = np.take_along_axis(difference, k_above[None, :], axis=0)[0]
+    d_below = np.take_along_axis(difference, k[None, :], axis=0)[0]
+    weight = np.clip((threshold - d_above) / np.where(d_below > d_above, d_below - d_above, 1), 0, 1)
+    mld = depth[k_above] + weight * (depth[k] - depth[k_above])
+    mld = np.where(mixed, depth[-1], mld)
+    return np.where(np.isnan(temp[0]), np.nan, mld)
+
+def stratification_metrics(temp, depth, hypsometry=None, dz=0.1, mixed_layer_threshold=0.5, min_gradient=0.1, chunk_size=10000):
+    """
+    Stratification metrics of a temperature grid temp (depth x time, NaN for missing values) at the sorted depths depth.
+
+    Returns a dictionary with N2 (depth - 1 x time) and depth_N2, thermocline_depth and mixed_layer_depth and, if the
+    hypsometry ({"Depth (m)": [...], "Area (m2)": [...]}) is given, schmidt_stability and heat_content (time).
+    The missing values are filled along depth (fill_depth_gaps) for the mixed layer depth and the integrals, which are
+    computed on layers of thickness dz from the surface to the maximum depth of the hypsometry. The time steps are
+    processed by chunks of chunk_size, the computation is vectorized within each chunk.
+    """
+    n_time = temp.shape[1]
+    metrics = {"thermocline_depth": np.full(n_time, np.nan), "mixed_layer_depth": np.full(n_time, np.nan),
+               "N2": np.full((len(depth) - 1, n_time), np.nan), "depth_N2": (depth[:-1] + depth[1:]) / 2}
+    if hypsometry is not None:
+        z, area = hypsometric_layers(hypsometry, dz)
+        W = depth_interpolation_matrix(depth, z)
+        metrics["schmidt_stability"] = np.full(n_time, np.nan)
+        metrics["heat_content"] = np.full(n_time, np.nan)
+    for start in range(0, n_time, chunk_size):
+        chunk = slice(start, min(start + chunk_size, n_time))
+        rho = water_density(temp[:, chunk])
+        metrics["N2"][:, chunk] = buoyancy_frequency(rho, depth)[0]
+        metrics["thermocline_depth"][chunk] = thermocline_depth(rho, depth, min_gradient)
+        temp_filled = fill_depth_gaps(temp[:, chunk], depth)
+        metrics["mixed_layer_depth"][chunk] = mixed_layer_depth(temp_filled, depth, mixed_layer_threshold)
+        if hypsometry is not None:
+            temp_layers = W @ np.nan_to_num(temp_filled) # Empty columns set to NaN below
+            rho_layers = water_density(temp_layers)
+            empty = np.isnan(temp_filled[0])
+            metrics["schmidt_stability"][chunk] = np.where(empty, np.nan, schmidt_stability(rho_layers, z, area, dz))
+            metrics["heat_content"][chunk] = np.where(empty, np.nan, heat_content(temp_layers, rho_layers, area, dz))
+    return metrics
+
 def create_folder(input_folder,output_folder):
     if os.path.exists(os.path.join(input_folder, output_folder)):
         print("Folder {} already exists: delete it".format(output_folder))
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 """
-Read the thermistors data and export it to netCDF files.
+Read the thermistors data, export it to netCDF files and compute the stratification indices.
 
 @author: T. Doda
 """
@@ -9,9 +9,13 @@ import sys
 import json
 import numpy as np
 #sys.path.append(os.path.join(os.path.dirname(__file__), r'..\..\functions\1-Mooring'))
-from thermistor import thermistor_series,thermistor_grid
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from thermistor import thermistor_series,thermistor_grid,thermistor_stratification
 from datetime import datetime, timezone
-from functions_mooring import read_data, export, create_temp_grid, create_folder
+from functions_mooring import read_data, export, grid_temp, create_folder, read_L3, remove_stale_outputs
+from pipeline import pipeline, code_version
+from instrumentation import start_report, stage, write_report
+from metadata_catalog import metadata_catalog
 
 #%% Specify field campaign here:
 
@@ -19,62 +23,151 @@ from functions_mooring import read_data, export, create_temp_grid, create_folder
 # date_campaign='20240910'
 #date_campaign='20241126'
 date_campaign='20250604'
-#%% Setup paths
-
-mooring_data_folder='..\..\data\Mooring\HOBO_T'
-input_folder=os.path.join(mooring_data_folder,date_campaign)
-meta_path=os.path.join(input_folder,"Level0","thermistors_"+date_campaign+".meta")
 
-create_folder(input_folder, "Level1")
-create_folder(input_folder, "Level2")
-create_folder(input_folder, "Level3")
+n_workers=None # Number of processes used to read the Level0 files (None = number of cores, 1 = serial)
+use_cache=True # Store the parsed Excel files to speed up the next runs
+excel_engine="stream" # "stream": read the Excel files row by row (low memory), "pandas": pd.read_excel
+incremental_L3=True # Keep the existing L3 file and only grid the time steps after its end
+force_rebuild=False # Delete the Level1-3 folders and reprocess everything, instead of only the outputs that are out of date
+report_memory=True # Measure the peak memory of each stage in the run report (tracemalloc, slower)
 
-#%% Load metadata of the mooring
-if os.path.exists(meta_path):
-    with open(meta_path) as f:
-        meta = json.load(f)
-else:
-    raise Exception("Metadata file not found!")
+#%% Setup paths
 
-#%% Read the data files
-files = np.array(meta["filenames"])[meta["valid"]]
-file_types=np.array(meta["filetypes"])[meta["valid"]]
+mooring_data_folder=os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','..','data','Mooring','HOBO_T')
+input_folder=os.path.join(mooring_data_folder,date_campaign)
+qa_path=os.path.join(os.path.dirname(os.path.abspath(__file__)),'quality_assurance_mooring.json')
+code_files=[os.path.join(os.path.dirname(os.path.abspath(__file__)),f) for f in ["functions_mooring.py","thermistor.py"]] + [os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','netcdf_storage.py')]
 
+#%% Functions to process the Level0 files
 
-for k,file in enumerate(files):
-    metadata = True
+def process_file(input_folder, file, file_type, meta, cache_folder=None, engine="pandas", qa_path=qa_path, file_meta=None):
+    """Process one logger file from Level0 to Level2 and return a summary of the processing (file_meta: parsed .meta file of the logger, if any)."""
+    result = {"file": file, "success": False, "error": "", "outputs": []}
     try:
-        data_temp = read_data(os.path.join(input_folder,"Level0",file),file_types[k])
+        path = os.path.join(input_folder,"Level0",file)
+        with stage("read_data", file=file, inputs=[path]) as record:
+            data_temp = read_data(path,file_type,cache_folder,engine)
+            record["rows"] = len(data_temp["data"])
+        temp_series = thermistor_series()
+        if temp_series.read_timeseries(data_temp,meta,file_meta):
+            with stage("quality_assurance", file=file, rows=record["rows"]):
+                temp_series.quality_assurance(qa_path)
+            file_name = file.rsplit('.', 1)[0]
+            print("Export {} to L1 and L2 netCDF files".format(file))
+            for level in ["L1", "L2"]: # The files of a previous run are updated in place, unless the record was cut or starts at another time
+                remove_stale_outputs(os.path.join(input_folder, "Level" + level[1]), "{}_mooring_{}_{}".format(level, file_type, file_name), temp_series.data["time"])
+            with stage("export", file=file, rows=record["rows"]) as record:
+                record["outputs"] = export(temp_series,os.path.join(input_folder, "Level1"), "L1_mooring_{}_{}".format(file_type, file_name),overwrite=True,
+                                           folder_masked=os.path.join(input_folder, "Level2"), title_masked="L2_mooring_{}_{}".format(file_type, file_name)) # Level 2: flagged data masked
+            result["outputs"] += record["outputs"]
+            result["success"] = True
+        else: # Not recorded as built: the file is processed again at the next run (e.g., once its metadata is corrected)
+            result["error"] = "{} marked invalid in its metadata, not processed".format(file)
     except Exception as e:
         print(e)
         print("Failed to process {}".format(file))
-        continue
-    temp_series = thermistor_series()
-    if temp_series.read_timeseries(data_temp,meta):
-        temp_series.quality_assurance()
-        file_name = file.rsplit('.', 1)[0]
-        print("Export to L1 netCDF files")
-        export(temp_series,os.path.join(input_folder, "Level1"), "L1_mooring_{}_{}".format(file_types[k], file_name),overwrite=True)
-        temp_series.mask_data() # Replace flagged data by nan 
-        print("Export to L2 netCDF files")
-        export(temp_series,os.path.join(input_folder, "Level2"), "L2_mooring_{}_{}".format(file_types[k], file_name), overwrite=True) # Create Level 2 file      
- 
-#%% Load L2 files and interpolate to grid
-temp_grid = thermistor_grid()
-files_L2=[]
-for f in os.listdir(os.path.join(input_folder, "Level2")):
-    if f.endswith(".nc"):
-        files_L2.append(f)
-# tnum_files=[None]*len(files_L2)
-# for k,f in enumerate(files_L2):
-#     ind_dash=[i for i, c in enumerate(f) if c == "_"]
-#     tnum_files[k]=datetime.strptime(f[ind_dash[-2]+1:f.find(".nc")],"%Y%m%d_%H%M%S").replace(tzinfo=timezone.utc).timestamp()
-tnum_start=datetime.strptime(meta["campaign"]["Time of deployment"],"%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
-tnum_end=datetime.strptime(meta["campaign"]["Time of retrieval"],"%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
-tnum_interp=np.arange(tnum_start,tnum_end,temp_grid.dt_sec)
-data_grid=create_temp_grid(os.path.join(input_folder, "Level2"),files_L2,tnum_interp)
-temp_grid.add_grid(data_grid,meta)
-print("Export to L3 netCDF file")
-export(temp_grid,os.path.join(input_folder, "Level3"), "L3_mooring", overwrite=True) # Create Level 3 file      
-
-    
\ No newline at end of file
+        result["error"] = repr(e)
+    return result
+
+def file_metadata(meta, file):
+    """Part of the mooring metadata used to process one logger file."""
+    ind = meta["filenames"].index(file)
+    return {"filename": file, "filetype": meta["filetypes"][ind], "valid": meta["valid"][ind],
+            "Depth (m)": meta["Depth (m)"][ind], "campaign": meta["campaign"]}
+
+def grid_L2(input_folder, meta, n_workers=None, incremental=False, qa_path=qa_path):
+    """Interpolate the L2 files of the campaign to the L3 grid."""
+    temp_grid = thermistor_grid()
+    files_L2=[]
+    for f in os.listdir(os.path.join(input_folder, "Level2")):
+        if f.endswith(".nc"):
+            files_L2.append(f)
+    # tnum_files=[None]*len(files_L2)
+    # for k,f in enumerate(files_L2):
+    #     ind_dash=[i for i, c in enumerate(f) if c == "_"]
+    #     tnum_files[k]=datetime.strptime(f[ind_dash[-2]+1:f.find(".nc")],"%Y%m%d_%H%M%S").replace(tzinfo=timezone.utc).timestamp()
+    tnum_start=datetime.strptime(meta["campaign"]["Time of deployment"],"%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+    tnum_end=datetime.strptime(meta["campaign"]["Time of retrieval"],"%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+    tnum_interp=np.arange(tnum_start,tnum_end,temp_grid.dt_sec)
+    temp_grid.add_metadata(meta)
+    temp_grid.quality_assurance(qa_path)
+    print("Interpolate to grid and export to L3 netCDF file")
+    with stage("grid_temp", file="Level3", rows=len(files_L2)*len(tnum_interp), inputs=[os.path.join(input_folder, "Level2", f) for f in files_L2]) as record:
+        record["outputs"] = grid_temp(temp_grid,os.path.join(input_folder, "Level2"),files_L2,tnum_interp,os.path.join(input_folder, "Level3"), "L3_mooring",n_workers=n_workers,incremental=incremental) # Create Level 3 file
+    return record["outputs"]
+
+def stratification_L4(input_folder, meta):
+    """Compute the stratification indices of the L3 grid and export them to the L4 netCDF file."""
+    files_L3 = sorted(f for f in os.listdir(os.path.join(input_folder, "Level3")) if f.startswith("L3_mooring") and f.endswith(".nc"))
+    if len(files_L3) == 0:
+        raise Exception("No L3 file found!")
+    strat = thermistor_stratification()
+    strat.add_metadata(meta)
+    with stage("read_L3", file=files_L3[0], inputs=[os.path.join(input_folder, "Level3", files_L3[0])]) as record:
+        time, depth, temp = read_L3(os.path.join(input_folder, "Level3", files_L3[0]))
+        record["rows"] = temp.size
+    with stage("stratification", file=files_L3[0], rows=temp.size):
+        strat.compute(time, depth, temp)
+    print("Export stratification indices to L4 netCDF file")
+    with stage("export", file=files_L3[0], rows=temp.size) as record:
+        record["outputs"] = export(strat, os.path.join(input_folder, "Level4"), "L4_mooring", overwrite=True)
+    return record["outputs"]
+
+
+def process_campaign(input_folder, date_campaign, n_workers=None, force_rebuild=False, use_cache=True, excel_engine="stream", incremental_L3=True, report_memory=True):
+    """
+    Process a mooring campaign from Level0 to Level4 (only the outputs that are out of date) and return the status of each step.
+
+    The time, rows, bytes and peak memory of each stage are written to a run report in the Reports folder of the campaign.
+    """
+    meta_path=os.path.join(input_folder,"Level0","thermistors_"+date_campaign+".meta")
+    cache_folder=os.path.join(input_folder,".cache") if use_cache else None # Not deleted by create_folder
+    manifest_path=os.path.join(input_folder,".pipeline.json") # Hashes and outputs of the last run
+    report_folder=os.path.join(input_folder,"Reports")
+    if force_rebuild:
+        create_folder(input_folder, "Level1")
+        create_folder(input_folder, "Level2")
+        create_folder(input_folder, "Level3")
+        create_folder(input_folder, "Level4")
+
+    # Load metadata of the mooring
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+    else:
+        raise Exception("Metadata file not found!")
+
+    # Processing steps: one node per data file (L0 to L2), the L3 grid and the L4 stratification indices
+    files = np.array(meta["filenames"])[meta["valid"]]
+    file_types=np.array(meta["filetypes"])[meta["valid"]]
+
+    # .meta files of the loggers, parsed once (only the new or modified ones if the cache is used)
+    catalog = metadata_catalog(os.path.join(input_folder, "Level0"), os.path.join(cache_folder, "metadata_catalog.json") if cache_folder else None)
+
+    steps = pipeline(manifest_path, code_version(code_files), n_workers)
+    for k, file in enumerate(files):
+        file_meta = file.rsplit('.', 1)[0] + ".meta"
+        steps.add_node("L2 " + file, process_file, (input_folder, file, file_types[k], meta, cache_folder, excel_engine, qa_path, catalog.get(file_meta)),
+                       inputs=[os.path.join(input_folder, "Level0", file), os.path.join(input_folder, "Level0", file_meta), qa_path], params=file_metadata(meta, file),
+                       keep_outputs=True) # The new samples of a serviced logger are merged in the existing L1/L2 files (append_sorted)
+    steps.add_node("L3", grid_L2, (input_folder, meta, n_workers, incremental_L3, qa_path), inputs=[qa_path],
+                   params={"campaign": meta["campaign"], "dt_sec": thermistor_grid().dt_sec},
+                   depends=["L2 " + file for file in files], keep_outputs=incremental_L3)
+    strat = thermistor_stratification()
+    steps.add_node("L4", stratification_L4, (input_folder, meta),
+                   params={"hypsometry": meta.get("hypsometry"), "dz": strat.dz, "mixed_layer_threshold": strat.mixed_layer_threshold,
+                           "min_gradient": strat.min_gradient}, depends=["L3"])
+
+    # Run the steps that are out of date
+    start_report(report_folder, report_memory)
+    status = steps.run(force=force_rebuild)
+    write_report(report_folder, "run_report_mooring")
+    failed = [name for name in status if status[name] == "failed"]
+    print("{} steps built, {} up to date, {} failed".format(list(status.values()).count("built"), list(status.values()).count("skipped"), len(failed)))
+    for name in failed:
+        print("Failed to build {}".format(name))
+    return status
+
+
+if __name__ == "__main__":
+    process_campaign(input_folder, date_campaign, n_workers, force_rebuild, use_cache, excel_engine, incremental_L3, report_memory)
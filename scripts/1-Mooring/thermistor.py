@@ -26,8 +26,8 @@ class thermistor_series:
         }
 
         self.variables = {
-            'time': {'var_name': 'time', 'dim': ('time',), 'unit': 'seconds since 1970-01-01 00:00:00', 'long_name': 'time'},
-            'Temp': {'var_name': 'Temp', 'dim': ('time',), 'unit': 'degC', 'long_name': 'temperature'},
+            'time': {'var_name': 'time', 'dim': ('time',), 'unit': 'seconds since 1970-01-01 00:00:00', 'long_name': 'time', 'storage': 'time'},
+            'Temp': {'var_name': 'Temp', 'dim': ('time',), 'unit': 'degC', 'long_name': 'temperature', 'storage': 'temperature_packed'},
         }
 
 
@@ -39,7 +39,7 @@ class thermistor_series:
         self.data = {}
         self.filename = False
 
-    def read_timeseries(self, data_temp,meta_mooring):
+    def read_timeseries(self, data_temp,meta_mooring,meta=None):
         self.filename = data_temp["file"]
         file_noext = self.filename.rsplit('.', 1)[0]
         df = data_temp["data"]
@@ -51,7 +51,9 @@ class thermistor_series:
 
         meta_path = os.path.join(data_temp["folder"], file_noext + ".meta")
          
-        if os.path.exists(meta_path):
+        if meta is not None: # Already parsed metadata of the logger (campaign catalog)
+            pass
+        elif os.path.exists(meta_path):
             with open(meta_path) as f:
                 meta = json.load(f)
         else:
@@ -89,19 +91,26 @@ class thermistor_series:
             
         return True
     
-    def quality_assurance(self):  
+    def quality_assurance(self, file_path=None):
+        # Flag the data outside the deployment period and, if a configuration file is given, apply its tests (see functions_mooring.qa_bits)
+        quality_assurance_dict = {}
+        if file_path is not None:
+            with open(file_path) as f:
+                quality_assurance_dict = json.load(f)
         for key, values in self.variables.copy().items():
             if "_qual" not in key: 
                 if key != "time": # Only add quality assurance on non temporal data (i.e., remove data before deployment and after retrieval)
                     name = key + "_qual"
                     self.variables[name] = {'var_name': name, 'dim': values["dim"],
-                                            'unit': '0 = nothing to report, 1 = more investigation',
-                                            'long_name': name, }
-                    self.data[name]=np.zeros(self.data[key].shape)
+                                            'unit': func.qa_flag_description,
+                                            'long_name': name, 'storage': 'flag'}
+                    self.data[name]=np.zeros(self.data[key].shape, dtype=np.int8)
                     if self.start_time:
-                        self.data[name][self.data["time"]<self.start_time.replace(tzinfo=timezone.utc).timestamp()] = 1
+                        self.data[name][self.data["time"]<self.start_time.replace(tzinfo=timezone.utc).timestamp()] |= func.qa_bits["deployment"]
                     if self.end_time:
-                        self.data[name][self.data["time"]>self.end_time.replace(tzinfo=timezone.utc).timestamp()] = 1
+                        self.data[name][self.data["time"]>self.end_time.replace(tzinfo=timezone.utc).timestamp()] |= func.qa_bits["deployment"]
+                    if key in quality_assurance_dict:
+                        self.data[name] |= func.quality_assurance_tests(self.data[key], self.data["time"], quality_assurance_dict[key])
 
 
     def mask_data(self):
@@ -130,13 +139,14 @@ class thermistor_grid:
         }
 
         self.variables = {
-            'time': {'var_name': 'time', 'dim': ('time',), 'unit': 'seconds since 1970-01-01 00:00:00', 'long_name': 'Time'},
+            'time': {'var_name': 'time', 'dim': ('time',), 'unit': 'seconds since 1970-01-01 00:00:00', 'long_name': 'Time', 'storage': 'time'},
             'depth': {'var_name': 'depth', 'dim': ('depth',), 'unit': 'm', 'long_name': "Depth"},
-            'temp': {'var_name': 'temp', 'dim': ('depth', 'time'), 'unit': 'degC', 'long_name': 'Temperature'}
+            'temp': {'var_name': 'temp', 'dim': ('depth', 'time'), 'unit': 'degC', 'long_name': 'Temperature', 'storage': 'grid_time_slab'}
         }
 
         self.data = {}
         self.dt_sec=10*60 # [s]
+        self.neighbour_test = None
         
     def add_grid(self, data_grid,meta):
         for variable in self.variables:
@@ -145,11 +155,22 @@ class thermistor_grid:
             else:
                 dim_names=self.variables[variable]["dim"]
                 self.data[variable] = np.full(tuple([len(self.data[d]) for d in dim_names]),np.nan)
-  
+        self.add_metadata(meta)
+
+    def quality_assurance(self, file_path):
+        # Neighbour sensors test applied by grid_temp on the grid, results in temp_qual
+        with open(file_path) as f:
+            quality_assurance_dict = json.load(f)
+        if "neighbour" in quality_assurance_dict.get("temp", {}):
+            self.neighbour_test = quality_assurance_dict["temp"]["neighbour"]
+            self.variables["temp_qual"] = {'var_name': 'temp_qual', 'dim': ('depth', 'time'), 'unit': func.qa_flag_description,
+                                           'long_name': 'temp_qual', 'storage': 'grid_flag'}
+
+    def add_metadata(self, meta):
         if "valid" in meta:
             ind_sensors=np.where(meta["valid"])[0]
         else:
-            ind_sensors=np.arange(len(data_grid["depth"]))
+            ind_sensors=np.arange(len(meta["Depth (m)"]))
 
         for key in meta["campaign"]:
             if isinstance(meta["campaign"][key], bool):
@@ -168,3 +189,64 @@ class thermistor_grid:
         
         elif "Latitude" in self.general_attributes and self.general_attributes["Latitude"] != "":
             self.latitude = self.general_attributes["Latitude"]
+
+
+class thermistor_stratification:
+    def __init__(self):
+        self.general_attributes = {
+            "institution": "Unil",
+            "source": "",
+            "references": "Aquatic Science Master field camp",
+            "history": "See history on Renku",
+            "conventions": "CF 1.7",
+            "comment": "Stratification indices computed from the Level 3 temperature grid of the mooring in Lake Taney",
+            "title": "Stratification Lake Taney"
+        }
+
+        self.dimensions = {
+            'time': {'dim_name': 'time', 'dim_size': None},
+            "depth_N2": {'dim_name': "depth_N2", 'dim_size': None}
+        }
+
+        self.variables = {
+            'time': {'var_name': 'time', 'dim': ('time',), 'unit': 'seconds since 1970-01-01 00:00:00', 'long_name': 'Time', 'storage': 'time'},
+            'depth_N2': {'var_name': 'depth_N2', 'dim': ('depth_N2',), 'unit': 'm', 'long_name': "Depth between two sensors"},
+            'thermocline_depth': {'var_name': 'thermocline_depth', 'dim': ('time',), 'unit': 'm', 'long_name': 'Depth of the maximum density gradient', 'storage': 'index'},
+            'mixed_layer_depth': {'var_name': 'mixed_layer_depth', 'dim': ('time',), 'unit': 'm', 'long_name': 'Mixed layer depth', 'storage': 'index'},
+            'N2': {'var_name': 'N2', 'dim': ('depth_N2', 'time'), 'unit': 's-2', 'long_name': 'Squared buoyancy frequency', 'storage': 'grid_time_slab'},
+        }
+
+        self.hypsometry_variables = {
+            'schmidt_stability': {'var_name': 'schmidt_stability', 'dim': ('time',), 'unit': 'J/m2', 'long_name': 'Schmidt stability', 'storage': 'index'},
+            'heat_content': {'var_name': 'heat_content', 'dim': ('time',), 'unit': 'J', 'long_name': 'Heat content relative to 0 degC', 'storage': 'index'},
+        }
+
+        self.data = {}
+        self.hypsometry = None
+        self.dz = 0.1 # Thickness of the layers used to integrate over the hypsometry [m]
+        self.mixed_layer_threshold = 0.5 # Temperature difference to the surface defining the mixed layer [degC]
+        self.min_gradient = 0.1 # Minimum density gradient of the thermocline [kg/m3/m]
+
+    def add_metadata(self, meta):
+        for key in meta["campaign"]:
+            if isinstance(meta["campaign"][key], bool):
+                self.general_attributes[key] = str(meta["campaign"][key])
+            else:
+                self.general_attributes[key] = meta["campaign"][key]
+        if "hypsometry" in meta:
+            self.hypsometry = meta["hypsometry"]
+            self.general_attributes["Hypsometry depth (m)"] = np.array(meta["hypsometry"]["Depth (m)"], dtype=float)
+            self.general_attributes["Hypsometry area (m2)"] = np.array(meta["hypsometry"]["Area (m2)"], dtype=float)
+        else:
+            print("No hypsometry in the metadata: Schmidt stability and heat content are not computed")
+
+    def compute(self, time, depth, temp):
+        # temp: Level 3 temperature grid (depth x time) with NaN for the missing values
+        indsort = np.argsort(depth)
+        metrics = func.stratification_metrics(temp[indsort, :], depth[indsort], self.hypsometry, self.dz, self.mixed_layer_threshold, self.min_gradient)
+        if self.hypsometry is not None:
+            self.variables.update(self.hypsometry_variables)
+        self.data["time"] = time
+        for variable in self.variables:
+            if variable != "time":
+                self.data[variable] = metrics[variable]
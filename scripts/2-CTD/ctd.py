@@ -1,11 +1,12 @@
 # -*- coding: utf-8 -*-
 import os
+import glob
 import json
 import sys
+import logging
 import netCDF4
 import numpy as np
 import seawater as sw
-from copy import deepcopy
 from envass import qualityassurance
 from datetime import datetime, timedelta, timezone
 from dateutil.relativedelta import relativedelta
@@ -29,24 +30,39 @@ class CTD:
         }
 
         self.variables = {
-            'time': {'var_name': 'time', 'dim': ('time',), 'unit': 'seconds since 1970-01-01 00:00:00', 'long_name': 'time'},
-            'Press': {'var_name': 'Press', 'dim': ('time',), 'unit': 'dbar', 'long_name': 'pressure'},
-            'Temp': {'var_name': 'Temp', 'dim': ('time',), 'unit': 'degC', 'long_name': 'temperature'},
-            'Cond': {'var_name': 'Cond', 'dim': ('time',), 'unit': 'mS/cm', 'long_name': 'conductivity'},
-            'Chl_A': {'var_name': 'Chl_A', 'dim': ('time',), 'unit': 'µg/l', 'long_name': 'chlorophyll A'},
-            'Turb': {'var_name': 'Turb', 'dim': ('time',), 'unit': 'FTU', 'long_name': 'Turbidity'},
-            'pH': {'var_name': 'pH', 'dim': ('time',), 'unit': '_', 'long_name': 'pH'},
-            'sat': {'var_name': 'sat', 'dim': ('time',), 'unit': '%', 'long_name': 'oxygen saturation'},
-            'DO_mg': {'var_name': 'DO_mg', 'dim': ('time',), 'unit': 'mg/l', 'long_name': 'oxygen concentration'},
-            'Flur': {'var_name': 'Flur', 'dim': ('time',), 'unit': 'mg/m3', 'long_name': 'Fluorescence'},
+            'time': {'var_name': 'time', 'dim': ('time',), 'unit': 'seconds since 1970-01-01 00:00:00', 'long_name': 'time', 'storage': 'time'},
+            'Press': {'var_name': 'Press', 'dim': ('time',), 'unit': 'dbar', 'long_name': 'pressure', 'storage': 'data'},
+            'Temp': {'var_name': 'Temp', 'dim': ('time',), 'unit': 'degC', 'long_name': 'temperature', 'storage': 'data'},
+            'Cond': {'var_name': 'Cond', 'dim': ('time',), 'unit': 'mS/cm', 'long_name': 'conductivity', 'storage': 'data'},
+            'Chl_A': {'var_name': 'Chl_A', 'dim': ('time',), 'unit': 'µg/l', 'long_name': 'chlorophyll A', 'storage': 'data'},
+            'Turb': {'var_name': 'Turb', 'dim': ('time',), 'unit': 'FTU', 'long_name': 'Turbidity', 'storage': 'data'},
+            'pH': {'var_name': 'pH', 'dim': ('time',), 'unit': '_', 'long_name': 'pH', 'storage': 'data'},
+            'sat': {'var_name': 'sat', 'dim': ('time',), 'unit': '%', 'long_name': 'oxygen saturation', 'storage': 'data'},
+            'DO_mg': {'var_name': 'DO_mg', 'dim': ('time',), 'unit': 'mg/l', 'long_name': 'oxygen concentration', 'storage': 'data'},
+            'Flur': {'var_name': 'Flur', 'dim': ('time',), 'unit': 'mg/m3', 'long_name': 'Fluorescence', 'storage': 'data'},
         }
 
         self.derived_variables = {
-            "rho": {'var_name': "rho", 'dim': ('time',), 'unit': 'kg/m3', 'long_name': "Density", },
-            "depth": {'var_name': "depth", 'dim': ('time',), 'unit': 'm', 'long_name': "Depth", },
-            "SALIN": {'var_name': 'SALIN', 'dim': ('time',), 'unit': ['PSU', 'ppt'], 'long_name': 'salinity', }
+            "rho": {'var_name': "rho", 'dim': ('time',), 'unit': 'kg/m3', 'long_name': "Density", 'storage': 'precise'},
+            "depth": {'var_name': "depth", 'dim': ('time',), 'unit': 'm', 'long_name': "Depth", 'storage': 'data'},
+            "SALIN": {'var_name': 'SALIN', 'dim': ('time',), 'unit': ['PSU', 'ppt'], 'long_name': 'salinity', 'storage': 'data'}
         }
 
+        self.thorpe_variables = { # Optional Level 2 variables, see thorpe_analysis
+            "thorpe": {'var_name': 'thorpe', 'dim': ('time',), 'unit': 'm', 'long_name': 'Thorpe displacement', 'storage': 'data'},
+            "thorpe_scale": {'var_name': 'thorpe_scale', 'dim': ('time',), 'unit': 'm', 'long_name': 'Thorpe scale of the overturn', 'storage': 'data'},
+            "overturn_extent": {'var_name': 'overturn_extent', 'dim': ('time',), 'unit': 'm', 'long_name': 'Vertical extent of the overturn', 'storage': 'data'},
+            "overturn_ends": {'var_name': 'overturn_ends', 'dim': ('time',), 'unit': '1 = overturn including the first or last sample of the profile',
+                              'long_name': 'overturn_ends', 'storage': 'flag'}
+        }
+
+        self.grid_dimensions = {
+            'depth': {'dim_name': 'depth', 'dim_size': None}, # Number of depth bins, set by grid_profiles
+            'time': {'dim_name': 'time', 'dim_size': None}
+        }
+        self.grid_variables = {}
+        self.grid = {}
+
         self.start_profile_index = False
         self.bottom_profile_index = False
         self.end_profile_index = False
@@ -56,9 +72,13 @@ class CTD:
         self.latitude = False
         self.altitude = False
         self.data = {}
+        self.level1 = None # Level 1 variables and data, stored by derive_variables
+        self.derived_data = {} # Quantities computed by derive_variables (see derived)
+        self.derived_parameters = None
         self.filename = False
+        self.logger = logging.getLogger(__name__)
 
-    def read_profile(self, profile,profilemeta=None):
+    def read_profile(self, profile,profilemeta=None,meta=None):
         if not profilemeta:
             profilemeta=profile["name"] + ".meta"
         meta_path = os.path.join(profile["folder"],profilemeta)
@@ -74,9 +94,10 @@ class CTD:
         if "air_pressure" in profile:
             self.air_pressure = profile["air_pressure"]
   
-        if os.path.exists(meta_path):
+        if meta is None and os.path.exists(meta_path): # meta: already parsed metadata (campaign catalog)
             with open(meta_path) as f:
                 meta = json.load(f)
+        if meta is not None:
             if "valid" in meta and not meta["valid"]:
                 self.logger.warning("Profile {} marked invalid, not processing.".format(profile["name"]))
                 return False
@@ -111,29 +132,35 @@ class CTD:
             return False
 
     def quality_assurance(self, file_path, simple=True):
-        with open(file_path) as f:
-            quality_assurance_dict = func.json_converter(json.load(f))
-        for key, values in self.variables.copy().items():
-            if "_qual" not in key:
-                if (quality_assurance_dict[key]["advanced"]) or (quality_assurance_dict[key]["simple"]):
-                    name = key + "_qual"
-                    self.variables[name] = {'var_name': name, 'dim': values["dim"],
-                                            'unit': '0 = nothing to report, 1 = more investigation',
-                                            'long_name': name, }
-                    if simple:
-                        self.data[name] = qualityassurance(np.array(self.data[key]), np.array(self.data["time"]), **quality_assurance_dict[key]["simple"])
-                    else:
-                        quality_assurance_all = dict(quality_assurance_dict[key]["simple"], **quality_assurance_dict[key]["advanced"])
-                        self.data[name] = qualityassurance(np.array(self.data[key]), np.array(self.data["time"]), **quality_assurance_all)
-                    if key != "time":
-                        if self.bottom_profile_index:
-                            self.data[name][self.bottom_profile_index:] = 1
-                        if self.start_profile_index:
-                            self.data[name][:self.start_profile_index] = 1
-                        if self.start_pressure:
-                            self.data[name][self.data["Press"] > self.start_pressure] = 1
-                        if self.end_pressure:
-                            self.data[name][self.data["Press"] < self.end_pressure] = 1
+        qa = func.compile_quality_assurance(file_path, simple)
+        keys = [key for key in self.variables if "_qual" not in key and key in qa["tests"]]
+        index = [qa["keys"].index(key) for key in keys]
+        values = np.array([self.data[key] for key in keys], dtype=float)
+        flags = func.quality_assurance_flags(values, qa["numeric"][index], qa["lower"][index], qa["upper"][index])
+        outside = self.outside_profile()
+        for k, key in enumerate(keys):
+            if qa["tests"][key]: # Other tests of envass
+                flags[k] |= (qualityassurance(values[k], np.array(self.data["time"]), **dict(qa["tests"][key])) > 0).astype(np.int8)
+            if key != "time":
+                flags[k][outside] = 1
+            name = key + "_qual"
+            self.variables[name] = {'var_name': name, 'dim': self.variables[key]["dim"],
+                                    'unit': '0 = nothing to report, 1 = more investigation',
+                                    'long_name': name, 'storage': 'flag'}
+            self.data[name] = flags[k]
+
+    def outside_profile(self):
+        # Samples outside the profile (after the bottom, before the start or outside the pressure window), flagged for all the variables
+        outside = np.zeros(len(self.data["time"]), dtype=bool)
+        if self.bottom_profile_index:
+            outside[self.bottom_profile_index:] = True
+        if self.start_profile_index:
+            outside[:self.start_profile_index] = True
+        if self.start_pressure:
+            outside |= self.data["Press"] > self.start_pressure
+        if self.end_pressure:
+            outside |= self.data["Press"] < self.end_pressure
+        return outside
 
     def export(self, folder, title, output_period="file", time_label="time", profile_to_grid=False, overwrite=False):
         if profile_to_grid:
@@ -144,8 +171,31 @@ class CTD:
             variables = self.variables
             dimensions = self.dimensions
             data = self.data
+        return self.export_data(variables, dimensions, data, folder, title, output_period, time_label, profile_to_grid, overwrite)
 
-        time = data[time_label]
+    def export_levels(self, folder_L1, title_L1, folder_L2, title_L2, output_period="file", time_label="time", overwrite=False):
+        """
+        Export the Level 1 data, derive the additional variables and export the Level 2 data.
+
+        Level 2 is a masked view of the Level 1 arrays (flagged values masked, the data is not copied) completed with
+        the derived variables: mask_data must not be called before. If derive_variables was already called, the
+        Level 1 data stored by it is exported.
+        """
+        if self.level1 is None:
+            variables_L1 = dict(self.variables)
+            data_L1 = dict(self.data) # derive_variables replaces the arrays without modifying them
+            output_files = self.export_data(variables_L1, self.dimensions, data_L1, folder_L1, title_L1, output_period, time_label, overwrite=overwrite)
+            self.derive_variables()
+        else:
+            variables_L1, data_L1 = self.level1
+            output_files = self.export_data(variables_L1, self.dimensions, data_L1, folder_L1, title_L1, output_period, time_label, overwrite=overwrite)
+        data_L2 = func.masked_view(data_L1)
+        data_L2.update({key: values for key, values in self.data.items() if values is not data_L1.get(key)}) # Derived or recomputed variables
+        output_files += self.export_data(self.variables, self.dimensions, data_L2, folder_L2, title_L2, output_period, time_label, overwrite=overwrite)
+        return output_files
+
+    def export_data(self, variables, dimensions, data, folder, title, output_period="file", time_label="time", profile_to_grid=False, overwrite=False):
+        time = np.ma.filled(np.ma.asarray(data[time_label], dtype=float), np.nan) # Masked times are not exported
         time_min = datetime.utcfromtimestamp(np.nanmin(time)).replace(tzinfo=timezone.utc)
         time_max = datetime.utcfromtimestamp(np.nanmax(time)).replace(tzinfo=timezone.utc)
 
@@ -166,7 +216,7 @@ class CTD:
             file_period = relativedelta(year=+1)
         else:
             self.logger.warning('Output period "{}" not recognised.'.format(output_period))
-            return
+            return []
 
         if not os.path.exists(folder):
             os.makedirs(folder)
@@ -187,29 +237,27 @@ class CTD:
                     for key, values in dimensions.items():
                         nc.createDimension(values['dim_name'], values['dim_size'])
                     for key, values in variables.items():
-                        var = nc.createVariable(values["var_name"], np.float64, values["dim"], fill_value=np.nan)
-                        var.units = values["unit"]
-                        var.long_name = values["long_name"]
+                        var = func.create_variable(nc, values, np.shape(data[key]))
                         if profile_to_grid and key == time_label:
                             var[0] = time[0]
                         elif profile_to_grid and len(values["dim"]) == 2:
                             if values["dim"][0] == time_label:
-                                var[0, :] = data[key]
+                                var[0, :] = func.mask_invalid(var, data[key])
                             elif values["dim"][1] == time_label:
-                                var[:, 0] = data[key]
+                                var[:, 0] = func.mask_invalid(var, data[key])
                             else:
                                 raise ValueError("Failed to write variable {} with dimensions: {} to file".format(key, ", ".join(values["dim"])))
                         else:
                             if len(values["dim"]) == 1:
                                 if values["dim"][0] == time_label:
-                                    var[:] = data[key][valid_time]
+                                    var[:] = func.mask_invalid(var, data[key][valid_time])
                                 else:
-                                    var[:] = data[key]
+                                    var[:] = func.mask_invalid(var, data[key])
                             elif len(values["dim"]) == 2:
                                 if values["dim"][0] == time_label:
-                                    var[:] = data[key][valid_time, :]
+                                    var[:] = func.mask_invalid(var, data[key][valid_time, :])
                                 elif values["dim"][1] == time_label:
-                                    var[:] = data[key][:, valid_time]
+                                    var[:] = func.mask_invalid(var, data[key][:, valid_time])
                             else:
                                 raise ValueError("Failed to write variable {} with dimensions: {} to file".format(key, ", ".join(values["dim"])))
                     #close_netCDF(nc,out_file)
@@ -217,130 +265,185 @@ class CTD:
             else:
                 with netCDF4.Dataset(out_file, mode='a', format='NETCDF4') as nc:
                     #nc=create_netCDF(out_file, mode_name='a', format_name='NETCDF4')
-                    nc_time = np.array(nc.variables[time_label][:])
                     if profile_to_grid:
-                        if time[0] in nc_time:
-                            if overwrite:
-                                idx = np.where(nc_time == time[0])[0][0]
-                                for key, values in variables.items():
-                                    if key not in dimensions:
-                                        if len(values["dim"]) == 1:
-                                            if hasattr(data[key], "__len__"):
-                                                nc.variables[key][idx] = data[key][0]
-                                            else:
-                                                nc.variables[key][idx] = data[key]
-                                        elif len(values["dim"]) == 2 and values["dim"][1] == time_label:
-                                            nc.variables[key][:, idx] = data[key]
-                                        else:
-                                            self.logger.warning("Unable to write {} with {} dimensions.".format(key, len(
-                                                values["dim"])))
-    
-                            else:
-                                self.logger.warning("Grid data already exists in NetCDF, skipping.")
-                        else:
-                            idx = func.position_in_array(nc_time, time[0])
-                            nc.variables[time_label][:] = np.insert(nc_time, idx, time[0])
-                            for key, values in variables.items():
-                                if key not in dimensions:
-                                    var = nc.variables[key]
-                                    if len(values["dim"]) == 1:
-                                        if hasattr(data[key], "__len__"):
-                                            var[idx] = data[key][0]
-                                        else:
-                                            var[idx] = data[key]
-                                    elif len(values["dim"]) == 2 and values["dim"][1] == time_label:
-                                        end = len(var[:][0]) - 1
-                                        if idx != end:
-                                            var[:, end] = data[key]
-                                            var[:] = var[:, np.insert(np.arange(end), idx, end)]
-                                        else:
-                                            var[:, idx] = data[key]
-                                    else:
-                                        self.logger.warning(
-                                            "Unable to write {} with {} dimensions.".format(key, len(values["dim"])))
+                        func.insert_profiles(nc, variables, dimensions, [data], time_label, overwrite)
                     else:
-                        if np.all(np.isin(time, nc_time)) and not overwrite:
+                        if not func.append_sorted(nc, variables, data, time, valid_time, time_label, overwrite):
                             self.logger.warning("Data already exists in NetCDF, skipping.")
-                        else:
-                            non_duplicates = ~np.isin(time, nc_time)
-                            valid = np.logical_and(valid_time, non_duplicates)
-                            combined_time = np.append(nc_time, time[valid])
-                            order = np.argsort(combined_time)
-                            nc_copy = func.copy_variables(nc.variables)
-                            for key, values in self.variables.items():
-                                if time_label in values["dim"]:
-                                    if len(values["dim"]) == 1:
-                                        combined = np.append(nc_copy[key][:], np.array(data[key])[valid])
-                                        if overwrite:
-                                            combined[np.isin(combined_time, time)] = np.array(data[key])[
-                                                np.isin(time, combined_time)]
-                                        out = combined[order]
-                                    elif len(values["dim"]) == 2 and values["dim"][1] == time_label:
-                                        combined = np.concatenate((np.array(nc_copy[key][:]), np.array(data[key])[:, valid]), axis=1)
-                                        if overwrite:
-                                            combined[:, np.isin(combined_time, time)] = np.array(data[key])[:, np.isin(time, combined_time)]
-                                        out = combined[:, order]
-                                    else:
-                                        raise ValueError(
-                                            "Failed to write variable {} with dimensions: {} to file"
-                                            .format(key, ", ".join(values["dim"])))
-                                    nc.variables[key][:] = out
                     #close_netCDF(nc,out_file)
             file_start = file_start + file_period
         return output_files
 
+    def export_profiles(self, folder, title, grids, time_label="time", overwrite=False):
+        """
+        Export several gridded profiles (dictionaries with the structure of self.grid) to a single netCDF file.
+
+        The profiles are inserted in the existing file {title}_*.nc of the folder, or in a new file named after the
+        earliest profile, with one reorder and one write per variable for the whole batch.
+        """
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        out_files = sorted(glob.glob(os.path.join(folder, "{}_????????_??????.nc".format(title))))
+        if len(out_files) > 0:
+            out_file = out_files[0]
+            with netCDF4.Dataset(out_file, mode='a', format='NETCDF4') as nc:
+                func.insert_profiles(nc, self.grid_variables, self.grid_dimensions, grids, time_label, overwrite)
+        else:
+            time_min = datetime.utcfromtimestamp(np.nanmin([np.atleast_1d(grid[time_label])[0] for grid in grids])).replace(tzinfo=timezone.utc)
+            out_file = os.path.join(folder, "{}_{}.nc".format(title, time_min.strftime('%Y%m%d_%H%M%S')))
+            with netCDF4.Dataset(out_file, mode='w', format='NETCDF4') as nc:
+                for key in self.general_attributes:
+                    setattr(nc, key, self.general_attributes[key])
+                for key, values in self.grid_dimensions.items():
+                    nc.createDimension(values['dim_name'], values['dim_size'])
+                for key, values in self.grid_variables.items():
+                    var = func.create_variable(nc, values, np.shape(grids[0][key]) if time_label not in values["dim"] else None)
+                    if time_label not in values["dim"]:
+                        var[:] = func.mask_invalid(var, grids[0][key]) # Grid dimensions (e.g., depth) are the same for all the profiles
+                func.insert_profiles(nc, self.grid_variables, self.grid_dimensions, grids, time_label, overwrite)
+        return [out_file]
+
+    def grid_profiles(self, depth, data, row_size, start_time, dz=0.1, attributes=None):
+        """
+        Average profiles (concatenated, see functions_ctd.read_profiles) on a depth grid of dz bins [m], all at once.
+
+        Sets grid_variables (mean, standard deviation and number of samples of each variable in each bin) and returns
+        the grid of each profile, for export_profiles. attributes: global attributes common to the profiles.
+        """
+        binned = func.bin_profiles(depth, data, row_size, dz)
+        self.general_attributes.update(attributes or {})
+        self.general_attributes["Depth bin size (m)"] = dz
+        self.grid_dimensions["depth"]["dim_size"] = len(binned["depth"])
+        self.grid_variables = {
+            "time": self.variables["time"],
+            "depth": {'var_name': 'depth', 'dim': ('depth',), 'unit': 'm', 'long_name': 'Depth of the bin centre', 'storage': 'default'}
+        }
+        for key in data:
+            values = self.variables.get(key, self.derived_variables.get(key, {'unit': '', 'long_name': key, 'storage': 'data'}))
+            self.grid_variables[key] = {'var_name': key, 'dim': ('depth', 'time'), 'unit': values["unit"], 'long_name': values["long_name"],
+                                        'storage': 'grid_precise' if values["storage"] == "precise" else 'grid'}
+            self.grid_variables[key + "_std"] = {'var_name': key + "_std", 'dim': ('depth', 'time'), 'unit': values["unit"],
+                                                 'long_name': 'standard deviation of {} in the bin'.format(values["long_name"]), 'storage': 'grid'}
+            self.grid_variables[key + "_count"] = {'var_name': key + "_count", 'dim': ('depth', 'time'), 'unit': '-',
+                                                   'long_name': 'number of {} samples in the bin'.format(values["long_name"]), 'storage': 'grid_count'}
+        grids = [dict({"time": start_time[k], "depth": binned["depth"]},
+                      **{key: binned[key][:, k] for key in self.grid_variables if key not in self.grid_dimensions})
+                 for k in range(len(start_time))]
+        if grids:
+            self.grid = grids[-1]
+        return grids
+
     def mask_data(self):
         for var in self.variables:
             if var + "_qual" in self.data:
                 idx = self.data[var + "_qual"][:] > 0
                 self.data[var][idx] = np.nan
 
-    def derive_variables(self, y_cond=0.874e-3, beta=0.807e-3):
+    def derivations(self, y_cond=0.874e-3, freshwater=False):
+        # Derived quantities: (inputs, function of the inputs, NaN instead of an error if it fails), computed on demand by derived
+        potential_temperature = func.potential_temperature_freshwater if freshwater else func.potential_temperature_sw
+        return {
+            "adj_press": (["Press"], lambda press: press - self.air_pressure, False), # Atmospheric pressure is computed from measurements in the air in function extract_single_profile
+            "SALIN": (["Temp", "Cond"], lambda temp, cond: func.salinity(temp, cond, y_cond, temperature_func=func.default_salinity_temperature), False),
+            "rho": (["Temp", "SALIN"], func.density, False),
+            "depth": (["adj_press", "rho"], lambda press, rho: 1e4 * press / rho / sw.g(self.latitude), False),
+            "pt": (["Temp", "SALIN", "adj_press"], lambda temp, salin, press: potential_temperature(temp, salin, press, 0), True),
+            "prho": (["pt", "SALIN"], func.density, True),
+            "sat": (["DO_mg", "pt", "SALIN"], lambda do, pt, salin: (do / func.oxygen_saturation(pt, salin, self.altitude, self.latitude)) * 100, False),
+        }
+
+    def derived(self, name, graph):
+        """
+        Value of name, memoized in self.derived_data: derived quantity of graph computed from its inputs, or measured
+        variable with its flagged values set to NaN (the other arrays of self.data are not copied).
+        """
+        if name not in self.derived_data:
+            if name in graph:
+                inputs, function, nan_on_failure = graph[name]
+                try:
+                    self.derived_data[name] = function(*[self.derived(key, graph) for key in inputs])
+                except Exception:
+                    if not nan_on_failure:
+                        raise
+                    self.logger.warning("Failed to calculate {}".format(name))
+                    self.derived_data[name] = np.full(len(self.data["time"]), np.nan)
+            elif name + "_qual" in self.data:
+                self.derived_data[name] = np.where(np.asarray(self.data[name + "_qual"]) > 0, np.nan, self.data[name])
+            else:
+                self.derived_data[name] = np.asarray(self.data[name], dtype=float)
+        return self.derived_data[name]
+
+    def derive_variables(self, y_cond=0.874e-3, beta=0.807e-3, variables=None, freshwater=False):
+        """
+        Compute the derived variables (default: the ones of self.derived_variables, pt, prho and sat) in self.data.
+
+        Only the quantities needed by variables are computed (see derivations), e.g. variables=["depth", "rho"] skips
+        the potential temperature and the oxygen saturation. The oxygen saturation replaces the measured one, which is
+        kept if it cannot be computed. freshwater=True: potential temperature in closed form (see
+        functions_ctd.potential_temperature_freshwater, < 2e-9 degC from sw.ptmp up to 30 dbar).
+        """
         if self.altitude == False or self.latitude == False:
             raise ValueError("Altitude and latitude must be provided in metadata to calculate additional parameters")
-        data = deepcopy(self.data)
-        for var in self.variables:
-            if "_qual" not in var:
-                idx = data[var + "_qual"] > 0
-                data[var][idx] = np.nan
-        data["adj_press"] = data["Press"] - self.air_pressure # Atmospheric pressure is computed from measurements in the air in function extract_single_profile
-        threshold = data["Temp"].shape[0] * 0.9
-        if sum(np.isnan(data["Temp"])) > threshold or sum(np.isnan(data["Cond"])) > threshold or \
-                sum(np.isnan(data["adj_press"])) > threshold:
+        if self.level1 is None:
+            self.level1 = (dict(self.variables), dict(self.data)) # The arrays are replaced below, not modified
+        if self.derived_parameters != (y_cond, freshwater):
+            self.derived_data = {}
+            self.derived_parameters = (y_cond, freshwater)
+        graph = self.derivations(y_cond, freshwater)
+        if variables is None:
+            variables = list(self.derived_variables) + ["pt", "prho", "sat"]
+
+        threshold = len(self.data["Temp"]) * 0.9
+        if sum(np.isnan(self.derived("Temp", graph))) > threshold or sum(np.isnan(self.derived("Cond", graph))) > threshold or \
+                sum(np.isnan(self.derived("adj_press", graph))) > threshold:
             raise ValueError("Not enough valid parameters to calculate additional parameters.")
         else:
-            self.variables.update(self.derived_variables)
-
-        self.data["SALIN"] = func.salinity(data["Temp"], data["Cond"], y_cond, temperature_func=func.default_salinity_temperature)
-        self.data["rho"] = np.asarray([1000] * len(data["Press"]))
-        self.data["rho"] = func.density(data["Temp"], self.data["SALIN"])
-        self.data["depth"] = 1e4 * data["adj_press"] / self.data["rho"] / sw.g(self.latitude)
-
-        try:
-            self.data["pt"] = func.potential_temperature_sw(data["Temp"], self.data["SALIN"], data["adj_press"], 0)
-        except Exception:
-            self.data["pt"] = np.asarray([np.nan] * len(data["time"]))
-            self.logger.warning("Failed to calculate potential temperature")
-
-        try:
-            self.data["prho"] = func.density(self.data["pt"], self.data["SALIN"])
-        except Exception:
-            self.data["prho"] = np.asarray([np.nan] * len(data["time"]))
-            self.logger.warning("Failed to calculate potential density")
-
-        try:
-            theoretical_saturation = func.oxygen_saturation(self.data["pt"], self.data["SALIN"], self.altitude, self.latitude)
-            self.data["sat"] = (self.data["DO_mg"] / theoretical_saturation) * 100
-        except Exception:
-            self.logger.warning("Failed to replace oxygen saturation")
-
-        # try:
-        #     sorted_pt = np.argsort(self.data["pt"])[::-1]
-        #     self.data["thorpe"] = -(self.data["depth"] - self.data["depth"][sorted_pt])
-        # except Exception:
-        #     self.data["thorpe"] = np.asarray([np.nan] * len(data["time"]))
-        #     self.logger.warning("Failed to calculate Thorpe Displacements")
+            self.variables.update({key: values for key, values in self.derived_variables.items() if key in variables})
+
+        for name in variables:
+            if name in self.level1[0]: # Measured variable replaced by the derived one
+                try:
+                    self.data[name] = self.derived(name, graph)
+                except Exception:
+                    self.logger.warning("Failed to replace {}".format(name))
+            else:
+                self.data[name] = self.derived(name, graph)
 
     def get_lake(self):
         return self.general_attributes["Lake"].replace(" ", "").lower()
 
+
+def thorpe_analysis(ctds, quantity="prho", stability_type="increasing", res=0):
+    """
+    Overturn analysis of the profiles ctds (CTD objects, after derive_variables) at once, added to their Level 2 variables.
+
+    The Thorpe displacements and scales of quantity are computed by functions_ctd.thorpe_scales for all the profiles
+    together. Only the valid samples are used (finite depth and quantity) where the instrument is deeper than all the
+    previous samples (pressure reversals removed), the other samples are NaN. Returns the overturning patches
+    (see thorpe_scales, "patch_profile" is the index in ctds).
+    """
+    depth, q, selections = [], [], []
+    for ctd in ctds:
+        d = np.asarray(ctd.data["depth"], dtype=float)
+        values = np.asarray(ctd.data[quantity], dtype=float)
+        finite = np.isfinite(d) & np.isfinite(values)
+        deepest = np.maximum.accumulate(np.where(finite, d, -np.inf))
+        selection = np.flatnonzero(finite & (d > np.concatenate(([-np.inf], deepest[:-1]))))
+        depth.append(d[selection])
+        q.append(values[selection])
+        selections.append(selection)
+    overturns = func.thorpe_scales(np.concatenate(depth + [np.zeros(0)]), np.concatenate(q + [np.zeros(0)]),
+                                   [len(selection) for selection in selections], stability_type, res)
+    start = 0
+    for ctd, selection, valid in zip(ctds, selections, overturns["valid"]):
+        samples = slice(start, start + len(selection))
+        start += len(selection)
+        if not valid:
+            ctd.logger.warning("Thorpe scales not computed for {}: {} unstable over the whole profile".format(ctd.filename, quantity))
+        for name, key in [("thorpe", "thorpe_disp"), ("thorpe_scale", "Lt"), ("overturn_extent", "extent")]:
+            ctd.data[name] = np.full(len(ctd.data["time"]), np.nan)
+            ctd.data[name][selection] = overturns[key][samples]
+        ctd.data["overturn_ends"] = np.zeros(len(ctd.data["time"]), dtype=np.int8)
+        ctd.data["overturn_ends"][selection] = overturns["ends_flag"][samples]
+        ctd.variables.update(ctd.thorpe_variables)
+    return {key: overturns[key] for key in ["patches", "patch_profile", "patch_Lt", "patch_extent", "patch_ends"]}
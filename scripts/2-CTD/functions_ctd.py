@@ -1,6 +1,7 @@
 import os
 import json
 import shutil
+import hashlib
 import logging
 import dateparser
 import numpy as np
@@ -12,6 +13,7 @@ from pyrsktools import RSK
 import matplotlib.pyplot as plt
 from datetime import datetime, timezone
 from matplotlib.backends.backend_pdf import PdfPages
+from netcdf_storage import create_variable, mask_invalid, masked_view, append_sorted, insert_profiles
 
 
 def create_file_list(path):
@@ -36,11 +38,12 @@ def create_file_list(path):
     return files
 
 
-def read_data(file_path, file_type,DO_umol=False):
+def read_data(file_path, file_type,DO_umol=False,t1=None,t2=None,channels=None,cache_folder=None):
+    # t1, t2 (UTC datetimes), channels and cache_folder are only used for RBR files (see read_rbr)
     if file_type == "sea&sun":
         profiles = read_sea_and_sun(file_path)
     elif file_type == "rbr":
-        profiles = read_rbr(file_path,DO_umol)
+        profiles = read_rbr(file_path,DO_umol,t1,t2,channels,cache_folder)
     elif file_type == "seabird":
         profiles = read_seabird(file_path)
     elif file_type == "exo":
@@ -57,15 +60,14 @@ def read_sea_and_sun(file_path):
     skip_rows, columns, units, valid = parse_sea_and_sun(file_path, "Lines :")
     if not valid:
         return False
-    df = pd.read_csv(file_path, sep='\s+', header=None, skiprows=skip_rows, names=columns, engine='python',
-                     encoding="cp1252")
+    df = read_data_block(file_path, skip_rows, columns, text_columns=[c for pair in time_columns for c in pair])
     columns = list(df.columns)
     for i in range(len(df.columns)):
         if df.columns[i] in column_conversion:
             columns[i] = column_conversion[df.columns[i]]
     df.columns = columns
     df["time"] = parse_time(df)
-    df["time"] = df["time"].dt.tz_localize('UTC').astype('int64') // 10 ** 9
+    df["time"] = df["time"].to_numpy().astype("datetime64[s]").astype(np.int64)
     downcast, upcast, air_pressure = extract_single_profile(df)
     profiles = casts_to_profiles(df, downcast, upcast, file_path, "Sea&Sun", air_pressure)
     if len(profiles) == 0:
@@ -74,41 +76,123 @@ def read_sea_and_sun(file_path):
         return profiles
 
 
-def read_rbr(file_path,DO_umol):
-    column_conversion = {
-        "timestamp": "time",
-        "pressure": "Press",
-        "temperature": "Temp",
-        "conductivity": "Cond",
-        "chlorophyll": "Chl_A",
-        "dissolved_o2_saturation": "sat",
-        "dissolved_o2_concentration": "DO_mg",
-    }
-    air_pressure = False
+rbr_columns = {
+    "timestamp": "time",
+    "pressure": "Press",
+    "temperature": "Temp",
+    "conductivity": "Cond",
+    "chlorophyll": "Chl_A",
+    "dissolved_o2_saturation": "sat",
+    "dissolved_o2_concentration": "DO_mg",
+}
+
+def read_rbr(file_path,DO_umol,t1=None,t2=None,channels=None,cache_folder=None):
+    """
+    Read the profiles of an RBR .rsk file.
+
+    Only the channels (names of the columns, e.g. ["Press", "Temp", "Cond"], None: all the known channels) are decoded,
+    pressure and conductivity are always read to detect the casts. Only the casts between t1 and t2 (UTC datetimes,
+    None: start or end of the deployment) are returned.
+    If cache_folder is given, the casts are detected once on the whole record and their times are stored with the air
+    pressure in a sidecar file (<file>.casts.json) keyed by the hash of the .rsk file: the next runs skip the detection
+    and only read the samples of the casts in the time window. Without cache_folder, the casts are detected on the whole
+    record at each call. In both cases the profiles keep their number in the whole record (names of the .meta files).
+    """
+    window = [int(datetime.timestamp(t.replace(tzinfo=timezone.utc)) * 1000) if t is not None else None for t in (t1, t2)] # [ms]
+    cache_file = os.path.join(cache_folder, os.path.basename(file_path) + ".casts.json") if cache_folder else None
+    cache = load_rbr_casts(cache_file, file_path) if cache_file else None
     with RSK(file_path) as rsk:
-        rsk.readdata()
-        df = pd.DataFrame(rsk.data["timestamp"], columns=["time"])
-        for column in rsk.channelNames:
-            if column in column_conversion:
-                df[column_conversion[column]] = rsk.data[column]
-        if DO_umol: # Convert from umol/l to mg/L
-            df["DO_mg"]=df["DO_mg"]*32/1000
-        df["time"] = df["time"].dt.tz_localize('UTC').astype('int64') // 10 ** 3
-
-        rsk.computeprofiles()
-        downcast = rsk.getprofilesindices(direction="down")
-        upcast = rsk.getprofilesindices(direction="up")
-        air_idx = np.setdiff1d(np.arange(len(df)), np.array(flatten([downcast, upcast])))
-        if len(air_idx) > 0:
-            pressure = np.array(df["Press"])
-            air_pressure = np.nanmean(pressure[air_idx])
-
-    profiles = casts_to_profiles(df, downcast, upcast, file_path, "RBR", air_pressure)
+        rsk.channels = [c for c in rsk.channels if c.longName in ["pressure", "sea_pressure", "conductivity"] or
+                        (c.longName in rbr_columns and (channels is None or rbr_columns[c.longName] in channels))]
+        if cache is not None: # Read only the samples of the casts in the window
+            air_pressure = cache["air_pressure"]
+            numbers = [k for k, cast in enumerate(cache["profiles"]) if rbr_in_window(cast, window)]
+            segments = []
+            downcast = []
+            upcast = []
+            n = 0
+            for k in numbers:
+                t_start, t_bottom, t_end = cache["profiles"][k]
+                rsk.readdata(np.datetime64(t_start, "ms"), np.datetime64(t_end, "ms"))
+                segments.append(rbr_dataframe(rsk, DO_umol))
+                bottom = int(np.searchsorted(rsk.data["timestamp"].astype("datetime64[ms]").astype(np.int64), t_bottom))
+                downcast.append([n, n + bottom])
+                upcast.append([n + bottom + 1, n + len(segments[-1]) - 1])
+                n += len(segments[-1])
+            df = pd.concat(segments, ignore_index=True) if segments else pd.DataFrame(columns=["time"])
+        else:
+            rsk.readdata() # Casts detected on the whole record: their numbers do not depend on the window
+            df = rbr_dataframe(rsk, DO_umol)
+            timestamp = rsk.data["timestamp"].astype("datetime64[ms]").astype(np.int64)
+
+            air_pressure = False
+            rsk.computeprofiles()
+            downcast = rsk.getprofilesindices(direction="down")
+            upcast = rsk.getprofilesindices(direction="up")
+            air_idx = np.setdiff1d(np.arange(len(df)), np.array(flatten([downcast, upcast])))
+            if len(air_idx) > 0:
+                pressure = np.array(df["Press"])
+                air_pressure = float(np.nanmean(pressure[air_idx]))
+            casts = [[int(timestamp[cast[0]]), int(timestamp[cast[-1]]), int(timestamp[upcast[k][-1]])] for k, cast in enumerate(downcast)]
+            if cache_file:
+                save_rbr_casts(cache_file, file_path, {"profiles": casts, "air_pressure": air_pressure})
+            numbers = [k for k, cast in enumerate(casts) if rbr_in_window(cast, window)]
+            downcast = [downcast[k] for k in numbers]
+            upcast = [upcast[k] for k in numbers]
+
+    profiles = casts_to_profiles(df, downcast, upcast, file_path, "RBR", air_pressure, numbers)
     if len(profiles) == 0:
         return False
     else:
         return profiles
-    
+
+def rbr_in_window(cast, window):
+    # cast: times [ms] of the start, bottom and end of the cast, window: [t1, t2] in ms (None: no limit)
+    return (window[0] is None or cast[0] >= window[0]) and (window[1] is None or cast[2] <= window[1])
+
+def rbr_dataframe(rsk, DO_umol):
+    # Columns of rsk.data used by the processing, renamed
+    df = pd.DataFrame(rsk.data["timestamp"], columns=["time"])
+    for column in rsk.channelNames:
+        if column in rbr_columns:
+            df[rbr_columns[column]] = rsk.data[column]
+    if DO_umol and "DO_mg" in df: # Convert from umol/l to mg/L
+        df["DO_mg"]=df["DO_mg"]*32/1000
+    df["time"] = df["time"].dt.tz_localize('UTC').astype('int64') // 10 ** 3
+    return df
+
+def file_hash(file_path, block_size=2**20):
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def load_rbr_casts(cache_file, file_path):
+    # Casts stored in the sidecar file if it was written for the current content of file_path, None otherwise
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except ValueError:
+        return None
+    stat = os.stat(file_path)
+    if cache.get("size") == stat.st_size and cache.get("mtime_ns") == stat.st_mtime_ns: # Unchanged file: no need to hash it again
+        return cache
+    if cache.get("hash") == file_hash(file_path):
+        save_rbr_casts(cache_file, file_path, cache)
+        return cache
+    return None
+
+def save_rbr_casts(cache_file, file_path, casts):
+    stat = os.stat(file_path)
+    casts = dict(casts, hash=casts.get("hash") or file_hash(file_path), size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with open(cache_file + ".tmp", "w") as f:
+        json.dump(casts, f, indent=1)
+    os.replace(cache_file + ".tmp", cache_file)
+
 def read_exo(file_path):
     column_conversion = {
         "PRESSURE PSI A": "Press",
@@ -117,20 +201,22 @@ def read_exo(file_path):
         "ODO % CB": "sat",
         "ODO MG/L": "DO_mg",
     }
+    data_conversion = {
+        "PRESSURE PSI A": psi_to_dbar,
+        "COND ΜS/CM": divide_by_1000,
+    }
     air_pressure = False
     
-    try:
-        data_exo=pd.read_csv(file_path,skiprows=9,sep=",",parse_dates=[["Date (MM/DD/YYYY)","Time (HH:mm:ss)"]],encoding='utf-16')
-    except:
-        data_exo=pd.read_csv(file_path,skiprows=9,sep=",",parse_dates=[["DATE (MM/DD/YYYY)","TIME (HH:MM:SS)"]],encoding='utf-16') 
+    data_exo=pd.read_csv(file_path,skiprows=9,sep=",",encoding='utf-16',dtype={"Date (MM/DD/YYYY)":str,"Time (HH:mm:ss)":str,"DATE (MM/DD/YYYY)":str,"TIME (HH:MM:SS)":str})
     # Put column names in uppercase:
     colnames=list(data_exo.columns)
     for k in range(len(colnames)):
         colnames[k]=colnames[k].upper()
     data_exo.columns=colnames
 
-    tdate=data_exo.iloc[:,0].to_numpy().astype('datetime64[s]').astype(datetime)
-    tnum=data_exo.iloc[:,0].to_numpy().astype('datetime64[s]').astype(np.int64)
+    # Date and time columns combined (nested parse_dates lists are not supported by pandas >= 2)
+    time_exo=pd.to_datetime(data_exo["DATE (MM/DD/YYYY)"]+" "+data_exo["TIME (HH:MM:SS)"],format="%m/%d/%Y %H:%M:%S")
+    tnum=time_exo.to_numpy().astype('datetime64[s]').astype(np.int64)
 
     # Order chronologically
     # ind_sort=np.argsort(tnum)
@@ -143,7 +229,7 @@ def read_exo(file_path):
         
     for column in colnames:
         if column in column_conversion:
-            df[column_conversion[column]] = data_exo[column]
+            df[column_conversion[column]] = data_conversion[column](data_exo[column]) if column in data_conversion else data_exo[column]
 
     downcast, upcast, air_pressure = extract_single_profile(df)        
     profiles = casts_to_profiles(df, downcast, upcast, file_path, "EXO", air_pressure)
@@ -171,8 +257,7 @@ def read_seabird(file_path):
     skip_rows, columns, valid, time = parse_seabird(file_path, "*END*")
     if not valid:
         return False
-    df = pd.read_csv(file_path, sep='\s+', header=None, skiprows=skip_rows, names=columns, engine='python',
-                     encoding="cp1252")
+    df = read_data_block(file_path, skip_rows, columns)
     df["time"] = df["Time, Elapsed [seconds]"] + time
 
     columns = list(df.columns)
@@ -191,15 +276,17 @@ def read_seabird(file_path):
         return profiles
 
 
-def casts_to_profiles(df, downcast, upcast, file_path, file_type, air_pressure):
+def casts_to_profiles(df, downcast, upcast, file_path, file_type, air_pressure, numbers=None):
+    # numbers: number of each cast in the file, used in the profile names (default: 0, 1, ...)
     profiles = []
-    for index, cast in enumerate(downcast):
+    for k, cast in enumerate(downcast):
+        index = numbers[k] if numbers is not None else k
         if index == 0:
             name = os.path.splitext(os.path.basename(file_path))[0]
         else:
             name = os.path.splitext(os.path.basename(file_path))[0] + "_{}".format(index)
         bottom = cast[-1] - cast[0]
-        df_profile = df.iloc[cast[0]: upcast[index][-1] + 1]
+        df_profile = df.iloc[cast[0]: upcast[k][-1] + 1]
         data = {
             "name": name,
             "file": os.path.basename(file_path),
@@ -214,13 +301,32 @@ def casts_to_profiles(df, downcast, upcast, file_path, file_type, air_pressure):
     return profiles
 
 
+def scan_header(input_file_path, string, n_after=0):
+    # Lines of the header up to the first line containing string and the n_after next lines, the rest of the file is not read
+    # Returns the lines and the index of the line containing string (None if not found)
+    lines = []
+    found = None
+    with open(input_file_path, encoding="latin1", errors='ignore') as f:
+        for line in f:
+            lines.append(line)
+            if found is None and string in line:
+                found = len(lines) - 1
+            if found is not None and len(lines) > found + n_after:
+                break
+    return lines, found
+
+
+def read_data_block(file_path, skip_rows, columns, text_columns=()):
+    # Whitespace separated data after the header, parsed by the C engine of pandas (text_columns are kept as strings)
+    return pd.read_csv(file_path, sep=r'\s+', header=None, skiprows=skip_rows, names=columns, engine='c', encoding="cp1252",
+                       dtype={c: str for c in text_columns if c in columns})
+
+
 def parse_sea_and_sun(input_file_path, string):
     valid = True
-    with open(input_file_path, encoding="latin1", errors='ignore') as f:
-        lines = f.readlines()
-    for i in range(len(lines)):
-        if string in lines[i]:
-            break
+    lines, i = scan_header(input_file_path, string, 6) # Header and the first two data lines
+    if i is None:
+        return 0, [], [], False
     columns = lines[i + 2].replace(";", "").split()
     columns.pop(0)
     columns = rename_duplicates(columns)
@@ -237,17 +343,16 @@ def parse_sea_and_sun(input_file_path, string):
 
 def parse_seabird(input_file_path, string):
     valid = True
-    with open(input_file_path, encoding="latin1", errors='ignore') as f:
-        lines = f.readlines()
+    lines, i = scan_header(input_file_path, string, 2) # Header and the first two data lines
+    if i is None:
+        i = len(lines) - 1
     columns = []
-    for i in range(len(lines)):
-        if "# start_time" in lines[i]:
-            time = dateparser.parse(lines[i].split("= ")[1].split(" [")[0])
+    for line in lines[:i + 1]:
+        if "# start_time" in line:
+            time = dateparser.parse(line.split("= ")[1].split(" [")[0])
             time = time.replace(tzinfo=timezone.utc).timestamp()
-        if "# name" in lines[i]:
-            columns.append(lines[i].split(":")[1].lstrip().replace("\n", ""))
-        if string in lines[i]:
-            break
+        if "# name" in line:
+            columns.append(line.split(":")[1].lstrip().replace("\n", ""))
     skip_rows = i + 1
     if len(lines) <= skip_rows + 1 or len(columns) < 5:
         valid = False
@@ -299,13 +404,35 @@ def process_profiles(profiles, folder, template):
             json.dump(m, f, indent=4)
 
 
+time_columns = [("IntD", "IntT"), ("IntDT", "IntDT1"), ("IntT", "IntT1")] # Date (dd.mm.yyyy) and time (hh:mm:ss.ss) columns of Sea&Sun files
+
 def parse_time(df):
-    if "IntD" in df.columns and "IntT" in df.columns:
-        return pd.to_datetime(df["IntD"] + " " + df["IntT"], format="%d.%m.%Y %H:%M:%S.%f", dayfirst=True)
-    elif "IntDT" in df.columns and "IntDT1" in df.columns:
-        return pd.to_datetime(df["IntDT"] + " " + df["IntDT1"], format="%d.%m.%Y %H:%M:%S.%f", dayfirst=True)
-    elif "IntT" in df.columns and "IntT1" in df.columns:
-        return pd.to_datetime(df["IntT"] + " " + df["IntT1"], format="%d.%m.%Y %H:%M:%S.%f", dayfirst=True)
+    # The dates are parsed once per day, the times are converted by time_of_day
+    for date_column, time_column in time_columns:
+        if date_column in df.columns and time_column in df.columns:
+            codes, dates = pd.factorize(df[date_column])
+            days = pd.to_datetime(dates, format="%d.%m.%Y").to_numpy().astype("datetime64[ns]")
+            time = np.where(codes >= 0, days[codes], np.datetime64("NaT")) + time_of_day(df[time_column])
+            return pd.Series(time, index=df.index)
+
+
+def time_of_day(values):
+    # Strings hh:mm:ss[.fffffffff] to timedelta64[ns], computed from the bytes of the strings (other formats: pd.to_timedelta)
+    try:
+        b = np.asarray(values, dtype="S")
+    except UnicodeEncodeError:
+        return pd.to_timedelta(values).to_numpy()
+    if len(b) == 0 or b.dtype.itemsize < 8:
+        return pd.to_timedelta(values).to_numpy()
+    chars = b.view(np.uint8).reshape(len(b), -1).astype(np.int64)
+    if not (np.all(chars[:, 2] == ord(":")) and np.all(chars[:, 5] == ord(":"))):
+        return pd.to_timedelta(values).to_numpy()
+    digits = chars - ord("0")
+    ns = ((digits[:, 0] * 10 + digits[:, 1]) * 3600 + (digits[:, 3] * 10 + digits[:, 4]) * 60 + digits[:, 6] * 10 + digits[:, 7]) * 10 ** 9
+    fraction = chars[:, 9:18]
+    if fraction.shape[1] > 0: # Shorter strings are padded with zero bytes
+        ns = ns + np.where(fraction > 0, digits[:, 9:18], 0) @ (10 ** (8 - np.arange(fraction.shape[1])))
+    return ns.astype("timedelta64[ns]")
 
 
 def extract_single_profile(df, rolling=3, diff=0.01, var="Cond", pressure="Press", max_pressure_cut=3.0):
@@ -333,6 +460,9 @@ def extract_single_profile(df, rolling=3, diff=0.01, var="Cond", pressure="Press
 def divide_by_1000(arr):
     return arr / 1000
 
+def psi_to_dbar(arr):
+    return arr * 0.6894757
+
 
 def flatten(nested_list):
     flattened = []
@@ -407,6 +537,46 @@ def json_converter(qa):
         return qa
 
 
+quality_assurance_configs = {} # Compiled quality assurance files of this process, see compile_quality_assurance
+
+
+def compile_quality_assurance(file_path, simple=True):
+    """
+    Quality assurance file parsed once per process (again if it is modified) and compiled for quality_assurance_flags.
+
+    The numeric and bounds tests of the variables are stored as arrays in the order of "keys" ("numeric", "lower",
+    "upper"), the other tests (simple=False: advanced tests included) are kept for envass in "tests".
+    """
+    cache_key = (os.path.abspath(file_path), os.stat(file_path).st_mtime_ns, simple)
+    if cache_key not in quality_assurance_configs:
+        with open(file_path) as f:
+            quality_assurance_dict = json_converter(json.load(f))
+        qa = {"keys": [], "numeric": [], "lower": [], "upper": [], "tests": {}}
+        for key, tests in quality_assurance_dict.items():
+            if not (tests["advanced"] or tests["simple"]):
+                continue
+            tests = dict(tests["simple"]) if simple else dict(tests["simple"], **tests["advanced"])
+            bounds = tests.pop("bounds", False)
+            if isinstance(bounds, dict):
+                bounds = bounds["bounds"]
+            qa["keys"].append(key)
+            qa["numeric"].append(tests.pop("numeric", False) != False) # Same test as envass (e.g. "True" is applied)
+            qa["lower"].append(float(bounds[0]) if bounds != False else -np.inf)
+            qa["upper"].append(float(bounds[1]) if bounds != False else np.inf)
+            qa["tests"][key] = tests
+        for key in ["numeric", "lower", "upper"]:
+            qa[key] = np.array(qa[key])
+        quality_assurance_configs[cache_key] = qa
+    return quality_assurance_configs[cache_key]
+
+
+def quality_assurance_flags(values, numeric, lower, upper):
+    """Flags (int8, 1 = failed) of the numeric and bounds tests of values, one row per variable, evaluated at once."""
+    flags = (values < lower[:, None]) | (values > upper[:, None])
+    flags |= np.isnan(values) & numeric[:, None]
+    return flags.astype(np.int8)
+
+
 def copy_files(file_path, folder, extensions):
     directory, filename = os.path.split(file_path)
     filename_no_ext = os.path.splitext(filename)[0]
@@ -493,12 +663,180 @@ def potential_temperature_sw(T, S, p, p_ref):
     """
     return sw.ptmp(s=S,t=T,p=p,pr=p_ref)
 
+def potential_temperature_freshwater(T, S, p, p_ref=0):
+    """
+    Potential temperature [degC (ITS-90)] in closed form, for lakes (low pressure), instead of the Runge-Kutta
+    integration of potential_temperature_sw.
+
+    The adiabatic lapse rate of UNESCO 1983 (Bryden 1973) is integrated from p to p_ref at the mean pressure, with the
+    second order term of its temperature dependence. Maximum difference with sw.ptmp for -2 to 40 degC and a
+    salinity of 0 to 35: 2e-9 degC for |p - p_ref| up to 30 dbar, 2e-6 degC up to 300 dbar, 6e-5 degC up to 1000 dbar.
+    """
+    t = np.asarray(T) * 1.00024 # IPTS-68, as in the UNESCO 1983 polynomials
+    s = np.asarray(S) - 35
+    dp = p_ref - np.asarray(p)
+    pm = p + 0.5 * dp
+    gradient = (3.5803e-5 + (8.5258e-6 + (-6.836e-8 + 6.6228e-10 * t) * t) * t + (1.8932e-6 - 4.2393e-8 * t) * s
+                + ((1.8741e-8 + (-6.7795e-10 + (8.733e-12 - 5.4481e-14 * t) * t) * t) + (-1.1351e-10 + 2.7759e-12 * t) * s) * pm
+                + (-4.6206e-13 + (1.8676e-14 - 2.1687e-16 * t) * t) * pm * pm) # Adiabatic temperature gradient [degC/dbar]
+    gradient_t = (8.5258e-6 + (-1.3672e-7 + 1.98684e-9 * t) * t - 4.2393e-8 * s
+                  + ((-6.7795e-10 + (1.7466e-11 - 1.63443e-13 * t) * t) + 2.7759e-12 * s) * pm
+                  + (1.8676e-14 - 4.3374e-16 * t) * pm * pm) # Derivative with temperature
+    return (t + dp * gradient + 0.5 * dp * dp * gradient * gradient_t) / 1.00024
+
 def position_in_array(arr, value):
     for i in range(len(arr)):
         if value < arr[i]:
             return i
     return len(arr)
 
+def read_profiles(files, variables, time_label="time"):
+    """
+    Read variables from the netCDF files of several profiles (e.g. the L2 files), concatenated.
+
+    Returns the data (masked values and variables missing from a file are NaN), the number of samples of each profile
+    (row_size), the start time of each profile and the global attributes with the same value in all the files.
+    """
+    data = {key: [] for key in variables}
+    row_size, start_time, attributes = [], [], None
+    for file in files:
+        with nc.Dataset(file) as f:
+            time = np.ma.filled(f.variables[time_label][:].astype(float), np.nan)
+            for key in variables:
+                data[key].append(np.ma.filled(f.variables[key][:].astype(float), np.nan) if key in f.variables else np.full(len(time), np.nan))
+            row_size.append(len(time))
+            start_time.append(np.nanmin(time))
+            file_attributes = {key: f.getncattr(key) for key in f.ncattrs()}
+        if attributes is None:
+            attributes = file_attributes
+        else:
+            attributes = {key: value for key, value in attributes.items() if key in file_attributes and np.array_equal(file_attributes[key], value)}
+    data = {key: np.concatenate(values + [np.zeros(0)]) for key, values in data.items()}
+    return data, np.array(row_size, dtype=int), np.array(start_time), attributes or {}
+
+
+# Variables (profile dimension) of the contiguous ragged array files: name: (dtype, attributes of the variable)
+ragged_profile_variables = {
+    "row_size": ("i4", {"long_name": "number of samples of the profile", "sample_dimension": "obs"}),
+    "profile": (str, {"long_name": "profile name", "cf_role": "profile_id"}),
+    "profile_time": ("f8", {"units": "seconds since 1970-01-01 00:00:00", "long_name": "start time of the profile", "standard_name": "time"}),
+    "latitude": ("f8", {"units": "degrees_north", "long_name": "latitude", "standard_name": "latitude"}),
+    "longitude": ("f8", {"units": "degrees_east", "long_name": "longitude", "standard_name": "longitude"}),
+    "device": (str, {"long_name": "device"}),
+    "source_file": (str, {"long_name": "file of the profile"}),
+}
+
+def export_ragged(files, file_path, time_label="time", chunk_size=4096):
+    """
+    Write the netCDF files of several profiles (e.g. the L2 files of a campaign) to one CF contiguous ragged array file.
+
+    The samples of all the profiles are stored one profile after the other along the dimension obs, row_size gives the
+    number of samples of each profile and the profile variables its name, start time, coordinates, device and file
+    (ragged_profile_variables). The variables are copied without unpacking (same type, attributes and fill value), a
+    variable missing from a file is left to the fill value for its profile. The global attributes are the ones with the
+    same value in all the files.
+    """
+    profiles, variables, attributes = [], {}, None
+    for file in files:
+        with nc.Dataset(file) as f:
+            time = np.ma.filled(f.variables[time_label][:].astype(float), np.nan)
+            file_attributes = {key: f.getncattr(key) for key in f.ncattrs()}
+            for key, var in f.variables.items():
+                if var.dimensions == (time_label,) and key not in variables:
+                    variables[key] = (var.dtype, {attr: var.getncattr(attr) for attr in var.ncattrs()})
+        profiles.append({"row_size": len(time), "profile": str(file_attributes.get("Profile name", os.path.splitext(os.path.basename(file))[0])),
+                         "profile_time": np.nanmin(time) if len(time) > 0 else np.nan,
+                         "latitude": float(file_attributes.get("latitude", np.nan)), "longitude": float(file_attributes.get("longitude", np.nan)),
+                         "device": str(file_attributes.get("Device", "")), "source_file": os.path.basename(file)})
+        if attributes is None:
+            attributes = file_attributes
+        else:
+            attributes = {key: value for key, value in attributes.items() if key in file_attributes and np.array_equal(file_attributes[key], value)}
+    n_obs = sum(profile["row_size"] for profile in profiles)
+    with nc.Dataset(file_path, mode='w', format='NETCDF4') as out:
+        for key, value in (attributes or {}).items():
+            out.setncattr(key, value)
+        out.featureType = "profile"
+        out.createDimension("profile", len(profiles))
+        out.createDimension("obs", n_obs)
+        for key, (dtype, var_attributes) in ragged_profile_variables.items():
+            var = out.createVariable(key, dtype, ("profile",))
+            var.setncatts(var_attributes)
+            var[:] = np.array([profile[key] for profile in profiles], dtype=object if dtype is str else dtype)
+        for key, (dtype, var_attributes) in variables.items():
+            var = out.createVariable(key, dtype, ("obs",), fill_value=var_attributes.pop("_FillValue", None), zlib=True, complevel=4, shuffle=True,
+                                     chunksizes=[max(min(chunk_size, n_obs), 1)])
+            var.setncatts(var_attributes)
+            var.coordinates = "profile_time latitude longitude depth" if key != "depth" else "profile_time latitude longitude"
+            var.set_auto_maskandscale(False)
+        start = 0
+        for file, profile in zip(files, profiles):
+            with nc.Dataset(file) as f:
+                for key in variables:
+                    if key in f.variables:
+                        f.variables[key].set_auto_maskandscale(False) # Raw values: packed data copied as is
+                        out.variables[key][start:start + profile["row_size"]] = f.variables[key][:]
+            start += profile["row_size"]
+    return file_path
+
+
+def read_ragged_profile(file_path, index, variables=None):
+    """
+    Read the profile index of a contiguous ragged array file (export_ragged) without reading the other profiles.
+
+    Only row_size is read in full, the data variables (variables, default: all) are read on the samples of the profile.
+    Returns the data (masked arrays) and the profile variables (name, start time, coordinates, device and file).
+    """
+    with nc.Dataset(file_path) as f:
+        row_size = f.variables["row_size"][:].astype(int)
+        index = range(len(row_size))[index] # IndexError for a profile that is not in the file, negative index from the end
+        start = int(row_size[:index].sum())
+        if variables is None:
+            variables = [key for key, var in f.variables.items() if var.dimensions == ("obs",)]
+        data = {key: f.variables[key][start:start + row_size[index]] for key in variables}
+        profile = {}
+        for key in ragged_profile_variables:
+            f.variables[key].set_auto_mask(False) # NaN for the unknown coordinates
+            value = f.variables[key][index]
+            profile[key] = value if isinstance(value, str) else value.item()
+    return data, profile
+
+
+def bin_profiles(depth, data, row_size, dz=0.1, max_depth=None):
+    """
+    Average many profiles on a depth grid of dz bins [m] at once.
+
+    depth and the arrays of data are the profiles concatenated, row_size the number of samples of each profile. The
+    sums of all the bins of all the profiles are computed together with np.bincount. Returns the depth of the bin
+    centres and, for each variable, the mean, the standard deviation (key + "_std") and the number of valid samples
+    (key + "_count") of each bin, as arrays (depth, profile). Empty bins are NaN.
+    """
+    depth = np.asarray(depth, dtype=float)
+    row_size = np.asarray(row_size, dtype=int)
+    n_profiles = len(row_size)
+    profile = np.repeat(np.arange(n_profiles), row_size)
+    valid = np.isfinite(depth) & (depth >= 0)
+    if max_depth is None:
+        max_depth = np.max(depth[valid]) if np.any(valid) else 0.
+    n_bins = int(np.floor(max_depth / dz)) + 1
+    depth_bin = np.floor(np.where(valid, depth, 0) / dz).astype(int)
+    valid &= depth_bin < n_bins
+    cell = depth_bin * n_profiles + profile # Index in the (depth, profile) grid
+
+    binned = {"depth": (np.arange(n_bins) + 0.5) * dz}
+    for key, values in data.items():
+        values = np.asarray(values, dtype=float)
+        samples = valid & np.isfinite(values)
+        count = np.bincount(cell[samples], minlength=n_bins * n_profiles)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.bincount(cell[samples], weights=values[samples], minlength=n_bins * n_profiles) / count
+            variance = np.bincount(cell[samples], weights=(values[samples] - mean[cell[samples]]) ** 2, minlength=n_bins * n_profiles) / count
+        binned[key] = mean.reshape(n_bins, n_profiles)
+        binned[key + "_std"] = np.sqrt(variance).reshape(n_bins, n_profiles) # Two passes: no loss of precision for large means (e.g. density)
+        binned[key + "_count"] = count.reshape(n_bins, n_profiles)
+    return binned
+
+
 def thorpe_scale(depth,q,stability_type,res=0):
     """
     Calculates Thorpe displacements and Thorpe scale, based on https://github.com/modscripps/mixsea/tree/main
@@ -538,76 +876,78 @@ def thorpe_scale(depth,q,stability_type,res=0):
             Overturn ratio of Gargett & Garner.
     """
     if stability_type=="decreasing":
-        q=-q
-    
-
-    if q[0] > q[-1]:
+        if -q[0] > -q[-1]:
+            raise ValueError("The entire profile is unstable, q[0] > q[-1].")
+    elif q[0] > q[-1]:
         raise ValueError("The entire profile is unstable, q[0] > q[-1].")
 
     if not np.all(np.isclose(np.maximum.accumulate(depth), depth)):
         raise ValueError(
             "It appears that depth is not monotonically increasing, please fix."
         )
-    
-    if res!=0:
-        q_rounded=np.round(q/res)*res
-    else:
-        q_rounded=np.copy(q)
-    idx_sorted, idx_patches = find_overturns(q_rounded)
 
-    ndata = depth.size
+    overturns = thorpe_scales(depth, q, [len(depth)], stability_type, res)
+    return overturns["Lt"], overturns["thorpe_disp"], overturns["q_sorted"], overturns["ends_flag"], overturns["patches"], overturns["idx_sorted"]
 
-    # Thorpe displacements
-    # = defined here as the distance from current depth where the sorted value is located (i.e., depth where value should be moved to the current depth to get a sort profile is current depth + thorpe displacement)
-    # e.g., if displacement=-2, we need to get the value 2 m above the current depth to sort the profile
-    # Thorpe displacements can also be defined as depth-depth[idx_sorted] (opposite signs)
-    thorpe_disp = depth[idx_sorted] - depth
 
-    q_sorted = q[idx_sorted]
+def thorpe_scales(depth, q, row_size, stability_type="increasing", res=0):
+    """
+    Thorpe displacements, Thorpe scales and overturning patches of many profiles at once (see thorpe_scale).
+
+    The profiles are concatenated in depth and q, row_size is the number of samples of each profile. The patches of all
+    the profiles are found with one sort and one cumulative sum, their statistics are computed with segment reductions
+    (np.bincount) instead of a loop over the patches.
+
+    Returns a dictionary of arrays:
+        per sample: thorpe_disp, Lt, extent (vertical extent of the patch [m]), ends_flag, q_sorted, idx_sorted
+        (indices within the profile), patch (index of the patch, -1 outside the patches)
+        per patch: patches (first and last sample, both included), patch_profile, patch_Lt, patch_extent, patch_ends
+        per profile: valid, False if the profile is entirely unstable, contains NaN or if its depth is not increasing
+        (NaN and no patches for its samples)
+    """
+    depth = np.asarray(depth, dtype=float)
+    q = -np.asarray(q, dtype=float) if stability_type == "decreasing" else np.asarray(q, dtype=float)
+    row_size = np.asarray(row_size, dtype=int)
+    first_sample = np.concatenate(([0], np.cumsum(row_size)[:-1])).astype(int)
+    last_sample = first_sample + row_size - 1
+    profile = np.repeat(np.arange(len(row_size)), row_size)
+
+    # Profiles that can be analysed
+    valid = row_size > 0
+    valid[valid] = q[first_sample[valid]] <= q[last_sample[valid]]
+    shift = profile * (np.nanmax(np.abs(depth)) * 2 + 1) if len(depth) else 0 # Cumulative maximum within each profile
+    increasing = np.isclose(np.maximum.accumulate(depth + shift) - shift, depth) & np.isfinite(q)
+    valid &= np.bincount(profile, weights=~increasing, minlength=len(row_size)) == 0
+
+    # Overturns: the sorting indices differ from the indices (sorted within each profile, the sum returns to 0 at its end)
+    q_rounded = np.round(q / res) * res if res != 0 else q
+    idx_sorted = np.concatenate([np.argsort(q_rounded[i0:i0 + n], kind="stable") + i0 for i0, n in zip(first_sample, row_size)] +
+                                [np.zeros(0, dtype=int)]) # One sort per profile, faster than a sort of all the profiles by (profile, q)
+    unstable = np.cumsum(idx_sorted - np.arange(len(q))) > 0
+    previous = np.concatenate(([False], unstable[:-1]))
+    starts = unstable & ~previous & valid[profile]
+    in_patch = (unstable | previous) & valid[profile]
+    patch = np.where(in_patch, np.cumsum(starts) - 1, -1)
 
-    # Initialise arrays.
-    Lt = np.full_like(depth, np.nan,dtype=np.float64)
-    Ro = np.full_like(depth, np.nan,dtype=np.float64)
-    noise_flag = np.full_like(depth, False, dtype=bool)
-    ends_flag = np.full_like(depth, False, dtype=bool)
-
-    dz = 0.5 * (depth[2:] - depth[:-2])  # 'width' of each data point
-    dz = np.hstack((dz[0], dz, dz[-1]))  # assume width of first and last data point
-
-    for patch in idx_patches:
-        # Get patch indices.
-        i0 = patch[0]
-        i1 = patch[1]
-        pidx = np.arange(i0, i1 + 1, 1)  # Need +1 for Python indexing
-
-        # Thorpe scale is the root mean square thorpe displacement.
-        Lto = np.sqrt(np.mean(np.square(thorpe_disp[pidx])))
-        Lt[pidx] = Lto
-
-        # Flag beginning or end.
-        if i0 == 0:
-            ends_flag[pidx] = True
-        if i1 == ndata - 1:
-            ends_flag[pidx] = True
-
-        # Flag small difference.
-        # dq = q_sorted[i1] - q_sorted[i0]
-        # if dq < dnoise:
-        #     noise_flag[pidx] = True
-
-        # Overturn ratio of Gargett & Garner
-        # Tdo = thorpe_disp[pidx]
-        # dzo = dz[pidx]
-        # L_tot = np.sum(dzo)
-        # L_neg = np.sum(dzo[Tdo < 0])
-        # L_pos = np.sum(dzo[Tdo > 0])
-        # Roo = np.minimum(L_neg / L_tot, L_pos / L_tot)
-        # Ro[pidx] = Roo
-        
-    if stability_type=="decreasing":
-        q_sorted=-q_sorted
-    # return Lt, thorpe_disp, q_sorted, noise_flag, ends_flag, Ro, idx_patches, idx_sorted
-    return Lt, thorpe_disp, q_sorted, ends_flag, idx_patches, idx_sorted
+    thorpe_disp = depth[idx_sorted] - depth
+    first = np.flatnonzero(starts)
+    last = np.flatnonzero(in_patch & ~unstable)
+    patch_profile = profile[first]
+    counts = np.bincount(patch + 1, minlength=len(first) + 1)[1:] # Index 0: samples outside the patches
+    patch_Lt = np.sqrt(np.bincount(patch + 1, weights=thorpe_disp ** 2, minlength=len(first) + 1)[1:] / np.maximum(counts, 1))
+    patch_extent = depth[last] - depth[first]
+    patch_ends = (first == first_sample[patch_profile]) | (last == last_sample[patch_profile])
+
+    Lt = np.concatenate(([np.nan], patch_Lt))[patch + 1]
+    extent = np.concatenate(([np.nan], patch_extent))[patch + 1]
+    ends_flag = np.concatenate(([False], patch_ends))[patch + 1]
+    thorpe_disp[~valid[profile]] = np.nan
+    q_sorted = q[idx_sorted]
+    if stability_type == "decreasing":
+        q_sorted = -q_sorted
+    return {"thorpe_disp": thorpe_disp, "Lt": Lt, "extent": extent, "ends_flag": ends_flag, "q_sorted": q_sorted,
+            "idx_sorted": idx_sorted - first_sample[profile], "patch": patch, "patches": np.column_stack((first, last)),
+            "patch_profile": patch_profile, "patch_Lt": patch_Lt, "patch_extent": patch_extent, "patch_ends": patch_ends, "valid": valid}
 
 
 def find_overturns(q):
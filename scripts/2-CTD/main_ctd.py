@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 import os
 import sys
-import json
 import shutil
 import numpy as np
 from datetime import datetime, timezone
-from ctd import CTD
-from functions_ctd import create_file_list, copy_files, read_data, process_profiles, create_folder
+from concurrent.futures import ProcessPoolExecutor
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ctd import CTD, thorpe_analysis
+from functions_ctd import create_file_list, copy_files, read_data, process_profiles, create_folder, read_profiles, export_ragged
+from pipeline import pipeline, code_version
+from instrumentation import start_report, stage, write_report
+from metadata_catalog import metadata_catalog, nearest
 
 #%% Specify field campaign here:
 
@@ -14,41 +18,62 @@ date_campaign='20250605'
 date_min=datetime(2025,6,5,12,0,0) # Minimum device time
 
 # For RBR profiles:
-ctd_data_folder='..\..\data\Profiles\RBR_237207'
+ctd_data_folder=os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','..','data','Profiles','RBR_237207')
 extensions = [".rsk"]
 DO_umol=True # Do data is in umol/l and needs to be converted to mg/l
 
 # For EXO profiles:
-# ctd_data_folder='..\..\data\Profiles\EXO'
+# ctd_data_folder=os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','..','data','Profiles','EXO')
 # extensions = [".csv"]
 
+n_workers=None # Number of processes used to process the Level0 files (None = number of cores, 1 = serial)
+profile_workers=None # Number of processes used to process the profiles of each Level0 file (None = cores left by n_workers, 1 = serial)
+force_rebuild=False # Delete the Level1-2 folders and reprocess everything, instead of only the outputs that are out of date
+report_memory=True # Measure the peak memory of each stage in the run report (tracemalloc, slower)
+freshwater=True # Closed-form potential temperature for lakes (< 2e-9 degC from seawater.ptmp up to 30 dbar), False = seawater.ptmp
+dz_L3=0.1 # Size of the depth bins of the Level3 grid [m]
+thorpe=False # Thorpe displacements and scales of the potential density in the Level2 files
+meta_tolerance=None # Maximum difference [s] between the start of a profile and the time of its metadata file when they are matched by time (None = no limit)
+
 #%% Other parameters
 
 input_folder=os.path.join(ctd_data_folder,date_campaign)
+qa_path=os.path.join(os.path.dirname(os.path.abspath(__file__)),'quality_assurance_ctd.json')
+code_files=[os.path.join(os.path.dirname(os.path.abspath(__file__)),f) for f in ["ctd.py","functions_ctd.py"]] + [os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','netcdf_storage.py')]
+
+#%% Function to process a Level0 file
 
-create_folder(input_folder, "Level1")
-create_folder(input_folder, "Level2")
+def process_file(file, input_folder, date_min, DO_umol=False, qa_path=qa_path, profile_workers=1, catalog=None, meta_tolerance=None, freshwater=False, thorpe=False):
+    """
+    Process all the profiles of one Level0 file to Level1 and Level2 and return the output files.
 
-files = create_file_list(os.path.join(input_folder, "Level0"))
-metadata_required=[]
-#%% Read and export CTD data
-for file in files:
+    The metadata files are taken from catalog (metadata_catalog of the Level0 folder, built here if None). When their
+    number differs from the number of profiles, they are matched to the profiles by nearest start time, within
+    meta_tolerance [s]. The profiles are processed by a pool of profile_workers processes (1: serial). A failed profile
+    does not stop the others, it is listed in "failed_profiles" and the file is processed again at the next run.
+    """
+    outputs=[]
+    metadata_required=[]
     print("Processing file {}".format(file["path"]))
     try:
-        profiles = read_data(file["path"], file["type"],DO_umol)
+        with stage("read_data", file=file["path"], inputs=[file["path"]]) as record:
+            profiles = read_data(file["path"], file["type"],DO_umol,t1=date_min,cache_folder=os.path.join(input_folder,".cache")) # RBR: only the samples after date_min are read
+            record["rows"] = sum(len(profile["data"]) for profile in profiles)
     except Exception as e:
         print(e)
         print("Failed to process {}".format(file["path"]))
-        continue
+        return {"success": False, "outputs": []}
     
-    # Remove profiles before device time
+    # Remove profiles before device time (already skipped by the RBR reader)
     ind_rem=[]
     for kp,profile in enumerate(profiles):
         if profile["data"]["time"].iloc[0]<(date_min.replace(tzinfo=timezone.utc).timestamp()):
             ind_rem.append(kp)
     profiles = [prof for kp, prof in enumerate(profiles) if kp not in ind_rem]
     
-    list_metafiles=[f for f in os.listdir(os.path.join(os.path.dirname(file["path"]))) if f.endswith(".meta") and file["basename"] in f]
+    if catalog is None:
+        catalog = metadata_catalog(os.path.dirname(file["path"]))
+    list_metafiles=catalog.names(file["basename"])
     search_meta=False
     if len(list_metafiles)>len(profiles):
         print("**** WARNING: more meta files than detected profiles! ****") 
@@ -57,44 +82,204 @@ for file in files:
         print("**** WARNING: not all detected profiles have metadata! ****")
         search_meta=True
         
-    if search_meta: # List profiling time from all metadata files
-        time_prof=np.full(len(list_metafiles),np.nan)
-        for k,meta_file in enumerate(list_metafiles):
-            meta_path=os.path.join(os.path.dirname(file["path"]),meta_file)
-            with open(meta_path) as f:
-                meta = json.load(f)
-            time_prof_str=meta["campaign"]["Date of measurement"]+" "+meta["profile"]["Time of measurement (local)"]
-            time_prof[k]=datetime.strptime(time_prof_str,"%Y-%m-%d %H:%M").replace(tzinfo=timezone.utc).timestamp()
-            time_prof[k]=time_prof[k]+(meta["campaign"]["Time Zone device (UTC+)"]-meta["campaign"]["Time Zone local (UTC+)"])*3600 # Device time
+    if search_meta: # Match the profiles and the metadata files by start time (device time)
+        time_start_profiles=np.array([profile["data"]["time"].iloc[0] for profile in profiles])
         metafiles_found=[""]*len(profiles)
         if len(list_metafiles)>len(profiles): # Find the metadata file for each profile
-            for kp,profile in enumerate(profiles):
-                indmin=np.argmin(np.abs(time_prof-profile["data"]["time"].iloc[0]))
-                metafiles_found[kp]=list_metafiles[indmin]
+            metafiles_found=[name or "" for name in catalog.nearest(time_start_profiles, list_metafiles, meta_tolerance)]
         else: # Find the profile for each metadatafile (leave empty otherwise)
-            time_start_profiles=[profile["data"]["time"].iloc[0] for profile in profiles]
-            for km in range(len(list_metafiles)):
-                indmin=np.argmin(np.abs(time_start_profiles-time_prof[km]))
-                metafiles_found[indmin]=list_metafiles[km]
+            list_timed=[f for f in list_metafiles if catalog.start_time(f) is not None]
+            for meta_file,kp in zip(list_timed, nearest(time_start_profiles, [catalog.start_time(f) for f in list_timed], meta_tolerance)):
+                if kp>=0:
+                    metafiles_found[kp]=meta_file
                          
+    to_process=[]
     for kp,profile in enumerate(profiles):
         if search_meta: # Search for corresponding metadata files
             profilemeta=metafiles_found[kp]   
         else: 
             profilemeta=profile["name"] + ".meta"            
-        if profilemeta and os.path.isfile(os.path.join(os.path.dirname(file["path"]), profilemeta)):
-            print("Processing profile {}".format(profile["name"]))
-            ctd = CTD()
-            if ctd.read_profile(profile):
-                ctd.quality_assurance('quality_assurance_ctd.json')
-                file_name = os.path.basename(file["path"]).rsplit('.', 1)[0]
-                ctd.export(os.path.join(input_folder, "Level1"), "L1_CTD_{}_{}".format(file["type"], file_name),overwrite=True)
-                ctd.mask_data() # Replace flagged data by nan 
-                ctd.derive_variables() # Compute additional variables to add to Level 2
-                ctd.export(os.path.join(input_folder, "Level2"), "L2_CTD_{}_{}".format(file["type"], file_name), overwrite=True) # Create Level 2 file      
-                
+        if profilemeta and catalog.get(profilemeta) is not None:
+            to_process.append((profile, profilemeta, catalog.get(profilemeta)))
         else:
             print("No metadata for profile {}".format(profile["name"]))
-            metadata_required.append(profile)
+            metadata_required.append(profile["name"])
+
+    # Profiles written to the same output files (same start time) are processed in the same task, in their order in the file.
+    # Each task processes a contiguous part of the file, so that the Thorpe scales of its profiles are computed at once
+    groups={}
+    for profile, profilemeta, meta in to_process:
+        groups.setdefault(output_key(profile), []).append((profile, profilemeta, meta))
+    group_list=list(groups.values())
+    n_tasks=max(min(profile_workers, len(group_list)), 1)
+    bounds=np.linspace(0, len(group_list), n_tasks + 1).astype(int)
+    tasks=[([task for group in group_list[bounds[k]:bounds[k + 1]] for task in group], file, input_folder, qa_path, freshwater, thorpe) for k in range(n_tasks)]
+    if n_tasks == 1:
+        results = [process_profiles_group(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=profile_workers) as executor:
+            results = list(executor.map(process_profiles_group, *zip(*tasks)))
+    failed=[]
+    for result in [result for group_results in results for result in group_results]:
+        outputs += result["outputs"]
+        if not result["success"]:
+            failed.append(result["name"])
+    return {"success": len(failed) == 0, "outputs": sorted(set(outputs)), "metadata_required": metadata_required, "failed_profiles": failed}
+
+
+def output_key(profile):
+    # Start time of the profile, which defines the name of its output files
+    return datetime.fromtimestamp(profile["data"]["time"].min(), timezone.utc).strftime("%Y%m%d_%H%M%S")
+
+def process_profile(profile, qa_path=qa_path, profilemeta=None, meta=None, freshwater=False):
+    """Read one profile, check its quality and derive its variables (meta: parsed metadata file profilemeta). Returns the result and the CTD object (None if it is not valid or failed), the errors are returned instead of raised."""
+    result = {"name": profile["name"], "success": False, "error": "", "outputs": []}
+    print("Processing profile {}".format(profile["name"]))
+    try:
+        ctd = CTD()
+        rows = len(profile["data"])
+        with stage("read_profile", file=profile["name"], rows=rows):
+            valid = ctd.read_profile(profile, profilemeta, meta)
+        if not valid:
+            result["success"] = True
+            return result, None
+        with stage("quality_assurance", file=profile["name"], rows=rows):
+            ctd.quality_assurance(qa_path)
+        with stage("derive_variables", file=profile["name"], rows=rows):
+            ctd.derive_variables(freshwater=freshwater)
+        return result, ctd
+    except Exception as e:
+        print(e)
+        print("Failed to process profile {}".format(profile["name"]))
+        result["error"] = repr(e)
+        return result, None
+
+def export_profile(ctd, result, file, input_folder):
+    # Level 1 and Level 2 (flagged data masked and additional variables derived) of a processed profile
+    file_name = os.path.basename(file["path"]).rsplit('.', 1)[0]
+    try:
+        with stage("export", file=result["name"], rows=len(ctd.data["time"])) as record:
+            record["outputs"] = ctd.export_levels(os.path.join(input_folder, "Level1"), "L1_CTD_{}_{}".format(file["type"], file_name),
+                                                  os.path.join(input_folder, "Level2"), "L2_CTD_{}_{}".format(file["type"], file_name), overwrite=True)
+        result["outputs"] = record["outputs"]
+        result["success"] = True
+    except Exception as e:
+        print(e)
+        print("Failed to export profile {}".format(result["name"]))
+        result["error"] = repr(e)
+
+def process_profiles_group(profiles, file, input_folder, qa_path=qa_path, freshwater=False, thorpe=False):
+    """
+    Process profiles (profile, metadata file name, metadata) to Level1 and Level2, the profiles with the same output
+    files one after the other. The Thorpe scales of all the profiles are computed at once (thorpe_analysis), before the export.
+    """
+    processed = [process_profile(profile, qa_path, profilemeta, meta, freshwater) for profile, profilemeta, meta in profiles]
+    ctds = [ctd for result, ctd in processed if ctd is not None]
+    if thorpe and len(ctds) > 0:
+        try:
+            with stage("thorpe", file=file["path"], rows=sum(len(ctd.data["time"]) for ctd in ctds)):
+                thorpe_analysis(ctds)
+        except Exception as e:
+            print(e)
+            print("Failed to compute the Thorpe scales of {} profiles of {}".format(len(ctds), file["path"]))
+            for result, ctd in processed:
+                if ctd is not None:
+                    result["error"] = repr(e)
+            return [result for result, ctd in processed]
+    for result, ctd in processed:
+        if ctd is not None:
+            export_profile(ctd, result, file, input_folder)
+    return [result for result, ctd in processed]
+
+
+def grid_L2(input_folder, dz=0.1):
+    """Average the L2 profiles of the campaign on a depth grid, all at once, and export one L3 file (depth x time) per device type."""
+    files_L2 = sorted(f for f in os.listdir(os.path.join(input_folder, "Level2")) if f.startswith("L2_CTD_") and f.endswith(".nc"))
+    groups = {}
+    for f in files_L2: # L2_CTD_{type}_{Level0 file}_{start time}.nc
+        groups.setdefault(f.split("_")[2], []).append(os.path.join(input_folder, "Level2", f))
+    outputs = []
+    for file_type, files in groups.items():
+        ctd = CTD()
+        variables = [key for key in list(ctd.variables) + list(ctd.derived_variables) if key not in ["time", "Press", "depth"]]
+        with stage("read_L2", file=file_type, inputs=files) as record:
+            data, row_size, start_time, attributes = read_profiles(files, variables + ["depth"])
+            record["rows"] = int(row_size.sum())
+        depth = data.pop("depth")
+        data = {key: values for key, values in data.items() if np.any(np.isfinite(values))} # Variables not measured by the device
+        with stage("grid_profiles", file=file_type, rows=record["rows"]):
+            grids = ctd.grid_profiles(depth, data, row_size, start_time, dz, attributes)
+        title = "L3_CTD_{}".format(file_type)
+        folder_L3 = os.path.join(input_folder, "Level3")
+        os.makedirs(folder_L3, exist_ok=True)
+        for f in os.listdir(folder_L3):
+            if f.startswith(title + "_"): # The grid of the campaign is rebuilt from all the profiles
+                os.remove(os.path.join(folder_L3, f))
+        print("Export {} profiles to the L3 netCDF file {}".format(len(grids), title))
+        with stage("export_L3", file=file_type, rows=record["rows"]) as record:
+            record["outputs"] = ctd.export_profiles(folder_L3, title, grids)
+        outputs += record["outputs"]
+    return outputs
+
+
+def export_campaign(input_folder):
+    """Write all the L2 profiles of the campaign to one contiguous ragged array file (one profile after the other) in the Level3 folder."""
+    start_time = lambda f: "_".join(os.path.basename(f)[:-3].split("_")[-2:]) # L2_CTD_{type}_{Level0 file}_{start time}.nc
+    files_L2 = sorted((os.path.join(input_folder, "Level2", f) for f in os.listdir(os.path.join(input_folder, "Level2")) if f.startswith("L2_CTD_") and f.endswith(".nc")), key=start_time)
+    folder_L3 = os.path.join(input_folder, "Level3")
+    os.makedirs(folder_L3, exist_ok=True)
+    for f in os.listdir(folder_L3):
+        if f.startswith("L2_CTD_campaign_"):
+            os.remove(os.path.join(folder_L3, f))
+    if len(files_L2) == 0:
+        return []
+    title = "L2_CTD_campaign_{}".format(start_time(files_L2[0]))
+    print("Export {} profiles to the campaign netCDF file {}".format(len(files_L2), title))
+    with stage("export_campaign", file=title, inputs=files_L2) as record:
+        record["outputs"] = [export_ragged(files_L2, os.path.join(folder_L3, title + ".nc"))]
+    return record["outputs"]
+
+
+def process_campaign(input_folder, date_min, DO_umol=False, extensions=None, n_workers=None, force_rebuild=False, report_memory=True, profile_workers=None, meta_tolerance=None, freshwater=False, thorpe=False, dz_L3=0.1):
+    """
+    Process the profiles of a campaign to Level1, Level2, the Level3 depth grid and the campaign file of all the L2 profiles (only the outputs that are out of date) and return the status of each step.
+
+    The time, rows, bytes and peak memory of each stage are written to a run report in the Reports folder of the campaign.
+    """
+    manifest_path=os.path.join(input_folder,".pipeline.json") # Hashes and outputs of the last run
+    report_folder=os.path.join(input_folder,"Reports")
+    if force_rebuild:
+        create_folder(input_folder, "Level1")
+        create_folder(input_folder, "Level2")
+        create_folder(input_folder, "Level3")
+
+    # Read and export CTD data: one processing step per Level0 file, then the L3 grid and the campaign file of all the profiles
+    files = create_file_list(os.path.join(input_folder, "Level0"))
+    if extensions is not None:
+        files = [file for file in files if file["extension"].lower() in [ext.lower() for ext in extensions]]
+    # .meta files of the campaign, parsed once (only the new or modified ones since the last run)
+    catalog = metadata_catalog(os.path.join(input_folder, "Level0"), os.path.join(input_folder, ".cache", "metadata_catalog.json"))
+    steps = pipeline(manifest_path, code_version(code_files), n_workers)
+    if profile_workers is None: # Share the cores between the files processed at the same time
+        n_files=min(len(files), n_workers or os.cpu_count() or 1)
+        profile_workers=max((os.cpu_count() or 1) // max(n_files, 1), 1)
+    for file in files:
+        list_metafiles=catalog.names(file["basename"])
+        steps.add_node("L2 " + os.path.basename(file["path"]), process_file, (file, input_folder, date_min, DO_umol, qa_path, profile_workers, catalog, meta_tolerance, freshwater, thorpe),
+                       inputs=[file["path"], qa_path] + [os.path.join(os.path.dirname(file["path"]), f) for f in list_metafiles],
+                       params={"type": file["type"], "date_min": date_min.isoformat(), "DO_umol": DO_umol, "meta_tolerance": meta_tolerance, "freshwater": freshwater, "thorpe": thorpe})
+    steps.add_node("L3", grid_L2, (input_folder, dz_L3), params={"dz": dz_L3},
+                   depends=["L2 " + os.path.basename(file["path"]) for file in files])
+    steps.add_node("campaign", export_campaign, (input_folder,), depends=["L2 " + os.path.basename(file["path"]) for file in files])
+    start_report(report_folder, report_memory)
+    status = steps.run(force=force_rebuild)
+    write_report(report_folder, "run_report_CTD")
+    failed = [name for name in status if status[name] == "failed"]
+    print("{} steps built, {} up to date, {} failed".format(list(status.values()).count("built"), list(status.values()).count("skipped"), len(failed)))
+    for name in failed:
+        print("Failed to build {}".format(name))
+    return status
 
 
+if __name__ == "__main__":
+    process_campaign(input_folder, date_min, DO_umol, extensions, n_workers, force_rebuild, report_memory, profile_workers, meta_tolerance, freshwater, thorpe, dz_L3)
@@ -37,15 +37,15 @@ class meteo_series:
         }
 
         self.variables = {
-            'time': {'var_name': 'time', 'dim': ('time',), 'unit': 'seconds since 1970-01-01 00:00:00', 'long_name': 'time'},
-            'T_2M [°C]': {'var_name': 'T2M_C', 'dim': ('time',), 'unit': 'degC', 'long_name': 'air_temperature_2m_C'},
-            'T_2M [K]': {'var_name': 'T2M_K', 'dim': ('time',), 'unit': 'K', 'long_name': 'air_temperature_2m_K'},
-            'U [m/s]': {'var_name': 'U10', 'dim': ('time',), 'unit': 'm/s', 'long_name': 'zonal_wind_speed_10m'},
-            'V [m/s]': {'var_name': 'V10', 'dim': ('time',), 'unit': 'm/s', 'long_name': 'meridional_wind_speed_10m'},
-            'GLOB [W/m2]': {'var_name': 'GLOB', 'dim': ('time',), 'unit': 'W/m2', 'long_name': 'global_radiation_surface'},
-            'RELHUM_2M [%]': {'var_name': 'RH2M', 'dim': ('time',), 'unit': '%', 'long_name': 'relative_humidity_2m'},
-            'PMSL [Pa]': {'var_name': 'PMSL', 'dim': ('time',), 'unit': 'Pa', 'long_name': 'pressure_mean_sea_level'},
-            'CLCT [%]': {'var_name': 'CLCT', 'dim': ('time',), 'unit': '%', 'long_name': 'total_cloud_cover'}
+            'time': {'var_name': 'time', 'dim': ('time',), 'unit': 'seconds since 1970-01-01 00:00:00', 'long_name': 'time', 'storage': 'time'},
+            'T_2M [°C]': {'var_name': 'T2M_C', 'dim': ('time',), 'unit': 'degC', 'long_name': 'air_temperature_2m_C', 'storage': 'data'},
+            'T_2M [K]': {'var_name': 'T2M_K', 'dim': ('time',), 'unit': 'K', 'long_name': 'air_temperature_2m_K', 'storage': 'data'},
+            'U [m/s]': {'var_name': 'U10', 'dim': ('time',), 'unit': 'm/s', 'long_name': 'zonal_wind_speed_10m', 'storage': 'data'},
+            'V [m/s]': {'var_name': 'V10', 'dim': ('time',), 'unit': 'm/s', 'long_name': 'meridional_wind_speed_10m', 'storage': 'data'},
+            'GLOB [W/m2]': {'var_name': 'GLOB', 'dim': ('time',), 'unit': 'W/m2', 'long_name': 'global_radiation_surface', 'storage': 'data'},
+            'RELHUM_2M [%]': {'var_name': 'RH2M', 'dim': ('time',), 'unit': '%', 'long_name': 'relative_humidity_2m', 'storage': 'data'},
+            'PMSL [Pa]': {'var_name': 'PMSL', 'dim': ('time',), 'unit': 'Pa', 'long_name': 'pressure_mean_sea_level', 'storage': 'data'},
+            'CLCT [%]': {'var_name': 'CLCT', 'dim': ('time',), 'unit': '%', 'long_name': 'total_cloud_cover', 'storage': 'data'}
         }
 
         self.start_time = False
@@ -137,15 +137,15 @@ class meteo_grid:
         }
 
         self.variables = {
-            'time': {'var_name': 'time', 'dim': ('time',), 'unit': 'seconds since 1970-01-01 00:00:00', 'long_name': 'time'},
-            'T_2M [°C]': {'var_name': 'T2M_C', 'dim': ('time',), 'unit': 'degC', 'long_name': 'air_temperature_2m_C'},
-            'T_2M [K]': {'var_name': 'T2M_K', 'dim': ('time',), 'unit': 'K', 'long_name': 'air_temperature_2m_K'},
-            'U [m/s]': {'var_name': 'U10', 'dim': ('time',), 'unit': 'm/s', 'long_name': 'zonal_wind_speed_10m'},
-            'V [m/s]': {'var_name': 'V10', 'dim': ('time',), 'unit': 'm/s', 'long_name': 'meridional_wind_speed_10m'},
-            'GLOB [W/m2]': {'var_name': 'GLOB', 'dim': ('time',), 'unit': 'W/m2', 'long_name': 'global_radiation_surface'},
-            'RELHUM_2M [%]': {'var_name': 'RH2M', 'dim': ('time',), 'unit': '%', 'long_name': 'relative_humidity_2m'},
-            'PMSL [Pa]': {'var_name': 'PMSL', 'dim': ('time',), 'unit': 'Pa', 'long_name': 'pressure_mean_sea_level'},
-            'CLCT [%]': {'var_name': 'CLCT', 'dim': ('time',), 'unit': '%', 'long_name': 'total_cloud_cover'}
+            'time': {'var_name': 'time', 'dim': ('time',), 'unit': 'seconds since 1970-01-01 00:00:00', 'long_name': 'time', 'storage': 'time'},
+            'T_2M [°C]': {'var_name': 'T2M_C', 'dim': ('time',), 'unit': 'degC', 'long_name': 'air_temperature_2m_C', 'storage': 'data'},
+            'T_2M [K]': {'var_name': 'T2M_K', 'dim': ('time',), 'unit': 'K', 'long_name': 'air_temperature_2m_K', 'storage': 'data'},
+            'U [m/s]': {'var_name': 'U10', 'dim': ('time',), 'unit': 'm/s', 'long_name': 'zonal_wind_speed_10m', 'storage': 'data'},
+            'V [m/s]': {'var_name': 'V10', 'dim': ('time',), 'unit': 'm/s', 'long_name': 'meridional_wind_speed_10m', 'storage': 'data'},
+            'GLOB [W/m2]': {'var_name': 'GLOB', 'dim': ('time',), 'unit': 'W/m2', 'long_name': 'global_radiation_surface', 'storage': 'data'},
+            'RELHUM_2M [%]': {'var_name': 'RH2M', 'dim': ('time',), 'unit': '%', 'long_name': 'relative_humidity_2m', 'storage': 'data'},
+            'PMSL [Pa]': {'var_name': 'PMSL', 'dim': ('time',), 'unit': 'Pa', 'long_name': 'pressure_mean_sea_level', 'storage': 'data'},
+            'CLCT [%]': {'var_name': 'CLCT', 'dim': ('time',), 'unit': '%', 'long_name': 'total_cloud_cover', 'storage': 'data'}
         }
 
         self.data = {}
@@ -7,6 +7,7 @@ import netCDF4
 from copy import deepcopy
 from datetime import datetime, timezone, timedelta
 from dateutil.relativedelta import relativedelta
+from netcdf_storage import create_variable, mask_invalid
 
 
 def read_data(file_path):
@@ -106,14 +107,12 @@ def export(obj, folder, title, output_period="file", time_label="time", overwrit
 
             # Variables
             for key, values in variables.items():
-                var = nc.createVariable(values["var_name"], np.float64, values["dim"], fill_value=np.nan)
-                var.units = values["unit"]
-                var.long_name = values["long_name"]
+                var = create_variable(nc, values, np.shape(data[key]))
 
                 if len(values["dim"]) == 1 and values["dim"][0] == time_label:
-                    var[:] = data[key][valid_time]
+                    var[:] = mask_invalid(var, data[key][valid_time])
                 elif key == time_label:
-                    var[:] = data[time_label][valid_time]
+                    var[:] = mask_invalid(var, data[time_label][valid_time])
 
         file_start += file_period
 
@@ -11,48 +11,81 @@ import json
 import numpy as np
 from datetime import datetime, timezone
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
 from Meteo import meteo_series 
 from functions_meteo import read_data, export, create_folder
+from pipeline import pipeline, code_version
+from instrumentation import start_report, stage, write_report
 
 #%% Setup paths
 
-meteo_data_folder = r'..\..\data\Meteo\Model\20250606'
-input_folder = os.path.join(meteo_data_folder, "Level0")
-meta_path = os.path.join(input_folder, "meteo_20250606.meta")
+date_campaign = '20250606'
+meteo_data_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data', 'Meteo', 'Model', date_campaign)
+code_files = [os.path.join(os.path.dirname(os.path.abspath(__file__)), f) for f in ["Meteo.py", "functions_meteo.py"]] + [os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'netcdf_storage.py')]
 
+force_rebuild = False # Delete the Level1 folder and reprocess everything, instead of only the outputs that are out of date
+report_memory = True # Measure the peak memory of each stage in the run report (tracemalloc, slower)
 
-create_folder(meteo_data_folder, "Level1")
+#%% Function to process a data file
 
-#%% Load metadata
-
-if os.path.exists(meta_path):
-    with open(meta_path) as f:
-        meta = json.load(f)
-else:
-    raise Exception("Metadata file not found!")
-
-#%% Read the data files
-if isinstance(meta["filename"], list):
-    files = np.array(meta["filename"])[meta["valid"]]
-else:
-    files = [meta["filename"]] if meta["valid"] else []
-
-
-for k, file in enumerate(files):
+def process_file(input_folder, file, meta, output_folder):
+    """Read one meteo file, export it to Level 1 and return the output files."""
     try:
-        data_temp = read_data(os.path.join(input_folder, file))
+        with stage("read_data", file=file, inputs=[os.path.join(input_folder, file)]) as record:
+            data_temp = read_data(os.path.join(input_folder, file))
+            record["rows"] = len(data_temp["data"])
     except Exception as e:
         print(e)
         print(f"Failed to process {file}")
-        continue
-    
+        return {"success": False, "outputs": []}
+
     met_series = meteo_series()
     if met_series.read_timeseries(data_temp, meta):
         file_name = file.rsplit('.', 1)[0]
         print(f"Export to L1 netCDF file: L1_meteo_{file_name}.nc")
-        export(met_series, os.path.join(meteo_data_folder, "Level1"), f"L1_meteo_{file_name}", overwrite=True)
+        with stage("export", file=file, rows=record["rows"]) as record:
+            record["outputs"] = export(met_series, output_folder, f"L1_meteo_{file_name}", overwrite=True)
+        return record["outputs"]
+    return []
+
+
+def process_campaign(meteo_data_folder, date_campaign, force_rebuild=False, report_memory=True):
+    """
+    Export the meteo data of a campaign to Level 1 (only the outputs that are out of date) and return the status of each step.
+
+    The time, rows, bytes and peak memory of each stage are written to a run report in the Reports folder of the campaign.
+    """
+    input_folder = os.path.join(meteo_data_folder, "Level0")
+    meta_path = os.path.join(input_folder, f"meteo_{date_campaign}.meta")
+    manifest_path = os.path.join(meteo_data_folder, ".pipeline.json") # Hashes and outputs of the last run
+    if force_rebuild:
+        create_folder(meteo_data_folder, "Level1")
+
+    # Load metadata
+
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+    else:
+        raise Exception("Metadata file not found!")
+
+    # Read the data files
+    if isinstance(meta["filename"], list):
+        files = np.array(meta["filename"])[meta["valid"]]
+    else:
+        files = [meta["filename"]] if meta["valid"] else []
+
+    steps = pipeline(manifest_path, code_version(code_files))
+    start_report(os.path.join(meteo_data_folder, "Reports"), report_memory)
+    for file in files:
+        steps.add_node("L1 " + file, process_file, (input_folder, file, meta, os.path.join(meteo_data_folder, "Level1")),
+                       inputs=[os.path.join(input_folder, file), os.path.join(input_folder, file.rsplit('.', 1)[0] + ".meta")], params=meta)
+    status = steps.run(force=force_rebuild)
+    write_report(os.path.join(meteo_data_folder, "Reports"), "run_report_meteo")
+
+    print("Meteorological data exported to Level 1.")
+    return status
 
-print("Meteorological data exported to Level 1.")
-  
 
-    
\ No newline at end of file
+if __name__ == "__main__":
+    process_campaign(meteo_data_folder, date_campaign, force_rebuild, report_memory)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic Level0 files for the benchmarks, in the formats expected by functions_mooring.read_data and functions_ctd.read_data.
+
+The CTD files contain one profile: the instrument first stays in the air, then goes down to max_depth and back up.
+RBR .rsk files are SQLite databases written by the RBR software and cannot be generated here: generate_rbr returns the
+profiles as produced by read_rbr (casts_to_profiles) instead.
+"""
+import os
+import json
+import numpy as np
+import pandas as pd
+import openpyxl
+from datetime import datetime, timedelta, timezone
+
+start_time = datetime(2025, 6, 5, 12, 0, 0)
+campaign = {"X Coordinate (CH1903)": "554076", "Y Coordinate (CH1903)": "132894", "Altitude (m)": "1405", "Lake": "Lake Taney"}
+
+
+def mooring_temperature(n_rows, depth, dt_sec=60, seed=0):
+    # Stratified temperature with a daily cycle decreasing with depth
+    rng = np.random.default_rng(seed)
+    t = np.arange(n_rows) * dt_sec
+    return 15 - 0.4 * depth + 2 * np.exp(-depth / 3) * np.sin(2 * np.pi * t / 86400) + rng.normal(0, 0.02, n_rows)
+
+
+def generate_hobo(file_path, n_rows, depth=0., dt_sec=60, seed=0):
+    """Write a HOBO Excel file (sheet 'Data': #, date, temperature) with n_rows measurements every dt_sec."""
+    temp = mooring_temperature(n_rows, depth, dt_sec, seed)
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Data")
+    ws.append(["#", "Date Time, GMT+00:00", "Temp, °C"])
+    for i in range(n_rows):
+        ws.append([i + 1, start_time + timedelta(seconds=i * dt_sec), round(float(temp[i]), 3)])
+    wb.save(file_path)
+    return file_path
+
+
+def generate_mooring_campaign(folder, date_campaign, n_sensors, n_rows, dt_sec=60):
+    """Create a mooring campaign (Level0 HOBO files and metadata) with n_sensors loggers, return the metadata."""
+    level0 = os.path.join(folder, date_campaign, "Level0")
+    os.makedirs(level0, exist_ok=True)
+    depths = list(np.round(np.linspace(0, 20, n_sensors), 1))
+    names = []
+    for k, depth in enumerate(depths):
+        names.append("logger_{}.xlsx".format(k))
+        generate_hobo(os.path.join(level0, names[-1]), n_rows, depth, dt_sec, seed=k)
+    meta = {"filenames": names, "filetypes": ["hobo_T"] * n_sensors, "valid": [True] * n_sensors, "Depth (m)": [float(d) for d in depths],
+            "campaign": dict(campaign, **{"Time of deployment": start_time.strftime("%Y-%m-%d %H:%M:%S"),
+                                          "Time of retrieval": (start_time + timedelta(seconds=n_rows * dt_sec)).strftime("%Y-%m-%d %H:%M:%S")})}
+    with open(os.path.join(level0, "thermistors_{}.meta".format(date_campaign)), "w") as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+def profile_data(n_rows, max_depth=40., air_pressure=9.6, dt_sec=0.125, seed=0):
+    """Synthetic profile: time, pressure (relative to air_pressure), temperature, conductivity and oxygen, with 10% of the rows in the air."""
+    rng = np.random.default_rng(seed)
+    n_air = n_rows // 10
+    n_down = (n_rows - n_air) // 2
+    depth = np.concatenate((np.zeros(n_air), np.linspace(0.1, max_depth, n_down), np.linspace(max_depth, 0.1, n_rows - n_air - n_down)))
+    temp = 5 + 13 * np.exp(-depth / 8) + rng.normal(0, 0.005, n_rows)
+    cond = np.where(depth > 0, 0.2 + 0.001 * depth, 0.) + rng.normal(0, 0.0005, n_rows)
+    do_mg = 9 + 0.02 * depth + rng.normal(0, 0.01, n_rows)
+    return {"time": start_time.replace(tzinfo=timezone.utc).timestamp() + np.arange(n_rows) * dt_sec,
+            "depth": depth, "Press": air_pressure + depth + rng.normal(0, 0.002, n_rows), "Temp": temp, "Cond": cond,
+            "DO_mg": do_mg, "sat": do_mg / 9 * 95, "Turb": np.abs(rng.normal(1, 0.1, n_rows)), "Chl_A": np.abs(rng.normal(1, 0.1, n_rows))}
+
+
+def write_profile_meta(folder, name, device):
+    """Metadata file of a profile, as expected by CTD.read_profile."""
+    meta = {"campaign": dict(campaign, **{"Device": device, "Date of measurement": start_time.strftime("%Y-%m-%d"),
+                                          "Time Zone device (UTC+)": 0, "Time Zone local (UTC+)": 0}),
+            "profile": {"Profile name": name, "Time of measurement (local)": start_time.strftime("%H:%M")}}
+    with open(os.path.join(folder, name + ".meta"), "w") as f:
+        json.dump(meta, f, indent=4)
+
+
+def generate_sea_and_sun(file_path, n_rows, seed=0):
+    """Write a Sea&Sun .tob file."""
+    p = profile_data(n_rows, air_pressure=0., seed=seed)
+    times = pd.to_datetime(p["time"], unit="s")
+    columns = ["IntD", "IntT", "Press", "Temp", "Cond", "Tur", "sat", "DO_mg"]
+    units = ["[dd.mm.yyyy]", "[hh:mm:ss.ss]", "[dbar]", "[°C]", "[mS/cm]", "[FTU]", "[%]", "[mg/l]"]
+    with open(file_path, "w", encoding="cp1252") as f:
+        f.write("; Sea & Sun Technology Standard Data Format\n; Source file : synthetic.srd\n; Lines : {}\n;\n".format(n_rows))
+        f.write("; Datasets " + " ".join(columns) + "\n")
+        f.write("; [#] " + " ".join(units) + "\n")
+        f.write(";" + "-" * 80 + "\n")
+        table = pd.DataFrame({"n": np.arange(1, n_rows + 1), "IntD": times.strftime("%d.%m.%Y"), "IntT": times.strftime("%H:%M:%S.%f").str[:-4],
+                              "Press": p["Press"], "Temp": p["Temp"], "Cond": p["Cond"], "Tur": p["Turb"], "sat": p["sat"], "DO_mg": p["DO_mg"]})
+        table.to_csv(f, sep=" ", header=False, index=False, float_format="%.4f", lineterminator="\n")
+    write_profile_meta(os.path.dirname(file_path), os.path.splitext(os.path.basename(file_path))[0], "Sea&Sun")
+    return file_path
+
+
+def generate_seabird(file_path, n_rows, seed=0):
+    """Write a Seabird .cnv file."""
+    p = profile_data(n_rows, air_pressure=0., seed=seed)
+    names = ["timeS: Time, Elapsed [seconds]", "prdM: Pressure, Strain Gauge [db]", "tv290C: Temperature [ITS-90, deg C]",
+             "c0uS/cm: Conductivity [uS/cm]", "sbeox0PS: Oxygen, SBE 43 [% saturation]", "sbeox0Mg/L: Oxygen, SBE 43 [mg/l]",
+             "turbWETntu0: Turbidity, WET Labs ECO [NTU]"]
+    with open(file_path, "w", encoding="cp1252") as f:
+        f.write("* Sea-Bird SBE19plus Data File:\n* FileName = synthetic.hex\n")
+        f.write("# nquan = {}\n# nvalues = {}\n".format(len(names), n_rows))
+        for k, name in enumerate(names):
+            f.write("# name {} = {}\n".format(k, name))
+        f.write("# start_time = {} [Instrument's time stamp, header]\n".format(start_time.strftime("%b %d %Y %H:%M:%S")))
+        f.write("*END*\n")
+        table = pd.DataFrame({"t": p["time"] - p["time"][0], "p": p["Press"], "T": p["Temp"], "C": p["Cond"] * 1000,
+                              "sat": p["sat"], "DO": p["DO_mg"], "turb": p["Turb"]})
+        table.to_csv(f, sep=" ", header=False, index=False, float_format="%.4f", lineterminator="\n")
+    write_profile_meta(os.path.dirname(file_path), os.path.splitext(os.path.basename(file_path))[0], "Seabird")
+    return file_path
+
+
+def generate_exo(file_path, n_rows, seed=0):
+    """Write an EXO .csv file (UTF-16, 9 header lines)."""
+    p = profile_data(n_rows, air_pressure=0., dt_sec=1., seed=seed)
+    times = pd.to_datetime(p["time"], unit="s")
+    table = pd.DataFrame({"Date (MM/DD/YYYY)": times.strftime("%m/%d/%Y"), "Time (HH:mm:ss)": times.strftime("%H:%M:%S"),
+                          "Pressure psi a": (p["Press"] + 10.1) * 1.450377, "Temp °C": p["Temp"], "Cond µS/cm": p["Cond"] * 1000,
+                          "ODO % CB": p["sat"], "ODO mg/L": p["DO_mg"]})
+    header = "KOR Export File\n\n\nFILE CREATED:,{}\n\n\n\n\n\n".format(start_time.strftime("%m/%d/%Y"))
+    with open(file_path, "w", encoding="utf-16", newline="") as f:
+        f.write(header)
+        table.to_csv(f, index=False, float_format="%.4f", lineterminator="\n")
+    write_profile_meta(os.path.dirname(file_path), os.path.splitext(os.path.basename(file_path))[0], "EXO")
+    return file_path
+
+
+def generate_rbr(file_path, n_rows, seed=0):
+    """
+    Return the profiles of a synthetic RBR file, as returned by read_rbr, and write their metadata.
+
+    Only the profile detection (casts_to_profiles) is done: the .rsk database itself is not generated.
+    """
+    import functions_ctd
+    p = profile_data(n_rows, seed=seed)
+    df = pd.DataFrame({key: p[key] for key in ["time", "Press", "Temp", "Cond", "Chl_A", "sat", "DO_mg"]})
+    n_air = n_rows // 10
+    bottom = int(np.argmax(p["depth"]))
+    profiles = functions_ctd.casts_to_profiles(df, [list(range(n_air, bottom + 1))], [list(range(bottom + 1, n_rows))], file_path, "RBR",
+                                               float(np.mean(p["Press"][:n_air])))
+    write_profile_meta(os.path.dirname(file_path), profiles[0]["name"], "RBR")
+    return profiles
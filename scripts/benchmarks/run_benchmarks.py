@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark the processing stages (parse, QA, export, gridding, derive_variables, potential temperature, Thorpe scales) on synthetic Level0 files.
+
+    python run_benchmarks.py --rows 100000 --sensors 10 --profile-rows 20000
+    python run_benchmarks.py --save-baseline      # store the results as the new baseline
+    python run_benchmarks.py --tolerance 0.3      # fail (exit code 1) if a stage is 30% slower or uses 30% more memory than the baseline
+    python run_benchmarks.py --storage-report     # also print the size and read time of the exported netCDF files
+
+Each stage is timed on fresh outputs (best of --repeat runs), then run once more with tracemalloc to measure the
+peak memory allocated by Python and numpy (memory allocated by the HDF5/netCDF libraries is not included).
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import netCDF4
+import numpy as np
+
+benchmarks_folder = os.path.dirname(os.path.abspath(__file__))
+for folder in ["", "1-Mooring", "2-CTD"]:
+    sys.path.append(os.path.join(benchmarks_folder, "..", folder))
+import generators
+import functions_mooring
+import functions_ctd
+import main_mooring
+from netcdf_storage import storage_report
+from thermistor import thermistor_series, thermistor_grid
+from ctd import CTD, thorpe_analysis
+
+ctd_files = {"sea&sun": (".tob", generators.generate_sea_and_sun), "seabird": (".cnv", generators.generate_seabird),
+             "exo": (".csv", generators.generate_exo), "rbr": (".rsk", generators.generate_rbr)}
+mooring_qa = os.path.join(benchmarks_folder, "..", "1-Mooring", "quality_assurance_mooring.json")
+ctd_qa = os.path.join(benchmarks_folder, "..", "2-CTD", "quality_assurance_ctd.json")
+
+
+def measure(func, setup=None, repeat=3, memory=True):
+    """Return the result of func(*setup()), the best time of repeat runs [s] and the peak memory [MB] of one more run."""
+    seconds = np.inf
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        t0 = time.perf_counter()
+        result = func(*args)
+        seconds = min(seconds, time.perf_counter() - t0)
+    peak = np.nan
+    if memory:
+        args = setup() if setup else ()
+        tracemalloc.start()
+        func(*args)
+        peak = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+def clean(*folders):
+    # Setup of the stages writing files: start from empty output folders
+    for folder in folders:
+        shutil.rmtree(folder, ignore_errors=True)
+    return ()
+
+
+def check_levels(folder_L1, folder_L2):
+    """Raise an error if the masked values of an L2 file are not the flagged (_qual > 0) or missing values of its L1 file."""
+    for file in sorted(os.listdir(folder_L1)):
+        with netCDF4.Dataset(os.path.join(folder_L1, file)) as nc_L1, netCDF4.Dataset(os.path.join(folder_L2, "L2" + file[2:])) as nc_L2:
+            for key in nc_L1.variables:
+                if key + "_qual" not in nc_L1.variables:
+                    continue
+                expected = (np.asarray(nc_L1.variables[key + "_qual"][:]) > 0) | np.ma.getmaskarray(nc_L1.variables[key][:])
+                masked = np.ma.getmaskarray(nc_L2.variables[key][:])
+                if not np.array_equal(masked, expected):
+                    raise ValueError("{} {}: {} masked values in L2 instead of {} flagged in L1".format(file, key, masked.sum(), expected.sum()))
+
+
+def benchmark_mooring(results, work_folder, n_sensors, n_rows, repeat, memory, storage=None):
+    date_campaign = "20250605"
+    meta = generators.generate_mooring_campaign(work_folder, date_campaign, n_sensors, n_rows)
+    input_folder = os.path.join(work_folder, date_campaign)
+    paths = [os.path.join(input_folder, "Level0", file) for file in meta["filenames"]]
+    n_total = n_sensors * n_rows
+
+    for engine in ["stream", "pandas"]:
+        data, seconds, peak = measure(lambda: [functions_mooring.read_data(path, "hobo_T", engine=engine) for path in paths], repeat=repeat, memory=memory)
+        results["mooring.parse." + engine] = (n_total, seconds, peak)
+
+    def quality_assurance():
+        series = []
+        for data_temp in data:
+            temp_series = thermistor_series()
+            temp_series.read_timeseries(data_temp, meta)
+            temp_series.quality_assurance(mooring_qa)
+            series.append(temp_series)
+        return series
+    series, seconds, peak = measure(quality_assurance, repeat=repeat, memory=memory)
+    results["mooring.qa"] = (n_total, seconds, peak)
+
+    levels = [os.path.join(input_folder, level) for level in ["Level1", "Level2", "Level3"]]
+    def export():
+        for temp_series in series:
+            name = temp_series.filename.rsplit('.', 1)[0]
+            functions_mooring.export(temp_series, levels[0], "L1_mooring_" + name, overwrite=True, folder_masked=levels[1], title_masked="L2_mooring_" + name)
+    _, seconds, peak = measure(export, setup=lambda: clean(*levels[:2]), repeat=repeat, memory=memory)
+    results["mooring.export"] = (n_total, seconds, peak)
+    export() # Again onto the existing files: the L2 mask must survive the merge
+    check_levels(*levels[:2])
+
+    temp_grid = thermistor_grid()
+    temp_grid.add_metadata(meta)
+    temp_grid.quality_assurance(mooring_qa)
+    tnum_interp = np.arange(series[0].data["time"][0], series[0].data["time"][-1], temp_grid.dt_sec)
+    files_L2 = sorted(os.listdir(levels[1]))
+    _, seconds, peak = measure(lambda: functions_mooring.grid_temp(temp_grid, levels[1], files_L2, tnum_interp, levels[2], "L3_mooring", n_workers=1),
+                               setup=lambda: clean(levels[2]), repeat=repeat, memory=memory)
+    results["mooring.grid"] = (n_total, seconds, peak)
+    _, seconds, peak = measure(lambda: functions_mooring.create_temp_grid(levels[1], files_L2, tnum_interp), repeat=repeat, memory=memory)
+    results["mooring.create_temp_grid"] = (n_total, seconds, peak)
+    if storage is not None:
+        storage.extend(storage_report([os.path.join(level, file) for level in levels for file in sorted(os.listdir(level))]))
+
+
+def check_incremental(work_folder, n_sensors, n_rows):
+    """
+    Raise an error if a serviced mooring (same loggers, longer records) is not appended to the existing L2 and L3 files.
+
+    The campaign is processed, then generated again with twice the rows and processed with the pipeline: the L2 nodes
+    are rebuilt, the files written by the first run (marked with a global attribute) must be kept and extended.
+    The temperature of the first L3 time step is overwritten between the runs: only the new time steps may be gridded.
+    """
+    date_campaign = "20250605"
+    input_folder = os.path.join(work_folder, date_campaign)
+    generators.generate_mooring_campaign(work_folder, date_campaign, n_sensors, n_rows)
+    main_mooring.process_campaign(input_folder, date_campaign, n_workers=1, report_memory=False)
+    files = {}
+    for level in ["Level2", "Level3"]:
+        for file in os.listdir(os.path.join(input_folder, level)):
+            with netCDF4.Dataset(os.path.join(input_folder, level, file), mode="a") as nc:
+                nc.benchmark_marker = "first run"
+                files[os.path.join(level, file)] = np.array(nc.variables["time"][:])
+                if level == "Level3":
+                    nc.variables["temp"][:, 0] = -1.
+
+    generators.generate_mooring_campaign(work_folder, date_campaign, n_sensors, 2 * n_rows)
+    status = main_mooring.process_campaign(input_folder, date_campaign, n_workers=1, report_memory=False)
+    if any(status[name] != "built" for name in status):
+        raise ValueError("Steps not rebuilt after the service of the mooring: {}".format(status))
+    for file, time_first in files.items():
+        if not os.path.isfile(os.path.join(input_folder, file)):
+            raise ValueError("{} was deleted instead of appended".format(file))
+        with netCDF4.Dataset(os.path.join(input_folder, file)) as nc:
+            if "benchmark_marker" not in nc.ncattrs():
+                raise ValueError("{} was recreated instead of appended".format(file))
+            time = np.array(nc.variables["time"][:])
+            if file.startswith("Level3") and (np.any(nc.variables["temp"][:, 0] != -1.) or np.ma.getmaskarray(nc.variables["temp"][:, len(time_first):]).all()):
+                raise ValueError("{}: the time steps of the first run were gridded again".format(file))
+        if len(time) <= len(time_first) or not np.array_equal(time[:len(time_first)], time_first):
+            raise ValueError("{}: {} time steps after the second run, {} before".format(file, len(time), len(time_first)))
+
+
+def benchmark_ctd(results, work_folder, file_type, n_rows, repeat, memory, storage=None):
+    extension, generator = ctd_files[file_type]
+    folder = os.path.join(work_folder, file_type.replace("&", ""))
+    level0 = os.path.join(folder, "Level0")
+    os.makedirs(level0, exist_ok=True)
+    path = os.path.join(level0, "profile" + extension)
+    if file_type == "rbr": # No .rsk file: the parsing is not measured
+        profiles = generator(path, n_rows)
+    else:
+        generator(path, n_rows)
+        profiles, seconds, peak = measure(lambda: functions_ctd.read_data(path, file_type), repeat=repeat, memory=memory)
+        results["ctd.{}.parse".format(file_type)] = (n_rows, seconds, peak)
+    n_profile = len(profiles[0]["data"])
+
+    def quality_assurance():
+        ctd = CTD()
+        ctd.read_profile(profiles[0])
+        ctd.quality_assurance(ctd_qa)
+        return ctd
+    _, seconds, peak = measure(quality_assurance, repeat=repeat, memory=memory)
+    results["ctd.{}.qa".format(file_type)] = (n_profile, seconds, peak)
+
+    _, seconds, peak = measure(lambda ctd: ctd.derive_variables(), setup=lambda: (quality_assurance(),), repeat=repeat, memory=memory)
+    results["ctd.{}.derive_variables".format(file_type)] = (n_profile, seconds, peak)
+    _, seconds_freshwater, peak = measure(lambda ctd: ctd.derive_variables(freshwater=True), setup=lambda: (quality_assurance(),), repeat=repeat, memory=memory)
+    results["ctd.{}.derive_variables_freshwater".format(file_type)] = (n_profile, seconds_freshwater, peak)
+
+    def setup_thorpe():
+        ctd = quality_assurance()
+        ctd.derive_variables()
+        return (ctd,)
+    _, seconds_thorpe, peak = measure(lambda ctd: thorpe_analysis([ctd]), setup=setup_thorpe, repeat=repeat, memory=memory)
+    results["ctd.{}.thorpe".format(file_type)] = (n_profile, seconds_thorpe, peak)
+
+    # Potential temperature alone: seawater.ptmp and closed-form freshwater formula
+    ctd = quality_assurance()
+    temp, salin, press = ctd.data["Temp"], np.full(n_profile, 0.2), ctd.data["Press"] - np.nanmin(ctd.data["Press"])
+    pt_sw, seconds_sw, peak = measure(lambda: functions_ctd.potential_temperature_sw(temp, salin, press, 0), repeat=repeat, memory=memory)
+    results["ctd.{}.pt_sw".format(file_type)] = (n_profile, seconds_sw, peak)
+    pt_fw, seconds_fw, peak = measure(lambda: functions_ctd.potential_temperature_freshwater(temp, salin, press, 0), repeat=repeat, memory=memory)
+    results["ctd.{}.pt_freshwater".format(file_type)] = (n_profile, seconds_fw, peak)
+    print("{}: potential temperature {:.1f}x faster, derive_variables {:.1f}x faster in freshwater mode (max difference {:.1e} degC)".format(
+        file_type, seconds_sw / seconds_fw, seconds / seconds_freshwater, np.nanmax(np.abs(pt_fw - pt_sw))))
+
+    levels = [os.path.join(folder, level) for level in ["Level1", "Level2"]]
+    def setup_export():
+        clean(*levels)
+        return (quality_assurance(),)
+    _, seconds, peak = measure(lambda ctd: ctd.export_levels(levels[0], "L1_CTD", levels[1], "L2_CTD", overwrite=True),
+                               setup=setup_export, repeat=repeat, memory=memory)
+    results["ctd.{}.export".format(file_type)] = (n_profile, seconds, peak) # Level 1 and Level 2, derive_variables included
+    ctd = quality_assurance()
+    ctd.export_levels(levels[0], "L1_CTD", levels[1], "L2_CTD", overwrite=True) # Again onto the existing files
+    check_levels(*levels)
+    if storage is not None:
+        storage.extend(storage_report([os.path.join(level, file) for level in levels for file in sorted(os.listdir(level))]))
+
+
+def compare(results, baseline, tolerance):
+    """Return the stages slower or using more memory than the baseline by more than tolerance (relative)."""
+    regressions = []
+    for stage, values in results.items():
+        if stage not in baseline:
+            continue
+        if values["seconds"] > baseline[stage]["seconds"] * (1 + tolerance):
+            regressions.append("{}: {:.3f} s instead of {:.3f} s".format(stage, values["seconds"], baseline[stage]["seconds"]))
+        if values["peak_mb"] > baseline[stage]["peak_mb"] * (1 + tolerance):
+            regressions.append("{}: {:.1f} MB instead of {:.1f} MB".format(stage, values["peak_mb"], baseline[stage]["peak_mb"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the processing stages on synthetic Level0 files.")
+    parser.add_argument("--rows", type=int, default=100000, help="Number of rows per mooring logger")
+    parser.add_argument("--sensors", type=int, default=10, help="Number of mooring loggers")
+    parser.add_argument("--profile-rows", type=int, default=20000, help="Number of rows per CTD file")
+    parser.add_argument("--readers", nargs="+", default=["hobo_T"] + list(ctd_files), help="Readers to benchmark (hobo_T, sea&sun, seabird, exo, rbr)")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of timed runs per stage (the best one is kept)")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="Do not measure the peak memory")
+    parser.add_argument("--baseline", default=os.path.join(benchmarks_folder, "baseline.json"), help="Baseline file")
+    parser.add_argument("--save-baseline", action="store_true", help="Store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Relative slowdown or memory increase reported as a regression")
+    parser.add_argument("--output", default=None, help="Write the results to this JSON file")
+    parser.add_argument("--storage-report", action="store_true", help="Print the size and read time of the exported netCDF files (added to --output)")
+    args = parser.parse_args(argv)
+
+    work_folder = tempfile.mkdtemp(prefix="benchmark_")
+    results = {}
+    storage = [] if args.storage_report else None
+    failed = []
+    try:
+        for reader in args.readers:
+            try: # The stages measured before a failure are kept
+                if reader == "hobo_T":
+                    benchmark_mooring(results, os.path.join(work_folder, "mooring"), args.sensors, args.rows, args.repeat, args.memory, storage)
+                    check_incremental(os.path.join(work_folder, "incremental"), args.sensors, min(args.rows, 5000))
+                else:
+                    benchmark_ctd(results, os.path.join(work_folder, "ctd"), reader, args.profile_rows, args.repeat, args.memory, storage)
+            except Exception as e:
+                print(e)
+                prefix = "mooring." if reader == "hobo_T" else "ctd.{}.".format(reader)
+                failed.append("{} failed after {} stages: {}".format(reader, len([stage for stage in results if stage.startswith(prefix)]), repr(e)))
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+    results = {stage: {"rows": rows, "seconds": seconds, "rows_per_s": rows / seconds, "peak_mb": peak} for stage, (rows, seconds, peak) in results.items()}
+
+    print("\n{:<40} {:>10} {:>10} {:>12} {:>10}".format("Stage", "rows", "time (s)", "rows/s", "peak (MB)"))
+    for stage, values in results.items():
+        print("{:<40} {:>10} {:>10.3f} {:>12.0f} {:>10.1f}".format(stage, values["rows"], values["seconds"], values["rows_per_s"], values["peak_mb"]))
+    for failure in failed:
+        print("FAILED " + failure)
+    config = {"rows": args.rows, "sensors": args.sensors, "profile_rows": args.profile_rows}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(dict({"config": config, "results": results}, **({"storage": storage} if storage is not None else {})), f, indent=1)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"config": config, "results": results}, f, indent=1)
+        print("Baseline saved to {}".format(args.baseline))
+    elif os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["config"] != config:
+            print("Baseline computed with {}, not compared".format(baseline["config"]))
+        else:
+            regressions = compare(results, baseline["results"], args.tolerance)
+            for regression in regressions:
+                print("REGRESSION " + regression)
+            print("{} regressions compared to the baseline".format(len(regressions)))
+            return 1 if regressions or failed else 0
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
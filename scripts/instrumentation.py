@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Timing and memory instrumentation of the processing stages, written to a run report (JSON and CSV).
+
+    start_report(folder)
+    with stage("read_data", file=file, inputs=[path]) as record:
+        data = read_data(path)
+        record["rows"] = len(data)
+    write_report(folder, "L0_to_L2")
+
+Each stage records its wall time, the rows processed, the bytes read (size of the inputs) and written (size of the
+outputs set in record["outputs"]) and the tracemalloc peak. The records are appended to one file per process in the
+report folder, so that the stages run in a process pool are included, and merged by write_report.
+"""
+import os
+import csv
+import json
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from contextlib import contextmanager
+
+report_variable = "RUN_REPORT_FOLDER" # Environment variable: inherited by the worker processes
+memory_variable = "RUN_REPORT_MEMORY"
+fields = ["stage", "file", "start", "wall_s", "rows", "rows_per_s", "bytes_read", "bytes_written", "peak_mb", "success", "pid"]
+open_stages = [] # Stages in progress in this process (nested stages)
+
+
+def start_report(folder, memory=True):
+    """Record the stages of this process and its worker processes in folder (memory=False: no tracemalloc, lower overhead)."""
+    os.makedirs(folder, exist_ok=True)
+    for file in os.listdir(folder):
+        if file.startswith("records_") and file.endswith(".jsonl"): # Left by an interrupted run
+            os.remove(os.path.join(folder, file))
+    os.environ[report_variable] = os.path.abspath(folder)
+    os.environ[memory_variable] = "1" if memory else "0"
+
+
+def file_size(paths):
+    return int(sum(os.path.getsize(path) for path in paths if path and os.path.isfile(path)))
+
+
+@contextmanager
+def stage(name, file="", rows=0, inputs=()):
+    """Measure the stage name. Set record["rows"] and record["outputs"] in the block if they are only known at the end."""
+    record = {"stage": name, "file": os.path.basename(file), "rows": rows, "outputs": [], "success": False}
+    folder = os.environ.get(report_variable)
+    if not folder:
+        yield record
+        return
+    memory = os.environ.get(memory_variable) == "1"
+    if memory:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        record["memory_start"] = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    record["peak_abs"] = 0
+    open_stages.append(record)
+    record["start"] = datetime.now(timezone.utc).isoformat()
+    t0 = time.perf_counter()
+    try:
+        yield record
+        record["success"] = True
+    finally:
+        record["wall_s"] = time.perf_counter() - t0
+        open_stages.pop()
+        if memory:
+            peak_abs = max(record["peak_abs"], tracemalloc.get_traced_memory()[1])
+            record["peak_mb"] = (peak_abs - record["memory_start"]) / 1e6
+            if open_stages: # The peak of a nested stage is part of the peak of the enclosing stage
+                open_stages[-1]["peak_abs"] = max(open_stages[-1]["peak_abs"], peak_abs)
+            tracemalloc.reset_peak()
+        else:
+            record["peak_mb"] = None
+        record["rows_per_s"] = record["rows"] / record["wall_s"] if record["wall_s"] > 0 else None
+        record["bytes_read"] = file_size(inputs)
+        record["bytes_written"] = file_size(record["outputs"] or [])
+        record["pid"] = os.getpid()
+        with open(os.path.join(folder, "records_{}.jsonl".format(os.getpid())), "a") as f:
+            f.write(json.dumps({key: record[key] for key in fields}) + "\n")
+
+
+def summarize(records):
+    """Totals per stage, sorted by decreasing wall time."""
+    summary = {}
+    for record in records:
+        s = summary.setdefault(record["stage"], {"stage": record["stage"], "count": 0, "failed": 0, "wall_s": 0., "rows": 0,
+                                                 "bytes_read": 0, "bytes_written": 0, "peak_mb": None})
+        s["count"] += 1
+        s["failed"] += 0 if record["success"] else 1
+        for key in ["wall_s", "rows", "bytes_read", "bytes_written"]:
+            s[key] += record[key]
+        if record["peak_mb"] is not None:
+            s["peak_mb"] = max(s["peak_mb"] or 0, record["peak_mb"])
+    for s in summary.values():
+        s["rows_per_s"] = s["rows"] / s["wall_s"] if s["wall_s"] > 0 else None
+    return sorted(summary.values(), key=lambda s: -s["wall_s"])
+
+
+def write_report(folder, title):
+    """Merge the records of all the processes into {title}_<time>.json and .csv in folder, print the summary and return the JSON path (None if no stage was run)."""
+    os.environ.pop(report_variable, None) # Stop recording
+    records = []
+    for file in sorted(os.listdir(folder)):
+        if file.startswith("records_") and file.endswith(".jsonl"):
+            with open(os.path.join(folder, file)) as f:
+                records += [json.loads(line) for line in f if line.strip()]
+            os.remove(os.path.join(folder, file))
+    if len(records) == 0:
+        print("No stage run, no run report written")
+        return None
+    records.sort(key=lambda record: record["start"])
+    summary = summarize(records)
+    name = "{}_{}".format(title, datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S"))
+    with open(os.path.join(folder, name + ".json"), "w") as f:
+        json.dump({"summary": summary, "records": records}, f, indent=1)
+    with open(os.path.join(folder, name + ".csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(records)
+    print("\n{:<20} {:>6} {:>10} {:>12} {:>12} {:>10}".format("Stage", "count", "time (s)", "rows/s", "MB written", "peak (MB)"))
+    for s in summary:
+        print("{:<20} {:>6} {:>10.2f} {:>12} {:>12.1f} {:>10}".format(s["stage"], s["count"], s["wall_s"],
+                                                                     "{:.0f}".format(s["rows_per_s"]) if s["rows_per_s"] else "-",
+                                                                     s["bytes_written"] / 1e6, "{:.1f}".format(s["peak_mb"]) if s["peak_mb"] is not None else "-"))
+    print("Run report: {}".format(os.path.join(folder, name + ".json")))
+    return os.path.join(folder, name + ".json")
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Catalog of the .meta files of a Level0 folder, parsed once per run and indexed by name and by device start time.
+
+    catalog = metadata_catalog(os.path.join(input_folder, "Level0"), os.path.join(input_folder, ".cache", "metadata_catalog.json"))
+    meta = catalog.get("237207_20250605_1420.meta")
+    names = catalog.nearest(profile_start_times, catalog.names(basename), tolerance=3600) # Nearest .meta file of each profile
+
+The parsed documents are stored in cache_path with the size and modification time of each file: the next runs only
+parse the .meta files that were added or modified.
+"""
+import os
+import json
+import numpy as np
+from datetime import datetime, timezone
+
+
+def meta_start_time(meta):
+    """Device time [s] of the start of a profile from its metadata, None if the metadata has no time of measurement."""
+    try:
+        time = datetime.strptime(meta["campaign"]["Date of measurement"] + " " + meta["profile"]["Time of measurement (local)"],
+                                 "%Y-%m-%d %H:%M").replace(tzinfo=timezone.utc).timestamp()
+        return time + (meta["campaign"]["Time Zone device (UTC+)"] - meta["campaign"]["Time Zone local (UTC+)"]) * 3600
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def nearest(values, times, tolerance=None):
+    """Index of the value nearest to each of times (binary search in the sorted values), -1 if it is further than tolerance."""
+    values = np.asarray(values, dtype=float)
+    times = np.asarray(times, dtype=float)
+    if len(values) == 0:
+        return np.full(len(times), -1)
+    order = np.argsort(values, kind="stable")
+    sorted_values = values[order]
+    right = np.clip(np.searchsorted(sorted_values, times), 0, len(values) - 1)
+    left = np.clip(right - 1, 0, len(values) - 1)
+    closest = np.where(np.abs(times - sorted_values[left]) <= np.abs(sorted_values[right] - times), left, right)
+    index = order[closest]
+    if tolerance is not None:
+        index = np.where(np.abs(sorted_values[closest] - times) <= tolerance, index, -1)
+    return index
+
+
+class metadata_catalog:
+    def __init__(self, folder, cache_path=None):
+        self.folder = folder
+        self.cache_path = cache_path
+        self.entries = {} # File name: {"size", "mtime_ns", "meta", "start"}
+        self.scan()
+
+    def scan(self):
+        """Parse the .meta files of the folder (only the new or modified ones if the catalog was persisted) and build the time index."""
+        cached = {}
+        if self.cache_path and os.path.isfile(self.cache_path):
+            try:
+                with open(self.cache_path) as f:
+                    cached = json.load(f)
+            except ValueError:
+                cached = {}
+        self.entries = {}
+        n_parsed = 0
+        for name in sorted(os.listdir(self.folder)):
+            if not name.endswith(".meta"):
+                continue
+            stat = os.stat(os.path.join(self.folder, name))
+            entry = cached.get(name)
+            if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+                with open(os.path.join(self.folder, name)) as f:
+                    meta = json.load(f)
+                entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "meta": meta, "start": meta_start_time(meta)}
+                n_parsed += 1
+            self.entries[name] = entry
+        self.start_names = sorted((name for name, entry in self.entries.items() if entry["start"] is not None), key=lambda name: self.entries[name]["start"])
+        if self.cache_path and (n_parsed > 0 or len(cached) != len(self.entries)):
+            self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+        with open(self.cache_path + ".tmp", "w") as f:
+            json.dump(self.entries, f)
+        os.replace(self.cache_path + ".tmp", self.cache_path)
+
+    def get(self, name):
+        """Parsed metadata of the file name, None if there is no such file."""
+        return self.entries[name]["meta"] if name in self.entries else None
+
+    def names(self, pattern=""):
+        """Names of the .meta files containing pattern, sorted."""
+        return [name for name in self.entries if pattern in name]
+
+    def start_time(self, name):
+        """Device start time [s] of the profile of the file name, None if unknown."""
+        return self.entries[name]["start"] if name in self.entries else None
+
+    def nearest(self, times, names=None, tolerance=None):
+        """
+        Name of the .meta file (among names, default: all) with the start time nearest to each of times [s].
+
+        The lookup is a binary search in the sorted start times. None is returned for a time without metadata closer than
+        tolerance [s] (None: no limit).
+        """
+        names = self.start_names if names is None else [name for name in self.start_names if name in set(names)]
+        index = nearest([self.entries[name]["start"] for name in names], times, tolerance)
+        return [names[k] if k >= 0 else None for k in index]
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Storage of the netCDF variables and writing of the Level 1-3 files, shared by the mooring, CTD and meteo processing.
+
+    var = create_variable(nc, {"var_name": "Temp", "dim": ("time",), "unit": "degC", "long_name": "temperature", "storage": "data"})
+    var[:] = mask_invalid(var, values)
+    append_sorted(nc, variables, masked_view(data), time, valid_time) # Level 2: flagged values masked
+"""
+import os
+import numpy as np
+import netCDF4
+import time as time_module
+
+
+# Storage of the netCDF variables, selected with the key 'storage' of the variables dictionaries ("default" if missing)
+# dtype: netCDF type, zlib/complevel/shuffle: compression, chunks: chunk size per dimension (None or missing = whole dimension),
+# scale_factor/add_offset: float values packed in integers (resolution of scale_factor)
+storage_profiles = {
+    "default": {"dtype": "f8"},
+    "time": {"dtype": "f8", "zlib": True, "complevel": 4, "shuffle": True, "chunks": {"time": 4096}},
+    "data": {"dtype": "f4", "zlib": True, "complevel": 4, "shuffle": True, "chunks": {"time": 4096}},
+    "precise": {"dtype": "f8", "zlib": True, "complevel": 4, "shuffle": True, "chunks": {"time": 4096}}, # e.g., density, for small vertical differences
+    "temperature_packed": {"dtype": "i2", "scale_factor": 0.002, "add_offset": 20., "zlib": True, "complevel": 4, "shuffle": True, "chunks": {"time": 4096}}, # -45.53 to 85.53 degC by 0.002 degC, covers the range of the thermistors (e.g., HOBO -20 to 70 degC)
+    "flag": {"dtype": "i1", "zlib": True, "complevel": 4, "shuffle": True, "chunks": {"time": 4096}},
+    "index": {"dtype": "f4", "zlib": True, "complevel": 4, "shuffle": True, "chunks": {"time": 4096}}, # Time series of the Level 4 indices
+    "grid": {"dtype": "f4", "zlib": True, "complevel": 4, "shuffle": True, "chunks": {"depth": None, "time": 64}}, # Profiles on a depth grid
+    "grid_precise": {"dtype": "f8", "zlib": True, "complevel": 4, "shuffle": True, "chunks": {"depth": None, "time": 64}},
+    "grid_count": {"dtype": "i4", "zlib": True, "complevel": 4, "shuffle": True, "chunks": {"depth": None, "time": 64}},
+    "grid_time_slab": {"dtype": "f4", "zlib": True, "complevel": 4, "shuffle": True, "chunks": {"depth": None, "time": 1024}}, # Fast reading of time windows
+    "grid_depth_column": {"dtype": "f4", "zlib": True, "complevel": 4, "shuffle": True, "chunks": {"depth": 1, "time": 65536}}, # Fast reading of single depths
+    "grid_flag": {"dtype": "i1", "zlib": True, "complevel": 4, "shuffle": True, "chunks": {"depth": None, "time": 1024}},
+}
+
+def create_variable(nc, values, shape=None):
+    # Create the netCDF variable described by values with its storage profile
+    # shape: shape of the data, used for the chunk size of the dimensions that are not specified in the profile
+    storage = storage_profiles[values.get("storage", "default")]
+    kwargs = {"zlib": storage.get("zlib", False), "complevel": storage.get("complevel", 4), "shuffle": storage.get("shuffle", True)}
+    if "chunks" in storage:
+        chunksizes = []
+        for i, dim in enumerate(values["dim"]):
+            size = storage["chunks"].get(dim)
+            if size is None:
+                size = shape[i] if shape is not None else len(nc.dimensions[dim])
+            if not nc.dimensions[dim].isunlimited():
+                size = min(size, len(nc.dimensions[dim]))
+            chunksizes.append(max(int(size), 1))
+        kwargs["chunksizes"] = chunksizes
+    dtype = np.dtype(storage["dtype"])
+    fill_value = np.nan if dtype.kind == "f" else netCDF4.default_fillvals[dtype.str[1:]]
+    var = nc.createVariable(values["var_name"], dtype, values["dim"], fill_value=fill_value, **kwargs)
+    if "scale_factor" in storage:
+        var.scale_factor = storage["scale_factor"]
+        var.add_offset = storage.get("add_offset", 0.)
+    var.units = values["unit"]
+    var.long_name = values["long_name"]
+    return var
+
+def mask_invalid(var, values):
+    # NaN cannot be written in integer variables (e.g., packed data): mask them so that they are stored as _FillValue
+    if var.dtype.kind in "iu":
+        values = np.ma.masked_invalid(np.ma.filled(np.ma.asarray(values, dtype=float), np.nan))
+        if "scale_factor" in var.ncattrs(): # Values out of the range of the packed type (beyond the sensor range) would wrap around: masked instead
+            out_of_range = np.abs((values - var.add_offset) / var.scale_factor) > np.iinfo(var.dtype).max - 1
+            if np.any(out_of_range):
+                print("{} values of {} out of the range of the packed type, written as _FillValue".format(np.sum(out_of_range), var.name))
+                values = np.ma.masked_where(np.ma.filled(out_of_range, False), values)
+        # The masked values are replaced (NaN cannot be cast when the data is packed), they are written as _FillValue
+        return np.ma.array(np.ma.filled(values, var.add_offset if "scale_factor" in var.ncattrs() else 0), mask=np.ma.getmaskarray(values))
+    return values # Masked arrays (e.g., masked_view) are written with their mask
+
+def masked_view(data):
+    # Data with the flagged values (_qual > 0) masked, the arrays share the memory of data
+    return {key: np.ma.masked_where(np.asarray(data[key + "_qual"]) > 0, values, copy=False) if key + "_qual" in data else values
+            for key, values in data.items()}
+
+def append_sorted(nc, variables, data, time, valid_time, time_label="time", overwrite=False):
+    """
+    Append the data of valid_time to an open netCDF file whose time axis is sorted.
+
+    New times after the end of the file are written at the end of the unlimited dimension. If new times fall inside
+    the existing time axis, only the part of the file after the first insertion position is merged and rewritten.
+    Times already in the file are skipped, or replaced if overwrite=True.
+    Returns False if all the data already exists in the file and nothing was written.
+    """
+    nc_time = np.array(nc.variables[time_label][:])
+    n = len(nc_time)
+    idx = np.where(valid_time)[0]
+    idx = idx[np.argsort(time[idx], kind="stable")]
+    new_time = time[idx]
+    pos = np.searchsorted(nc_time, new_time)
+    duplicate = np.zeros(len(idx), dtype=bool)
+    duplicate[pos < n] = nc_time[pos[pos < n]] == new_time[pos < n]
+    if np.all(duplicate) and not overwrite:
+        return False
+    add = ~duplicate
+    n_add = np.sum(add)
+    tail = n == 0 or np.all(new_time[add] > nc_time[-1])
+    if not tail:
+        p0 = pos[add][0] # First position where new data is inserted: the file is rewritten from there
+        order = np.argsort(np.append(nc_time[p0:], new_time[add]), kind="stable")
+    for key, values in variables.items():
+        if time_label in values["dim"]:
+            if len(values["dim"]) == 1:
+                new = mask_invalid(nc.variables[key], np.ma.asarray(data[key])[idx])
+                if overwrite and np.any(duplicate):
+                    nc.variables[key][pos[duplicate]] = new[duplicate]
+                if not np.any(add):
+                    continue
+                if tail:
+                    nc.variables[key][n:n + n_add] = new[add]
+                else:
+                    nc.variables[key][p0:n + n_add] = np.ma.concatenate((nc.variables[key][p0:n], new[add]))[order]
+            elif len(values["dim"]) == 2 and values["dim"][1] == time_label:
+                new = mask_invalid(nc.variables[key], np.ma.asarray(data[key])[:, idx])
+                if overwrite and np.any(duplicate):
+                    nc.variables[key][:, pos[duplicate]] = new[:, duplicate]
+                if not np.any(add):
+                    continue
+                if tail:
+                    nc.variables[key][:, n:n + n_add] = new[:, add]
+                else:
+                    nc.variables[key][:, p0:n + n_add] = np.ma.concatenate((nc.variables[key][:, p0:n], new[:, add]), axis=1)[:, order]
+            else:
+                raise ValueError(
+                    "Failed to write variable {} with dimensions: {} to file"
+                    .format(key, ", ".join(values["dim"])))
+    return True
+
+def insert_profiles(nc, variables, dimensions, grids, time_label="time", overwrite=False):
+    """
+    Insert gridded profiles in an open netCDF file whose time axis is sorted.
+
+    grids is a list of dictionaries with the structure of the grid of a profile (time of the profile, one value per
+    1D variable and one column per 2D variable). The insertion positions are found by binary search, then each
+    variable is reordered and written once, from the first insertion position to the end of the file.
+    Profiles already in the file are skipped, or replaced if overwrite=True.
+    """
+    nc_time = np.array(nc.variables[time_label][:])
+    n = len(nc_time)
+    times = np.array([np.atleast_1d(grid[time_label])[0] for grid in grids], dtype=float)
+    order_grids = np.argsort(times, kind="stable")
+    times = times[order_grids]
+    pos = np.searchsorted(nc_time, times)
+    duplicate = np.zeros(len(times), dtype=bool)
+    duplicate[pos < n] = nc_time[pos[pos < n]] == times[pos < n]
+    if np.any(duplicate) and not overwrite:
+        print("Grid data already exists in NetCDF for {} profile(s), skipping.".format(np.sum(duplicate)))
+    replace = duplicate & overwrite
+    add = ~duplicate
+    n_add = np.sum(add)
+    tail = n == 0 or np.all(times[add] > nc_time[-1])
+    if not tail:
+        p0 = pos[add][0] # First position where a profile is inserted: the file is rewritten from there
+        order = np.argsort(np.append(nc_time[p0:], times[add]), kind="stable")
+    for key, values in variables.items():
+        if key in dimensions and key != time_label:
+            continue
+        if len(values["dim"]) == 1 and values["dim"][0] == time_label:
+            new = np.ma.concatenate([np.ma.atleast_1d(grids[i][key])[:1] for i in order_grids]).astype(float)
+        elif len(values["dim"]) == 2 and values["dim"][1] == time_label:
+            new = np.ma.column_stack([grids[i][key] for i in order_grids])
+        else:
+            print("Unable to write {} with {} dimensions.".format(key, len(values["dim"])))
+            continue
+        var = nc.variables[key]
+        new = mask_invalid(var, new)
+        if np.any(replace):
+            var[..., pos[replace]] = new[..., replace]
+        if n_add == 0:
+            continue
+        if tail:
+            var[..., n:n + n_add] = new[..., add]
+        else:
+            var[..., p0:n + n_add] = np.ma.concatenate((var[..., p0:n], new[..., add]), axis=-1)[..., order]
+
+def storage_report(file_paths, time_window=86400, time_label="time"):
+    """
+    Print and return the size of netCDF files and the time needed to read them.
+
+    For each file: size on disk, storage of each variable (type, compression, chunks), time to read all the variables
+    and time to read a window of time_window seconds at the start of the file (time slab) of all the variables.
+    """
+    report = []
+    for file_path in file_paths:
+        with netCDF4.Dataset(file_path, mode='r') as nc:
+            variables = {}
+            for key, var in nc.variables.items():
+                filters = var.filters() or {}
+                variables[key] = {"dtype": str(var.dtype), "zlib": filters.get("zlib", False), "complevel": filters.get("complevel", 0),
+                                  "chunks": var.chunking(), "packed": "scale_factor" in var.ncattrs()}
+            t = time_module.perf_counter()
+            for key in nc.variables:
+                nc.variables[key][:]
+            read_all = time_module.perf_counter() - t
+            t = time_module.perf_counter()
+            time = nc.variables[time_label][:]
+            n_window = np.searchsorted(time, time[0] + time_window, side="right") if len(time) > 0 else 0
+            for key, var in nc.variables.items():
+                if time_label in var.dimensions:
+                    index = tuple(slice(0, n_window) if dim == time_label else slice(None) for dim in var.dimensions)
+                    var[index]
+            read_window = time_module.perf_counter() - t
+        report.append({"file": file_path, "size (MB)": os.path.getsize(file_path) / 1e6, "read all (s)": read_all,
+                       "read window (s)": read_window, "variables": variables})
+        print("{}: {:.2f} MB, read all {:.3f} s, read {:.0f} s window {:.3f} s".format(
+            os.path.basename(file_path), report[-1]["size (MB)"], read_all, time_window, read_window))
+    return report
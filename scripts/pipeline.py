@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Dependency-tracked runner for the processing steps (L0 -> L1 -> L2 -> L3).
+
+Each step is a node of a DAG. The key of a node is the hash of its input files,
+its parameters (metadata, QA configuration, ...), the code version and the keys
+of the nodes it depends on. The keys and outputs of the last run are stored in a
+manifest file: a node is only rebuilt when its key changed or one of its outputs
+is missing, the outputs of the other nodes are left untouched.
+"""
+import os
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+
+def file_hash(file_path, block_size=1 << 20):
+    """Return the sha256 of a file."""
+    h = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def object_hash(obj):
+    """Return the sha256 of a JSON serializable object (keys sorted)."""
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def code_version(paths):
+    """Return a hash of the source files used by the processing."""
+    h = hashlib.sha256()
+    for path in sorted(paths):
+        h.update(os.path.basename(path).encode())
+        h.update(file_hash(path).encode())
+    return h.hexdigest()
+
+
+class pipeline:
+    def __init__(self, manifest_path, code_version="", n_workers=None):
+        self.manifest_path = manifest_path
+        self.code_version = code_version
+        self.n_workers = n_workers
+        self.nodes = {}
+        self.manifest = {"nodes": {}, "files": {}}
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+
+    def add_node(self, name, func, args=(), inputs=(), params=None, depends=(), keep_outputs=False):
+        """
+        Add a processing step.
+
+        func(*args) is called to build the node. It returns the list of the output files,
+        or a dictionary with the keys "success" and "outputs".
+        inputs are the files read by the step, params any other setting that changes its outputs
+        and depends the names of the nodes that must be built first.
+        With keep_outputs=True the outputs of a stale node are never deleted before it is rebuilt, also when one
+        of its dependencies was rebuilt: the step updates them itself (e.g., appends the new data or rewrites them).
+        """
+        for dep in depends:
+            if dep not in self.nodes:
+                raise ValueError("Node {} depends on unknown node {}".format(name, dep))
+        self.nodes[name] = {"func": func, "args": args, "inputs": list(inputs), "params": params,
+                            "depends": list(depends), "keep_outputs": keep_outputs, "key": None}
+
+    def input_hash(self, file_path):
+        """Hash of an input file, only recomputed when its size or modification time changed."""
+        stat = os.stat(file_path)
+        entry = self.manifest["files"].get(os.path.abspath(file_path))
+        if entry and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            return entry["hash"]
+        h = file_hash(file_path)
+        self.manifest["files"][os.path.abspath(file_path)] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": h}
+        return h
+
+    def node_key(self, name):
+        node = self.nodes[name]
+        inputs = [[os.path.basename(path), self.input_hash(path) if os.path.isfile(path) else None] for path in node["inputs"]]
+        return object_hash({"inputs": inputs, "params": node["params"], "code": self.code_version,
+                            "depends": [self.nodes[dep]["key"] for dep in node["depends"]]})
+
+    def is_up_to_date(self, name):
+        previous = self.manifest["nodes"].get(name)
+        if previous is None or previous["key"] != self.nodes[name]["key"]:
+            return False
+        return all(os.path.exists(path) for path in previous["outputs"])
+
+    def levels(self):
+        """Group the nodes by depth in the DAG: the nodes of a level only depend on the previous levels."""
+        depth = {}
+        for name in self.nodes: # Nodes are added after their dependencies
+            depth[name] = max([depth[dep] + 1 for dep in self.nodes[name]["depends"]], default=0)
+        return [[name for name in self.nodes if depth[name] == d] for d in range(max(depth.values(), default=-1) + 1)]
+
+    def remove_outputs(self, name):
+        for path in self.manifest["nodes"].get(name, {}).get("outputs", []):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def prune(self):
+        """Delete the outputs of the nodes of a previous run that are not part of the DAG anymore."""
+        for name in [name for name in self.manifest["nodes"] if name not in self.nodes]:
+            print("Remove outputs of {}".format(name))
+            self.remove_outputs(name)
+            del self.manifest["nodes"][name]
+
+    def run(self, force=False, prune=True):
+        """Build the stale nodes and return a dictionary with the status of each node ("skipped", "built" or "failed")."""
+        if prune:
+            self.prune()
+        status = {}
+        for level in self.levels():
+            stale = []
+            for name in level:
+                self.nodes[name]["key"] = self.node_key(name)
+                if not force and self.is_up_to_date(name):
+                    print("{} is up to date".format(name))
+                    status[name] = "skipped"
+                else:
+                    stale.append(name)
+            for name in stale:
+                if not self.nodes[name]["keep_outputs"]:
+                    self.remove_outputs(name)
+            if self.n_workers == 1 or len(stale) <= 1:
+                results = [self.build(name) for name in stale]
+            else:
+                with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+                    futures = [executor.submit(self.nodes[name]["func"], *self.nodes[name]["args"]) for name in stale]
+                    results = [self.result(future) for future in futures]
+            for name, (success, outputs) in zip(stale, results):
+                if success:
+                    self.manifest["nodes"][name] = {"key": self.nodes[name]["key"], "outputs": [os.path.abspath(path) for path in outputs]}
+                    status[name] = "built"
+                else: # Rebuilt at the next run
+                    self.manifest["nodes"].pop(name, None)
+                    status[name] = "failed"
+            self.save()
+        return status
+
+    def build(self, name):
+        print("Build {}".format(name))
+        try:
+            return self.parse_result(self.nodes[name]["func"](*self.nodes[name]["args"]))
+        except Exception as e:
+            print(e)
+            print("Failed to build {}".format(name))
+            return False, []
+
+    def result(self, future):
+        try:
+            return self.parse_result(future.result())
+        except Exception as e:
+            print(e)
+            return False, []
+
+    @staticmethod
+    def parse_result(result):
+        if isinstance(result, dict):
+            return result["success"], result["outputs"]
+        return True, list(result)
+
+    def save(self):
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmp_path, self.manifest_path)
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Process several field campaigns from the command line.
+
+The campaigns are given as paths relative to the data folder, glob patterns are accepted:
+    python process_campaigns.py Mooring/HOBO_T/2025* Profiles/*/20250605 Meteo/Model/20250606
+The shortcuts HOBO_T, Profiles and Meteo select all the campaigns of an instrument, "all" selects everything.
+The campaigns are processed concurrently by a pool of processes and a combined summary is printed at the end.
+The run report of each campaign (time, rows, bytes and peak memory of each stage) is written to its Reports folder.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+scripts_folder = os.path.dirname(os.path.abspath(__file__))
+for folder in ["1-Mooring", "2-CTD", "Meteo"]:
+    sys.path.append(os.path.join(scripts_folder, folder))
+
+shortcuts = {"HOBO_T": ["Mooring/HOBO_T/*"], "Profiles": ["Profiles/*/*"], "Meteo": ["Meteo/Model/*"]}
+shortcuts["all"] = shortcuts["HOBO_T"] + shortcuts["Profiles"] + shortcuts["Meteo"]
+
+
+def campaign_type(path):
+    """Return the instrument of a campaign folder ("mooring", "ctd" or "meteo"), None if it is not a campaign."""
+    parts = os.path.normpath(path).split(os.sep)
+    if len(parts) < 3 or not os.path.isdir(os.path.join(path, "Level0")):
+        return None
+    if parts[-3] == "Mooring" and parts[-2] == "HOBO_T":
+        return "mooring"
+    if parts[-3] == "Profiles":
+        return "ctd"
+    if parts[-3] == "Meteo":
+        return "meteo"
+    return None
+
+
+def find_campaigns(data_folder, patterns):
+    """List the campaign folders matching the patterns (relative to data_folder)."""
+    campaigns = []
+    for pattern in patterns:
+        for p in shortcuts.get(pattern, [pattern]):
+            for path in sorted(glob.glob(os.path.join(data_folder, p))):
+                if campaign_type(path) and path not in [c["path"] for c in campaigns]:
+                    campaigns.append({"path": path, "type": campaign_type(path), "date": os.path.basename(path)})
+    return campaigns
+
+
+def process_campaign(campaign, options):
+    """Process one campaign and return its summary."""
+    summary = {"campaign": campaign["path"], "type": campaign["type"], "status": {}, "error": "", "time": 0}
+    t0 = time.time()
+    try:
+        if campaign["type"] == "mooring":
+            import main_mooring
+            summary["status"] = main_mooring.process_campaign(campaign["path"], campaign["date"], n_workers=1, force_rebuild=options["force"],
+                                                              use_cache=options["cache"], excel_engine=options["excel_engine"],
+                                                              report_memory=options["report_memory"])
+        elif campaign["type"] == "ctd":
+            import main_ctd
+            if options["date_min"]:
+                date_min = datetime.strptime(options["date_min"], "%Y-%m-%d %H:%M:%S")
+            elif campaign["date"][:8].isdigit(): # Profiles measured before the day of the campaign are removed
+                date_min = datetime.strptime(campaign["date"][:8], "%Y%m%d")
+            else:
+                date_min = datetime(1970, 1, 1)
+            summary["status"] = main_ctd.process_campaign(campaign["path"], date_min, DO_umol=options["DO_umol"], extensions=options["extensions"],
+                                                          n_workers=1, force_rebuild=options["force"], report_memory=options["report_memory"],
+                                                          profile_workers=1, freshwater=options["freshwater"], thorpe=options["thorpe"])
+        elif campaign["type"] == "meteo":
+            import main_meteo
+            summary["status"] = main_meteo.process_campaign(campaign["path"], campaign["date"], force_rebuild=options["force"], report_memory=options["report_memory"])
+    except Exception as e:
+        print(e)
+        print("Failed to process {}".format(campaign["path"]))
+        summary["error"] = repr(e)
+    summary["time"] = time.time() - t0
+    return summary
+
+
+def print_summary(summaries):
+    print("\n{:<50} {:>8} {:>8} {:>8} {:>9}".format("Campaign", "built", "skipped", "failed", "time (s)"))
+    for s in summaries:
+        values = list(s["status"].values())
+        print("{:<50} {:>8} {:>8} {:>8} {:>9.1f}".format(os.path.relpath(s["campaign"], os.path.dirname(os.path.dirname(s["campaign"]))),
+                                                        values.count("built"), values.count("skipped"), values.count("failed"), s["time"]))
+        if s["error"]:
+            print("    Error: {}".format(s["error"]))
+        for name in [name for name in s["status"] if s["status"][name] == "failed"]:
+            print("    Failed: {}".format(name))
+    n_failed = sum(1 for s in summaries if s["error"] or "failed" in s["status"].values())
+    print("{} campaigns processed, {} with errors".format(len(summaries), n_failed))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Process field campaigns from Level0 to the upper levels.")
+    parser.add_argument("campaigns", nargs="+", help="Campaign folders relative to the data folder (glob patterns accepted), or HOBO_T, Profiles, Meteo, all")
+    parser.add_argument("--data-folder", default=os.path.join(scripts_folder, "..", "data"), help="Data folder (default: ../data)")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="Number of campaigns processed at the same time (default: number of cores)")
+    parser.add_argument("--force", action="store_true", help="Reprocess everything instead of only the outputs that are out of date")
+    parser.add_argument("--date-min", default=None, help="CTD: minimum device time 'YYYY-MM-DD HH:MM:SS' (default: day of the campaign)")
+    parser.add_argument("--no-DO-umol", dest="DO_umol", action="store_false", help="CTD: RBR oxygen data is already in mg/l")
+    parser.add_argument("--extensions", nargs="+", default=None, help="CTD: only process the Level0 files with these extensions (e.g. .rsk)")
+    parser.add_argument("--seawater-ptmp", dest="freshwater", action="store_false", help="CTD: potential temperature with seawater.ptmp instead of the closed-form freshwater formula")
+    parser.add_argument("--thorpe", action="store_true", help="CTD: add the Thorpe displacements and scales to the Level2 files")
+    parser.add_argument("--no-cache", dest="cache", action="store_false", help="Mooring: do not cache the parsed Excel files")
+    parser.add_argument("--excel-engine", default="stream", choices=["stream", "pandas"], help="Mooring: engine used to read the Excel files")
+    parser.add_argument("--no-report-memory", dest="report_memory", action="store_false", help="Do not measure the peak memory of the stages in the run reports")
+    parser.add_argument("--summary", default=None, help="Write the run summary to this JSON file")
+    args = parser.parse_args(argv)
+
+    campaigns = find_campaigns(args.data_folder, args.campaigns)
+    if len(campaigns) == 0:
+        print("No campaign found")
+        return []
+    print("Process {} campaigns".format(len(campaigns)))
+    options = vars(args)
+    if args.workers == 1 or len(campaigns) == 1:
+        summaries = [process_campaign(campaign, options) for campaign in campaigns]
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = [executor.submit(process_campaign, campaign, options) for campaign in campaigns]
+            summaries = [future.result() for future in futures]
+    print_summary(summaries)
+    if args.summary:
+        with open(args.summary, "w") as f:
+            json.dump(summaries, f, indent=1)
+    return summaries
+
+
+if __name__ == "__main__":
+    main()